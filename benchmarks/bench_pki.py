@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Measures how long the credentials stage of the deployment takes with each PKI backend.
+# Usage: python3 benchmarks/bench_pki.py [--repeat N] [--clients N] [--skip-easy-rsa]
+# The easy-rsa backend clones easy-rsa from github, so it needs git and the network.
+import argparse
+import builtins
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+
+from common import load_toggler, measure, print_result
+
+
+SETTINGS = {'friendlyName': 'bench', 'region': 'us-east-1', 'isSplitTunneled': False}
+
+
+def run_in_process(toggler, clientCount):
+    deployment = toggler.Deployment(SETTINGS, 'builtin', [f"client{i}" for i in range(clientCount)])
+    with contextlib.redirect_stdout(io.StringIO()):
+        toggler.generate_credentials_in_process(deployment)
+
+
+def run_easy_rsa(toggler):
+    workingDirectory = tempfile.mkdtemp()
+    previousDirectory = os.getcwd()
+    previousInput = builtins.input
+    os.chdir(workingDirectory)
+    builtins.input = lambda prompt='': ''
+    try:
+        # easy-rsa writes to the real stdout of the process, so its output is not captured here.
+        toggler.generate_credentials_with_easy_rsa(toggler.Deployment(SETTINGS, 'easy-rsa'))
+    finally:
+        builtins.input = previousInput
+        os.chdir(previousDirectory)
+        shutil.rmtree(workingDirectory)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--clients', type=int, default=0,
+                        help='additional client certificates issued by the builtin backend')
+    parser.add_argument('--skip-easy-rsa', action='store_true')
+    arguments = parser.parse_args()
+
+    toggler = load_toggler()
+    print_result(f"builtin (+{arguments.clients} clients)",
+                 *measure(lambda: run_in_process(toggler, arguments.clients), arguments.repeat))
+    if not arguments.skip_easy_rsa:
+        # easy-rsa asks for the CA common name unless it runs in batch mode.
+        os.environ['EASYRSA_BATCH'] = '1'
+        print_result("easy-rsa", *measure(lambda: run_easy_rsa(toggler), arguments.repeat))
+
+
+if __name__ == '__main__':
+    main()
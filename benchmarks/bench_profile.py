@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Measures the cost of rendering and writing .ovpn files in bulk with ConnectionProfileTemplate.
+# The time per profile should stay flat as the number of profiles grows.
+# Usage: python3 benchmarks/bench_profile.py [--counts 10,100,1000] [--repeat N]
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from common import load_toggler
+
+CLIENT_CONFIGURATION = '''client
+dev tun
+proto udp
+remote cvpn-endpoint-0123456789abcdef0.prod.clientvpn.us-east-1.amazonaws.com 443
+remote-random-hostname
+resolv-retry infinite
+nobind
+remote-cert-tls server
+cipher AES-256-GCM
+verb 3
+<ca>
+{ca}
+</ca>
+
+
+reneg-sec 0
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', default='10,100,1000')
+    parser.add_argument('--repeat', type=int, default=3)
+    arguments = parser.parse_args()
+
+    toggler = load_toggler()
+    credentials = toggler.generate_pki('bench')
+    clientKey, clientCert = credentials['clientKey'], credentials['clientCert']
+    configuration = CLIENT_CONFIGURATION.format(ca=credentials['caCert'].decode('UTF-8').strip())
+
+    for count in [int(x) for x in arguments.counts.split(',')]:
+        renderTimings = []
+        writeTimings = []
+        for _ in range(arguments.repeat):
+            template = toggler.ConnectionProfileTemplate(configuration)
+            startTime = time.perf_counter()
+            for _ in range(count):
+                ''.join(template.render(clientKey, clientCert))
+            renderTimings.append(time.perf_counter() - startTime)
+
+            directory = Path(tempfile.mkdtemp())
+            try:
+                startTime = time.perf_counter()
+                for i in range(count):
+                    toggler.write_connection_profile(
+                        template, clientKey, clientCert, directory / f"client{i}.ovpn")
+                writeTimings.append(time.perf_counter() - startTime)
+            finally:
+                shutil.rmtree(directory)
+        print("{:>6} profiles   render {:>8.1f} us/profile   render+write {:>8.1f} us/profile".format(
+            count, min(renderTimings) / count * 1e6, min(writeTimings) / count * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# Measures the start-up cost of the script with "python -X importtime", for commands which never reach AWS.
+# It reports the wall-clock time of the whole run, the time spent importing, the heaviest top-level imports,
+# and fails when boto3/botocore get imported, or when --max-ms is given and exceeded.
+# Usage: python3 benchmarks/bench_startup.py [--repeat N] [--top N] [--max-ms MS] [--json] [-- command args...]
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from common import SCRIPT_PATH
+
+FORBIDDEN_MODULES = ('boto3', 'botocore')
+
+
+# Parses the "import time: self | cumulative | name" lines, and returns the top-level imports with their cumulative time.
+def parse_import_times(stderr):
+    topLevel = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _self, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            topLevel[name.strip()] = int(cumulative)
+    return topLevel
+
+
+def run_once(command):
+    startTime = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(SCRIPT_PATH)] + command,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wallTime = time.perf_counter() - startTime
+    return wallTime, parse_import_times(result.stderr), result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--max-ms', type=float)
+    parser.add_argument('--json', action='store_true', help='print the results as one JSON object')
+    parser.add_argument('command', nargs='*', default=['help'])
+    arguments = parser.parse_args()
+
+    wallTimes = []
+    importTimes = []
+    runs = []
+    for _ in range(arguments.repeat):
+        wallTime, topLevel, stderr = run_once(arguments.command)
+        wallTimes.append(wallTime * 1000)
+        importTimes.append(sum(topLevel.values()) / 1000)
+        runs.append(topLevel)
+    forbidden = sorted({name for topLevel in runs for name in topLevel
+                        if name.split('.')[0] in FORBIDDEN_MODULES})
+    heaviest = sorted(runs[-1].items(), key=lambda x: -x[1])[:arguments.top]
+    results = {
+        'command': arguments.command,
+        'wall_ms_median': round(statistics.median(wallTimes), 1),
+        'wall_ms_min': round(min(wallTimes), 1),
+        'import_ms_median': round(statistics.median(importTimes), 1),
+        'heaviest_imports_ms': {name: round(cumulative / 1000, 1) for name, cumulative in heaviest},
+        'forbidden_imports': forbidden,
+    }
+
+    if arguments.json:
+        print(json.dumps(results))
+    else:
+        print("Command          : {}".format(' '.join(arguments.command)))
+        print("Wall time        : median {:.1f} ms, min {:.1f} ms".format(
+            results['wall_ms_median'], results['wall_ms_min']))
+        print("Import time      : median {:.1f} ms".format(results['import_ms_median']))
+        print("Heaviest imports :")
+        for name, cumulative in results['heaviest_imports_ms'].items():
+            print("    {:<30}{:>8.1f} ms".format(name, cumulative))
+    if len(forbidden) > 0:
+        print("Imported at start-up although it should be deferred : " + ', '.join(forbidden), file=sys.stderr)
+        sys.exit(1)
+    if arguments.max_ms is not None and results['wall_ms_median'] > arguments.max_ms:
+        print("The median wall time exceeds {} ms.".format(arguments.max_ms), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+# Shared helpers of the benchmark scripts.
+# The toggler is a standalone script with a dash in its name, so it is loaded from its path instead of imported.
+import importlib.util
+import sys
+import time
+from pathlib import Path
+
+SCRIPT_PATH = Path(__file__).resolve().parent.parent / 'client-vpn-toggler.py'
+
+
+def load_toggler():
+    spec = importlib.util.spec_from_file_location('client_vpn_toggler', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that the worker processes of the process pools can find the module.
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Runs the function the given number of times and returns the best and the median wall-clock time in seconds.
+def measure(function, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - startTime)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def print_result(name, best, median):
+    print("{:<40} best {:>9.3f} s   median {:>9.3f} s".format(name, best, median))
@@ -0,0 +1,377 @@
+# An in-process fake of the EC2 Client VPN, ACM, CloudFormation and Resource Groups Tagging APIs used by the toggler.
+# It keeps the state of the endpoints, target networks, routes, certificates and stacks in memory,
+# sleeps for a configurable latency on every call, moves the resources through their states after configurable delays,
+# pages its results like AWS does, and counts the calls per operation. Optionally, it throttles the calls like AWS does,
+# with one token bucket per service, region and API family (reads or writes).
+# FakeAws.client has the signature of the toggler's CLIENT_FACTORY, so that the script runs against it unchanged.
+import collections
+import datetime
+import itertools
+import json
+import random
+import threading
+import time
+
+CLIENT_CONFIGURATION = '''client
+dev tun
+proto udp
+remote {endpointId}.prod.clientvpn.{region}.amazonaws.com 443
+remote-random-hostname
+resolv-retry infinite
+nobind
+remote-cert-tls server
+cipher AES-256-GCM
+verb 3
+<ca>
+-----BEGIN CERTIFICATE-----
+MIIBfake
+-----END CERTIFICATE-----
+</ca>
+reneg-sec 0
+'''
+
+
+# Raised like botocore's ClientError, with the error code under response['Error']['Code'].
+class FakeAwsError(Exception):
+
+    def __init__(self, code, message=''):
+        super().__init__(f"{code}: {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class FakeAws:
+
+    # latency : seconds slept by every call, plus up to jitter seconds more.
+    # transitionDelay : seconds an association or a disassociation takes.
+    # stackDelay : seconds a stack takes to be created or deleted.
+    # releaseDelay : seconds a certificate stays in use after its stack is deleted.
+    # throttleRate, throttleBurst : refill rate and size of the throttling buckets. None disables throttling.
+    def __init__(self, latency=0.0, jitter=0.0, transitionDelay=0.0, stackDelay=0.0, releaseDelay=0.0, pageSize=50,
+                 throttleRate=None, throttleBurst=10):
+        self.latency = latency
+        self.jitter = jitter
+        self.transitionDelay = transitionDelay
+        self.stackDelay = stackDelay
+        self.releaseDelay = releaseDelay
+        self.pageSize = pageSize
+        self.throttleRate = throttleRate
+        self.throttleBurst = throttleBurst
+        self.calls = collections.Counter()  # (service, operation) -> number of calls
+        self.throttled = collections.Counter()  # (service, operation) -> number of throttled calls
+        self._buckets = {}  # (service, region, family) -> (tokens, time of the last refill)
+        self.endpoints = {}  # endpoint id -> endpoint
+        self.certificates = {}  # ARN -> certificate
+        self.stacks = {}  # stack id -> stack
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def client(self, service, region):
+        return FakeClient(self, service, region)
+
+    def throttle(self, service, region, operation):
+        if self.throttleRate is None:
+            return
+        family = 'read' if operation.startswith(('describe_', 'list_', 'get_', 'export_')) else 'write'
+        now = time.monotonic()
+        tokens, refilledAt = self._buckets.get((service, region, family), (self.throttleBurst, now))
+        tokens = min(self.throttleBurst, tokens + (now - refilledAt) * self.throttleRate)
+        if tokens < 1:
+            self._buckets[(service, region, family)] = (tokens, now)
+            self.throttled[(service, operation)] += 1
+            raise FakeAwsError('RequestLimitExceeded' if service == 'ec2' else 'ThrottlingException', 'Rate exceeded')
+        self._buckets[(service, region, family)] = (tokens - 1, now)
+
+    def new_id(self, prefix):
+        return f"{prefix}-{next(self._ids):017x}"
+
+    # Creates an endpoint directly, as if it had been deployed earlier, and returns it.
+    def seed_endpoint(self, region, friendlyName, associated=False, connections=0, subnets=1):
+        with self._lock:
+            endpoint = self._add_endpoint(region, friendlyName, subnets)
+            endpoint['connections'] = connections
+            if associated:
+                for subnetId in endpoint['subnetIds']:
+                    endpoint['associations'][self.new_id('cvpn-assoc')] = {'SubnetId': subnetId, 'status': 'associated',
+                                                                           'since': 0.0}
+            return endpoint
+
+    def _add_endpoint(self, region, friendlyName, subnets=1):
+        endpointId = self.new_id('cvpn-endpoint')
+        subnetIds = [self.new_id('subnet') for _ in range(subnets)]
+        endpoint = {
+            'id': endpointId,
+            'region': region,
+            'friendlyName': friendlyName,
+            'subnetId': subnetIds[0],
+            'subnetIds': subnetIds,
+            'associations': {},  # association id -> association
+            'routes': [],
+            'connections': 0,
+        }
+        self.endpoints[endpointId] = endpoint
+        return endpoint
+
+    # Settles the transitions whose delay is over. Disassociated networks are dropped once they are reported.
+    def _settle(self, endpoint):
+        now = time.monotonic()
+        for association in endpoint['associations'].values():
+            if now - association['since'] >= self.transitionDelay:
+                if association['status'] == 'associating':
+                    association['status'] = 'associated'
+                elif association['status'] == 'disassociating':
+                    association['status'] = 'disassociated'
+
+    def _endpoint_status(self, endpoint):
+        if any(x['status'] == 'associated' for x in endpoint['associations'].values()):
+            return 'available'
+        return 'pending-associate'
+
+    def _settle_stack(self, stack):
+        elapsed = time.monotonic() - stack['since']
+        if stack['status'] == 'CREATE_IN_PROGRESS':
+            if elapsed >= self.stackDelay:
+                endpoint = self._add_endpoint(stack['region'], stack['friendlyName'],
+                                              int(stack['parameters'].get('SubnetCount', 1)))
+                stack['outputs'] = {'ClientVPNEndpointId': endpoint['id']}
+                stack['outputs'].update(zip(('SubnetId', 'SecondSubnetId', 'ThirdSubnetId'), endpoint['subnetIds']))
+                for resourceType, logicalId in (('AWS::EC2::VPC', 'VPC'), ('AWS::EC2::Subnet', 'Subnet'),
+                                                ('AWS::EC2::ClientVpnEndpoint', 'ClientVPNEndpoint')):
+                    self._add_stack_event(stack, resourceType, logicalId, 'CREATE_IN_PROGRESS')
+                    self._add_stack_event(stack, resourceType, logicalId, 'CREATE_COMPLETE')
+                self._set_stack_status(stack, 'CREATE_COMPLETE')
+        elif stack['status'] == 'DELETE_IN_PROGRESS':
+            if elapsed >= self.stackDelay:
+                self.endpoints.pop(stack['outputs'].get('ClientVPNEndpointId'), None)
+                for arn in stack['certificates']:
+                    if arn in self.certificates:
+                        self.certificates[arn]['releasedAt'] = time.monotonic() + self.releaseDelay
+                self._set_stack_status(stack, 'DELETE_COMPLETE')
+
+    def _set_stack_status(self, stack, status):
+        stack['status'] = status
+        stack['since'] = time.monotonic()
+        self._add_stack_event(stack, 'AWS::CloudFormation::Stack', stack['name'], status, stack['id'])
+
+    def _add_stack_event(self, stack, resourceType, logicalId, status, physicalId=None):
+        stack['events'].insert(0, {
+            'EventId': self.new_id('event'),
+            'StackId': stack['id'],
+            'StackName': stack['name'],
+            'LogicalResourceId': logicalId,
+            'PhysicalResourceId': physicalId or self.new_id(logicalId.lower()),
+            'ResourceType': resourceType,
+            'ResourceStatus': status,
+            'Timestamp': datetime.datetime.now(datetime.timezone.utc),
+        })
+
+    def _certificate_in_use(self, arn):
+        certificate = self.certificates[arn]
+        if certificate['releasedAt'] is not None:
+            return time.monotonic() < certificate['releasedAt']
+        return any(arn in stack['certificates'] for stack in self.stacks.values()
+                   if stack['status'] != 'DELETE_COMPLETE')
+
+    def find_stack(self, nameOrId):
+        for stack in self.stacks.values():
+            if nameOrId == stack['id'] or (nameOrId == stack['name'] and stack['status'] != 'DELETE_COMPLETE'):
+                return stack
+        raise FakeAwsError('ValidationError', f"Stack with id {nameOrId} does not exist")
+
+    def find_endpoint(self, endpointId):
+        endpoint = self.endpoints.get(endpointId)
+        if endpoint is None:
+            raise FakeAwsError('InvalidClientVpnEndpointId.NotFound', f"Endpoint {endpointId} does not exist")
+        self._settle(endpoint)
+        return endpoint
+
+    # Returns one page of the items, and the token of the next page if there is one.
+    def page(self, items, kwargs, key, tokenName='NextToken', maxResults=None):
+        start = int(kwargs.get(tokenName) or 0)
+        size = min(maxResults or self.pageSize, self.pageSize)
+        response = {key: items[start:start + size]}
+        if start + size < len(items):
+            response[tokenName] = str(start + size)
+        return response
+
+
+class FakeClient:
+
+    def __init__(self, aws, service, region):
+        self.aws = aws
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, name):
+        # Private names, and the attributes of real clients such as meta, are not operations.
+        if name.startswith('_') or name == 'meta':
+            raise AttributeError(name)
+        operation = getattr(self, f"_{self.service.replace('-', '_')}_{name}", None)
+        if operation is None:
+            raise AttributeError(f"The fake {self.service} client has no operation {name}.")
+
+        def call(**kwargs):
+            with self.aws._lock:
+                self.aws.calls[(self.service, name)] += 1
+            delay = self.aws.latency + random.uniform(0, self.aws.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            with self.aws._lock:
+                self.aws.throttle(self.service, self.region, name)
+                return operation(**kwargs)
+        return call
+
+    # *** EC2 ***
+
+    def _ec2_describe_client_vpn_endpoints(self, ClientVpnEndpointIds=(), NextToken=None, MaxResults=None):
+        # Like EC2, the whole call is rejected when one of the ids does not exist in the region.
+        missing = [x for x in ClientVpnEndpointIds
+                   if x not in self.aws.endpoints or self.aws.endpoints[x]['region'] != self.region]
+        if len(missing) > 0:
+            raise FakeAwsError('InvalidClientVpnEndpointId.NotFound',
+                               f"The client VPN endpoint ID '{missing[0]}' does not exist")
+        endpoints = [self.aws.find_endpoint(x) for x in ClientVpnEndpointIds]
+        descriptions = [{'ClientVpnEndpointId': x['id'], 'Status': {'Code': self.aws._endpoint_status(x)},
+                         'Description': x['friendlyName']} for x in endpoints]
+        return self.aws.page(descriptions, {'NextToken': NextToken}, 'ClientVpnEndpoints', maxResults=MaxResults)
+
+    def _ec2_describe_client_vpn_target_networks(self, ClientVpnEndpointId, NextToken=None, MaxResults=None):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        networks = [{'AssociationId': associationId, 'ClientVpnEndpointId': endpoint['id'],
+                     'TargetNetworkId': x['SubnetId'], 'Status': {'Code': x['status']}}
+                    for associationId, x in endpoint['associations'].items()]
+        for associationId in [k for k, x in endpoint['associations'].items() if x['status'] == 'disassociated']:
+            del endpoint['associations'][associationId]
+        return self.aws.page(networks, {'NextToken': NextToken}, 'ClientVpnTargetNetworks', maxResults=MaxResults)
+
+    def _ec2_describe_client_vpn_routes(self, ClientVpnEndpointId, NextToken=None, MaxResults=None):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        return self.aws.page(endpoint['routes'], {'NextToken': NextToken}, 'Routes', maxResults=MaxResults)
+
+    def _ec2_describe_client_vpn_connections(self, ClientVpnEndpointId, NextToken=None, MaxResults=None, Filters=None):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        connections = [{'ConnectionId': f"cvpn-connection-{i}", 'Status': {'Code': 'active'}}
+                       for i in range(endpoint['connections'])]
+        return self.aws.page(connections, {'NextToken': NextToken}, 'Connections', maxResults=MaxResults)
+
+    def _ec2_associate_client_vpn_target_network(self, ClientVpnEndpointId, SubnetId, **kwargs):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        if any(x['SubnetId'] == SubnetId and x['status'] != 'disassociated' for x in endpoint['associations'].values()):
+            raise FakeAwsError('InvalidClientVpnDuplicateAssociationException', f"{SubnetId} is associated already")
+        associationId = self.aws.new_id('cvpn-assoc')
+        endpoint['associations'][associationId] = {'SubnetId': SubnetId, 'status': 'associating',
+                                                   'since': time.monotonic()}
+        return {'AssociationId': associationId, 'Status': {'Code': 'associating'}}
+
+    def _ec2_disassociate_client_vpn_target_network(self, ClientVpnEndpointId, AssociationId, **kwargs):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        association = endpoint['associations'].get(AssociationId)
+        if association is None or association['status'] == 'disassociated':
+            raise FakeAwsError('InvalidClientVpnAssociationId.NotFound', f"{AssociationId} does not exist")
+        association['status'] = 'disassociating'
+        association['since'] = time.monotonic()
+        # The routes through the subnet go away with its association.
+        endpoint['routes'] = [x for x in endpoint['routes'] if x['TargetSubnet'] != association['SubnetId']]
+        return {'AssociationId': AssociationId, 'Status': {'Code': 'disassociating'}}
+
+    def _ec2_create_client_vpn_route(self, ClientVpnEndpointId, DestinationCidrBlock, TargetVpcSubnetId, **kwargs):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        if any(x['DestinationCidr'] == DestinationCidrBlock and x['TargetSubnet'] == TargetVpcSubnetId
+               for x in endpoint['routes']):
+            raise FakeAwsError('InvalidClientVpnRouteDuplicate', f"The route to {DestinationCidrBlock} exists already")
+        endpoint['routes'].append({'ClientVpnEndpointId': endpoint['id'], 'DestinationCidr': DestinationCidrBlock,
+                                   'TargetSubnet': TargetVpcSubnetId, 'Type': 'Nat', 'Origin': 'add-route',
+                                   'Status': {'Code': 'active'}})
+        return {'Status': {'Code': 'creating'}}
+
+    def _ec2_delete_client_vpn_route(self, ClientVpnEndpointId, DestinationCidrBlock, TargetVpcSubnetId=None, **kwargs):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        routes = [x for x in endpoint['routes'] if x['DestinationCidr'] == DestinationCidrBlock and
+                  (TargetVpcSubnetId is None or x['TargetSubnet'] == TargetVpcSubnetId)]
+        if len(routes) == 0:
+            raise FakeAwsError('InvalidClientVpnEndpointRouteNotFound', f"No route to {DestinationCidrBlock}")
+        endpoint['routes'] = [x for x in endpoint['routes'] if x not in routes]
+        return {'Status': {'Code': 'deleting'}}
+
+    def _ec2_export_client_vpn_client_configuration(self, ClientVpnEndpointId, **kwargs):
+        endpoint = self.aws.find_endpoint(ClientVpnEndpointId)
+        return {'ClientConfiguration': CLIENT_CONFIGURATION.format(endpointId=endpoint['id'], region=self.region)}
+
+    # *** ACM ***
+
+    def _acm_import_certificate(self, Certificate, PrivateKey, CertificateChain=None, Tags=()):
+        arn = f"arn:aws:acm:{self.region}:123456789012:certificate/{self.aws.new_id('cert')}"
+        self.aws.certificates[arn] = {'region': self.region, 'tags': {x['Key']: x['Value'] for x in Tags},
+                                      'releasedAt': None,
+                                      'createdAt': datetime.datetime.now(datetime.timezone.utc)}
+        return {'CertificateArn': arn}
+
+    def _acm_list_certificates(self, NextToken=None, MaxItems=None, **kwargs):
+        summaries = [{'CertificateArn': arn, 'InUse': self.aws._certificate_in_use(arn), 'CreatedAt': x['createdAt']}
+                     for arn, x in self.aws.certificates.items() if x['region'] == self.region]
+        return self.aws.page(summaries, {'NextToken': NextToken}, 'CertificateSummaryList', maxResults=MaxItems)
+
+    def _acm_delete_certificate(self, CertificateArn):
+        if CertificateArn not in self.aws.certificates:
+            raise FakeAwsError('ResourceNotFoundException', f"{CertificateArn} does not exist")
+        if self.aws._certificate_in_use(CertificateArn):
+            raise FakeAwsError('ResourceInUseException', f"{CertificateArn} is in use")
+        del self.aws.certificates[CertificateArn]
+        return {}
+
+    # *** Resource Groups Tagging ***
+
+    def _resourcegroupstaggingapi_get_resources(self, TagFilters=(), ResourceTypeFilters=(), PaginationToken=None):
+        keys = [x['Key'] for x in TagFilters]
+        resources = [{'ResourceARN': arn, 'Tags': [{'Key': k, 'Value': v} for k, v in x['tags'].items()]}
+                     for arn, x in self.aws.certificates.items()
+                     if x['region'] == self.region and all(key in x['tags'] for key in keys)]
+        response = self.aws.page(resources, {'PaginationToken': PaginationToken}, 'ResourceTagMappingList',
+                                 tokenName='PaginationToken')
+        response.setdefault('PaginationToken', '')
+        return response
+
+    # *** CloudFormation ***
+
+    def _cloudformation_create_stack(self, StackName, TemplateBody, Parameters=(), **kwargs):
+        if any(x['name'] == StackName and x['status'] != 'DELETE_COMPLETE' for x in self.aws.stacks.values()):
+            raise FakeAwsError('AlreadyExistsException', f"Stack [{StackName}] already exists")
+        json.loads(TemplateBody)
+        parameters = {x['ParameterKey']: x['ParameterValue'] for x in Parameters}
+        stackId = f"arn:aws:cloudformation:{self.region}:123456789012:stack/{StackName}/{self.aws.new_id('stack')}"
+        stack = {
+            'id': stackId,
+            'name': StackName,
+            'region': self.region,
+            'friendlyName': parameters.get('FriendlyName', StackName),
+            'parameters': parameters,
+            'certificates': [parameters[key] for key in ('ServerCertificateArn', 'ClientCertificateArn')
+                             if key in parameters],
+            'outputs': {},
+            'events': [],
+        }
+        self.aws.stacks[stackId] = stack
+        self.aws._set_stack_status(stack, 'CREATE_IN_PROGRESS')
+        return {'StackId': stackId}
+
+    def _cloudformation_describe_stacks(self, StackName):
+        stack = self.aws.find_stack(StackName)
+        self.aws._settle_stack(stack)
+        return {'Stacks': [{
+            'StackId': stack['id'],
+            'StackName': stack['name'],
+            'StackStatus': stack['status'],
+            'Parameters': [{'ParameterKey': k, 'ParameterValue': v} for k, v in stack['parameters'].items()],
+            'Outputs': [{'OutputKey': k, 'OutputValue': v} for k, v in stack['outputs'].items()],
+        }]}
+
+    def _cloudformation_describe_stack_events(self, StackName, NextToken=None):
+        stack = self.aws.find_stack(StackName)
+        self.aws._settle_stack(stack)
+        return self.aws.page(stack['events'], {'NextToken': NextToken}, 'StackEvents')
+
+    def _cloudformation_delete_stack(self, StackName):
+        stack = self.aws.find_stack(StackName)
+        self.aws._settle_stack(stack)
+        if stack['status'] != 'DELETE_COMPLETE':
+            self.aws._set_stack_status(stack, 'DELETE_IN_PROGRESS')
+        return {}
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# Runs the deploy path and the management commands of the script against the simulated AWS backend of fake_aws.py,
+# and reports the wall-clock time, the number of AWS calls and the peak memory (traced with tracemalloc) of every run.
+# routes-sync syncs a list of 2000 prefixes to one endpoint. pool-claim hands out an endpoint deployed beforehand.
+# daemon drives the toggle daemon in process, with a fake clock for its schedules.
+# fleet-gone runs fleet status with one registered profile whose endpoint was deleted behind the script's back.
+# The fleet scenarios run against 1, 10 and 500 endpoints by default, spread over several regions.
+# With --save, the results are written to a JSON file, which a later run can be compared to with --baseline :
+# the run fails when a scenario makes more AWS calls than the baseline, or takes more time or memory than allowed by --tolerance.
+# The client-side rate limiting of the script is turned off unless --rate-limit is given, since the fake does not throttle
+# unless --throttle-rate is given. Both together show how the script copes with throttling.
+# Usage: python3 benchmarks/harness.py [--scenarios a,b,...] [--sizes 1,10,500] [--regions N] [--subnets N] [--latency S]
+#                                      [--transition-delay S] [--stack-delay S] [--rate-limit] [--throttle-rate R]
+#                                      [--repeat N] [--verbose] [--json] [--save FILE] [--baseline FILE] [--tolerance R]
+import argparse
+import asyncio
+import builtins
+import datetime
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+from pathlib import Path
+
+from common import SCRIPT_PATH, load_toggler
+from fake_aws import FakeAws
+
+# Scenarios whose every run waits for real stack or association transitions are capped in size, to keep the suite short.
+# The routes-sync scenario syncs a list of ROUTE_SYNC_PREFIXES /24 prefixes, half of which are routed already,
+# to an endpoint which also has stale routes to delete.
+ROUTE_SYNC_PREFIXES = 2000
+
+SCENARIO_MAX_SIZES = {
+    'deploy': 1,
+    'deploy-spec': 10,
+    'status': 1,
+    'on': 1,
+    'off': 1,
+    'toggle': 1,
+    'routes-sync': 1,
+    'fleet-status': None,
+    'fleet-on': None,
+    'fleet-off': None,
+    'fleet-gone': None,
+    'fleet-destroy': 10,
+    'pool-fill': 10,
+    'pool-claim': 1,
+    'daemon': 10,
+}
+
+
+def seed_endpoints(toggler, fake, size, regions, associated, subnets):
+    profiles = []
+    for i in range(size):
+        region = regions[i % len(regions)]
+        endpoint = fake.seed_endpoint(region, f"bench{i}", associated=associated, subnets=subnets)
+        profiles.append({'AWS_REGION': region, 'ENDPOINT_ID': endpoint['id'], 'SUBNET_ID': endpoint['subnetId'],
+                         'SUBNET_IDS': endpoint['subnetIds'], 'DATE_OF_CREATION': i, 'FRIENDLY_NAME': f"bench{i}"})
+    toggler.register_profiles(profiles)
+    return profiles
+
+
+# Drives the daemon without its socket, and fails when it acts twice on an endpoint. Every endpoint is toggled by
+# two concurrent requests, of which only the first may go through, then its status is read once it is on.
+# The clock is then moved past the end of the schedules, so that the next tick turns every endpoint off again,
+# and one endpoint is deleted before a last refresh.
+def run_daemon_session(toggler, fake, profiles, subnets):
+    moment = [datetime.datetime(2026, 1, 5, 12, 0)]
+    schedules = {profile['FRIENDLY_NAME']: '08:00-20:00' for profile in profiles}
+    daemon = toggler.ToggleDaemon(profiles, schedules, clientFactory=partial(fake.client, 'ec2'),
+                                  clock=lambda: moment[0])
+
+    async def session():
+        await daemon.refresh()
+        await daemon.apply_schedules()
+        for profile in profiles:
+            results = await asyncio.gather(
+                *[daemon.handle_request({'command': 'toggle', 'endpoint': profile['FRIENDLY_NAME']})
+                  for _ in range(2)], return_exceptions=True)
+            if [isinstance(result, Exception) for result in results] != [False, True]:
+                raise Exception(f"Two concurrent toggles of {profile['FRIENDLY_NAME']} gave {results!r}.")
+        deadline = time.monotonic() + 60
+        while any(entry['expectedState'] is not None for entry in daemon.endpoints.values()):
+            if time.monotonic() > deadline:
+                raise Exception("The endpoints were not associated in time.")
+            await asyncio.sleep(fake.transitionDelay)
+            await daemon.refresh()
+        for profile in profiles:
+            response = await daemon.handle_request({'command': 'status', 'endpoint': profile['FRIENDLY_NAME']})
+            if response['state'] != 'available':
+                raise Exception(f"{profile['FRIENDLY_NAME']} is {response['state']} after being toggled on.")
+        moment[0] = moment[0].replace(hour=21)
+        await daemon.apply_schedules()
+        for profile in profiles:
+            if daemon.find(profile['FRIENDLY_NAME'])['expectedState'] != 'pending-associate':
+                raise Exception(f"The schedule did not turn {profile['FRIENDLY_NAME']} off.")
+        # An endpoint deleted behind the daemon's back is marked not-found, while the others keep being refreshed.
+        del fake.endpoints[profiles[0]['ENDPOINT_ID']]
+        await asyncio.sleep(fake.transitionDelay)
+        await daemon.refresh()
+        states = [daemon.find(profile['FRIENDLY_NAME'])['state'] for profile in profiles]
+        if states != ['not-found'] + ['pending-associate'] * (len(profiles) - 1):
+            raise Exception(f"The daemon refreshed the states to {states!r} with one endpoint gone.")
+
+    try:
+        asyncio.run(session())
+    finally:
+        daemon.executor.shutdown()
+    associations = fake.calls[('ec2', 'associate_client_vpn_target_network')]
+    if associations != len(profiles) * subnets:
+        raise Exception(f"The daemon made {associations} associations for {len(profiles)} endpoint(s).")
+
+
+# Runs fleet status, and fails unless the endpoint which is gone is listed as not-found while the others are described.
+def run_fleet_gone(toggler, goneEndpointId):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        toggler.manage()
+    print(output.getvalue(), end='')
+    rows = [line.split() for line in output.getvalue().splitlines() if 'cvpn-endpoint-' in line]
+    states = {row[2]: row[3] for row in rows}
+    if states.get(goneEndpointId) != 'not-found' or \
+            any(state == 'not-found' for endpointId, state in states.items() if endpointId != goneEndpointId):
+        raise Exception(f"fleet status gave {states!r} with {goneEndpointId} gone.")
+
+
+# Seeds the fake and the registry for the scenario, and returns the command line to run with the function to run it.
+def prepare(toggler, fake, scenario, size, regions, subnets):
+    if scenario == 'deploy':
+        # The prompts : the CWD notice, the friendly name, split tunnel, the region number and the final confirmation.
+        answers = iter(['', 'bench0', 'n', str(toggler.CLIENT_VPN_REGIONS.index(regions[0]) + 1), ''])
+        builtins.input = lambda prompt='': next(answers)
+        return ['deploy', '--subnets', str(subnets)], toggler.deploy
+    if scenario == 'deploy-spec':
+        spec = {'deployments': [{'name': f"bench{i}", 'region': regions[i % len(regions)], 'pki': 'bench',
+                                 'subnets': subnets}
+                                for i in range(size)]}
+        Path('spec.json').write_text(json.dumps(spec))
+        return ['deploy', '--spec', 'spec.json'], toggler.deploy
+    if scenario in ('status', 'on', 'off', 'toggle'):
+        seed_endpoints(toggler, fake, 1, regions, associated=scenario == 'off', subnets=subnets)
+        waiting = ['--wait'] if scenario != 'status' else []
+        return [scenario, '-p', 'bench0'] + waiting, toggler.manage
+    if scenario == 'routes-sync':
+        profile = seed_endpoints(toggler, fake, 1, regions, associated=True, subnets=subnets)[0]
+        endpoint = fake.endpoints[profile['ENDPOINT_ID']]
+        # Every other /24 of 10.0.0.0/8 is listed, so that the prefixes cannot be collapsed.
+        prefixes = [f"10.{i // 128}.{i % 128 * 2}.0/24" for i in range(ROUTE_SYNC_PREFIXES)]
+        stale = [f"172.16.{i}.0/24" for i in range(ROUTE_SYNC_PREFIXES // 20)]
+        for cidr in prefixes[::2] + stale:
+            endpoint['routes'].append({'ClientVpnEndpointId': endpoint['id'], 'DestinationCidr': cidr,
+                                       'TargetSubnet': endpoint['subnetId'], 'Type': 'Nat', 'Origin': 'add-route',
+                                       'Status': {'Code': 'active'}})
+        Path('routes.txt').write_text('\n'.join(prefixes) + '\n')
+        return ['routes', 'sync', 'routes.txt', '-p', 'bench0'], toggler.manage
+    if scenario == 'pool-fill':
+        return ['pool', 'fill', str(size), '--region', regions[0], '--subnets', str(subnets)], toggler.manage
+    if scenario == 'pool-claim':
+        # One warm endpoint is deployed into the pool beforehand. The refill is left out, since it runs in another process.
+        sys.argv = [str(SCRIPT_PATH), 'pool', 'fill', '1', '--region', regions[0], '--subnets', str(subnets)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            toggler.manage()
+        return ['pool', 'claim', '--region', regions[0], '--no-refill', '--wait'], toggler.manage
+    if scenario == 'fleet-destroy':
+        for profile in seed_endpoints(toggler, fake, size, regions, associated=True, subnets=subnets):
+            # The stacks and certificates of the seeded endpoints, as deploy would have left them.
+            client = fake.client('acm', profile['AWS_REGION'])
+            tags = [{'Key': 'deploymentFriendlyName', 'Value': profile['FRIENDLY_NAME']}]
+            arns = [client.import_certificate(Certificate=b'', PrivateKey=b'', Tags=tags)['CertificateArn']
+                    for _ in range(2)]
+            cloudformation = fake.client('cloudformation', profile['AWS_REGION'])
+            stackId = cloudformation.create_stack(
+                StackName=f"ovpn-{profile['FRIENDLY_NAME']}", TemplateBody='{}',
+                Parameters=[{'ParameterKey': 'ServerCertificateArn', 'ParameterValue': arns[0]},
+                            {'ParameterKey': 'ClientCertificateArn', 'ParameterValue': arns[1]},
+                            {'ParameterKey': 'FriendlyName', 'ParameterValue': profile['FRIENDLY_NAME']}])['StackId']
+            stack = fake.stacks[stackId]
+            stack['status'] = 'CREATE_COMPLETE'
+            stack['outputs'] = {'ClientVPNEndpointId': profile['ENDPOINT_ID'], 'SubnetId': profile['SUBNET_ID']}
+        fake.calls.clear()
+        return ['fleet', 'destroy', '--yes'], toggler.manage
+    if scenario == 'daemon':
+        profiles = seed_endpoints(toggler, fake, size, regions, associated=False, subnets=subnets)
+        return ['daemon'], partial(run_daemon_session, toggler, fake, profiles, subnets)
+    if scenario == 'fleet-gone':
+        profiles = seed_endpoints(toggler, fake, size + 1, regions, associated=False, subnets=subnets)
+        goneEndpointId = profiles[-1]['ENDPOINT_ID']
+        del fake.endpoints[goneEndpointId]
+        return ['fleet', 'status'], partial(run_fleet_gone, toggler, goneEndpointId)
+    command = scenario[len('fleet-'):]
+    seed_endpoints(toggler, fake, size, regions, associated=command == 'off', subnets=subnets)
+    return ['fleet', command], toggler.manage
+
+
+def run_scenario(toggler, arguments, scenario, size, traceMemory):
+    fake = FakeAws(latency=arguments.latency, jitter=arguments.latency / 2,
+                   transitionDelay=arguments.transition_delay, stackDelay=arguments.stack_delay,
+                   releaseDelay=arguments.transition_delay, throttleRate=arguments.throttle_rate,
+                   throttleBurst=arguments.throttle_burst)
+    regions = toggler.CLIENT_VPN_REGIONS[:arguments.regions]
+    workingDirectory = tempfile.mkdtemp()
+    previousDirectory = os.getcwd()
+    previousInput = builtins.input
+    previousArgv = sys.argv
+    os.chdir(workingDirectory)
+    shutil.copy(SCRIPT_PATH.parent / 'cloudformation-template', workingDirectory)
+    toggler.CLIENT_FACTORY = fake.client
+    toggler._CLIENTS.clear()
+    toggler._BUCKETS.clear()
+    toggler.RETRY_BUDGET = toggler.RetryBudget()
+    toggler.RATE_LIMITING = arguments.rate_limit
+    toggler.REGISTRY_PATH = str(Path(workingDirectory) / 'profiles.sqlite3')
+    try:
+        command, function = prepare(toggler, fake, scenario, size, regions, arguments.subnets)
+        fake.calls.clear()
+        sys.argv = [str(SCRIPT_PATH)] + command
+        output = io.StringIO()
+        if traceMemory:
+            tracemalloc.start()
+        startTime = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                function()
+        except BaseException as e:
+            raise Exception(f"The scenario {scenario} ({size}) failed : {e!r}\n{output.getvalue()[-2000:]}")
+        wallTime = time.perf_counter() - startTime
+        peakMemory = None
+        if traceMemory:
+            peakMemory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return wallTime, dict(fake.calls), sum(fake.throttled.values()), peakMemory
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        sys.argv = previousArgv
+        builtins.input = previousInput
+        os.chdir(previousDirectory)
+        shutil.rmtree(workingDirectory)
+
+
+# Every scenario runs --repeat times for the wall-clock time, and once more under tracemalloc for the peak memory,
+# since tracing the allocations slows the run down.
+def run_suite(toggler, arguments):
+    results = []
+    for scenario in arguments.scenarios.split(','):
+        if scenario not in SCENARIO_MAX_SIZES:
+            raise Exception(f"No such scenario as \"{scenario}\". Please use {', '.join(SCENARIO_MAX_SIZES)}.")
+        maxSize = SCENARIO_MAX_SIZES[scenario]
+        sizes = [int(x) for x in arguments.sizes.split(',')]
+        sizes = sorted({size if maxSize is None else min(size, maxSize) for size in sizes})
+        for size in sizes:
+            wallTimes = []
+            for _ in range(arguments.repeat):
+                wallTime, calls, throttled, _peak = run_scenario(toggler, arguments, scenario, size, False)
+                wallTimes.append(wallTime)
+            _wallTime, _calls, _throttled, peakMemory = run_scenario(toggler, arguments, scenario, size, True)
+            results.append({
+                'scenario': scenario,
+                'endpoints': size,
+                'wall_s': round(min(wallTimes), 4),
+                'calls': sum(calls.values()),
+                'throttled': throttled,
+                'calls_by_operation': {f"{service}.{operation}": count
+                                       for (service, operation), count in sorted(calls.items())},
+                'peak_memory_kb': round(peakMemory / 1024, 1),
+            })
+            print(f"{scenario} ({size}) : {results[-1]['wall_s']:.3f} s, {results[-1]['calls']} calls",
+                  file=sys.stderr)
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    baselineRuns = {(x['scenario'], x['endpoints']): x for x in baseline}
+    for result in results:
+        reference = baselineRuns.get((result['scenario'], result['endpoints']))
+        if reference is None:
+            continue
+        name = f"{result['scenario']} ({result['endpoints']})"
+        if result['calls'] > reference['calls']:
+            regressions.append(f"{name} : {result['calls']} AWS calls, {reference['calls']} in the baseline")
+        # A small absolute allowance keeps the very short runs from failing on noise.
+        if result['wall_s'] > reference['wall_s'] * (1 + tolerance) + 0.05:
+            regressions.append(f"{name} : {result['wall_s']:.3f} s, {reference['wall_s']:.3f} s in the baseline")
+        if result['peak_memory_kb'] > reference['peak_memory_kb'] * (1 + tolerance) + 256:
+            regressions.append(
+                f"{name} : {result['peak_memory_kb']:.0f} KB at peak, {reference['peak_memory_kb']:.0f} KB in the baseline")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=','.join(SCENARIO_MAX_SIZES))
+    parser.add_argument('--sizes', default='1,10,500', help='numbers of endpoints of the fleet scenarios')
+    parser.add_argument('--regions', type=int, default=4, help='number of regions the endpoints are spread over')
+    parser.add_argument('--subnets', type=int, default=1, help='target subnets of every endpoint, one per AZ')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds every fake AWS call takes')
+    parser.add_argument('--transition-delay', type=float, default=0.05,
+                        help='seconds an association, a disassociation or a certificate release takes')
+    parser.add_argument('--stack-delay', type=float, default=0.2, help='seconds a stack takes to be created or deleted')
+    parser.add_argument('--rate-limit', action='store_true', help="keep the script's client-side rate limiting on")
+    parser.add_argument('--throttle-rate', type=float, help='calls per second the fake allows per region and API family')
+    parser.add_argument('--throttle-burst', type=float, default=10)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='print the AWS calls of every run by operation')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--save', help='write the results to this file, to be used as a baseline later')
+    parser.add_argument('--baseline', help='fail when the results regress from the ones saved in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative increase of time and memory allowed over the baseline')
+    arguments = parser.parse_args()
+
+    toggler = load_toggler()
+    results = run_suite(toggler, arguments)
+
+    if arguments.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("{:<16}{:>10}{:>12}{:>10}{:>11}{:>16}".format(
+            'SCENARIO', 'ENDPOINTS', 'WALL (s)', 'CALLS', 'THROTTLED', 'PEAK MEMORY'))
+        for result in results:
+            print("{:<16}{:>10}{:>12.3f}{:>10}{:>11}{:>13.0f} KB".format(
+                result['scenario'], result['endpoints'], result['wall_s'], result['calls'], result['throttled'],
+                result['peak_memory_kb']))
+            if arguments.verbose:
+                for operation, count in result['calls_by_operation'].items():
+                    print("    {:<52}{:>8}".format(operation, count))
+    if arguments.save is not None:
+        Path(arguments.save).write_text(json.dumps(results, indent=2))
+    if arguments.baseline is not None:
+        regressions = compare_to_baseline(results, json.loads(Path(arguments.baseline).read_text()), arguments.tolerance)
+        for regression in regressions:
+            print("Regression : " + regression, file=sys.stderr)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
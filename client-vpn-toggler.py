@@ -1,151 +1,2380 @@
 #!/usr/bin/env python3
 import time
 from sys import stdout
-import boto3
 import sys
-import traceback
 import string
 import random
-import subprocess
+import threading
+import os
 from pathlib import Path
-from json import dumps
+from json import dumps, loads
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial, wraps
+from contextlib import contextmanager
+
+'''
+So please leave these values below blank if you want to specify the ids with system environment variables.
+Otherwise, the values specified here would override the environment variables.
+'''
+CLOUDFORMATION_STACK_ID = ""
+CLIENT_VPN_ENDPOINT_ID = ""
+SERVER_CERTIFICATE_ARN = ""
+CLIENT_CERTIFICATE_ARN = ""
+SUBNET_ID = ""
+PKI_BACKEND = ''  # builtin or easy-rsa. Left blank, builtin is used when the cryptography package is installed.
+PKI_KEY_SIZE = 2048
+PKI_CA_DAYS = 3650
+PKI_CERT_DAYS = 825
+HELP_SCRIPT = '''
+Usage: ./client-vpn-manager [command] [-f the_config_file | -p the_profile_name]
+The python script to deploy and manage the vpn service based on AWS Client VPN Endpoints.
+
+NOTE: PLEASE HAVE YOUR AWS CLI SETUP WITH YOUR AWS ACCOUNT BEFORE YOU RUN THIS SCRIPT.
+      THE SCRIPT WILL NOT RUN WITHOUT AN AWS ACCOUNT SETUP WITH THE CLI.
+
+***TO DEPLOY A NEW VPN SERVICE, please run the script without any command or option, or with the deploy command.***
+    deploy [--pki builtin|easy-rsa] [--clients name1,name2,...] [--subnets 1-3] :
+                Deploy a new VPN service. The credentials are generated in-process with the cryptography package (builtin),
+                or with easy-rsa, which requires git and the network. Default: builtin when cryptography is installed.
+                One more client certificate and .ovpn file is created for every name given to --clients.
+                With --subnets, the VPC gets a target subnet in each of as many availability zones (Default: 1).
+                All of them are associated with the endpoint, so that it keeps working when one AZ is down.
+    deploy --spec <File> :
+                Deploy every VPN service listed in the spec file (YAML when PyYAML is installed, or JSON) without prompting.
+                Each entry gives a name and a region, and optionally splitTunnel, clients, pki and subnets.
+                The regions are deployed concurrently, and the entries with the same pki value share one PKI.
+                A summary with the duration and the critical path of every deployment is printed at the end.
+                Running the same spec again resumes the deployments which were interrupted,
+                and skips the ones which are registered already or have a stack, reported as "exists".
+    resume [Journal File] [--stack-id Stack ID] :
+                Resume an interrupted deployment from its journal (Default: the only *.deploy-journal.json under the CWD).
+                Every deployment records its finished stages in the journal, which is removed once the deployment is done.
+                The finished stages are skipped, and the stack created by the interrupted run is reattached to.
+                The journal holds the private keys of the CA and the clients until then, readable by the user only,
+                while the server key is left out once the server certificate is imported, unless the PKI is shared
+                with other entries of a spec. Keep it safe, or delete it together with the deployment's certificates
+                and stack if the deployment is not to be resumed.
+
+***TO MANAGE AN EXISTING ENDPOINT, please use the following commands:***
+    status  :   Output the current status of the specified VPN Endpoint.
+    on      :   Turn on the VPN : associate every target subnet concurrently, and create the routes through each of them.
+    off     :   Turn off the VPN : remove every association in parallel.
+    toggle  :   Toggle the VPN
+    fleet [status|on|off|destroy] [Directory or Glob] [--yes] :
+                Run the command against every profile found in the directory or matching the glob (Default: every registered profile).
+                The endpoints are handled concurrently and the results are printed as one table.
+    destroy [--yes] :
+                Tear the deployment down : disassociate its target networks, delete its stack, and delete its ACM certificates,
+                along with the certificates tagged with its friendly name which are not in use. The profile is unregistered.
+                You are asked to type the friendly name to confirm, unless --yes is given.
+    destroy --orphans [--region Region] [--yes] :
+                Delete the certificates tagged by a deployment which are not in use, in every region or in the given one.
+                The certificates imported in the last hour, and those of the deployments with a journal under the CWD
+                or with an endpoint in the pool, are left alone.
+    routes sync <CIDR File> [--dry-run] :
+                Route the split tunnel to the CIDR blocks listed in the file, one per line. The blocks are collapsed into
+                the fewest routes, and only the missing routes are created and the extra ones deleted, concurrently.
+                The routes are recorded in the profile, and created instead of 0.0.0.0/0 whenever the endpoint is turned on.
+                With --dry-run, the changes are printed without being applied.
+    routes list :
+                List the routes of the endpoint.
+    pool fill [Size] --region Region [--subnets 1-3] :
+                Keep a pool of Size endpoints deployed ahead of time in the region, left off until they are claimed.
+                The missing endpoints are deployed concurrently, and the ones beyond the size are destroyed.
+                Without a size, the pool is refilled to the size given last. The pool is kept in the registry database,
+                and the files of its deployments under ~/.config/vpn-toggle-utility/pool/.
+    pool claim [--region Region] [--name Client Name] [--output-dir Directory] [--no-refill] [--wait] :
+                Take the oldest warm endpoint out of the pool, turn it on, and write a .ovpn file for a new client
+                certificate (Default name: client). The endpoint is registered as a profile, and the pool is refilled
+                by a process running in the background, unless --no-refill is given.
+    pool status :
+                List the endpoints of the pool, and how many are ready in every region.
+    registry import [Directory or Glob] :
+                Register the .ovpnsetup profiles found in the directory (Default: CWD) or matching the glob.
+    registry list [--region Region] :
+                List the registered profiles, the most recent first.
+    issue-clients [Names File] [--ca-cert File --ca-key File] [--output-dir Directory] [--workers N] :
+                Issue one client certificate and .ovpn file for every user name listed in the file, one per line.
+                The CA recorded in the profile by the builtin PKI backend is used unless --ca-cert and --ca-key are given.
+    idle-off [Directory or Glob] [--idle-minutes N] [--interval Seconds] :
+                Watch the client connections of the endpoints (Default: every registered profile, or the one given with -f/-p),
+                and turn an endpoint off once nobody has been connected for N minutes (Default: 30).
+    daemon [Directory or Glob] [--schedules File] [--socket Path] :
+                Run in the foreground and manage every profile found in the directory or matching the glob (Default: every
+                registered profile). The endpoint states are kept in memory and served over a Unix socket
+                (Default: ~/.config/vpn-toggle-utility/daemon.sock). The schedules file is a JSON object which maps
+                friendly names or endpoint ids to daily windows, e.g. {"my-vpn": "08:00-20:00"}. An endpoint is turned on
+                when its window opens, and turned off whenever it is found on outside of its window.
+    ctl [status|on|off|toggle|list] [Friendly Name or Endpoint ID] [--socket Path] :
+                Send the command to the running daemon, and print its JSON response.
+   *help    :   Output the help 
+
+    --wait (Optional, for on/off/toggle)
+    Wait until the endpoint settles in its new state, and report how long it took.
+
+    --metrics <File> / --trace <File> (Optional, for every command)
+    Measure every AWS call (latency, retries, throttled attempts and errors) and every stage of the command.
+    At exit, the metrics are written in the Prometheus text format ("-" for stdout), and the trace as a JSON file
+    in the Trace Event Format, to be opened with chrome://tracing or https://ui.perfetto.dev.
+
+    -f [Filename] (Optional)
+    You can use the optional -f flag to specify the file which contains the profile of a specific VPN deployment.
+    Thus you can have multiple deployments active at the same time, and manage each of them with its profile.
+
+    -p [Friendly Name or Endpoint ID] (Optional)
+    Or you can pick a deployment from the profile registry, by its friendly name or its endpoint id.
+    Every deployment is registered when it is created, and older .ovpnsetup files can be added with "registry import".
+    If neither -f nor -p is specified, the most recent profile in the registry is used.
+    The registry is kept in ~/.config/vpn-toggle-utility/profiles.sqlite3.
+'''
+
+# *** THE MANAGEMENT CODE SECTION STARTS ***
+
+# The boto3 clients are built on first use, one per service and region, and shared across calls and threads.
+# boto3 is only imported here, so that the commands which never reach AWS, like help, start without loading it.
+# CLIENT_FACTORY may be set to a function (service, region) -> client, e.g. to run the script against a fake backend.
+CLIENT_FACTORY = None
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(service, region):
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get((service, region))
+        if client is None:
+            if CLIENT_FACTORY is not None:
+                client = CLIENT_FACTORY(service, region)
+            else:
+                import boto3
+                from botocore.config import Config
+                # The throttled calls are retried by RateLimitedClient, so botocore makes one attempt only.
+                client = boto3.client(service, region_name=region, config=Config(
+                    retries={'mode': 'standard', 'total_max_attempts': 1}))
+            if INSTRUMENTATION is not None:
+                INSTRUMENTATION.instrument_client(client)
+            if RATE_LIMITING:
+                client = RateLimitedClient(client, service, region)
+            _CLIENTS[(service, region)] = client
+        return client
+
+
+# With --metrics <File> and/or --trace <File>, every AWS call and every stage is measured while the script runs.
+# The boto3 clients are instrumented through their event hooks, which give the latency and the throttled attempts
+# of every call, while the retries are counted by RateLimitedClient, which makes them. The stages are the helpers
+# marked with @traced, the deploy pipeline stages and the command.
+# At exit, the metrics are written in the Prometheus text format ("-" for stdout), and the trace as a JSON trace file
+# in the Trace Event Format, which chrome://tracing and Perfetto open, with one row per thread.
+# Nothing is measured unless one of the options is given.
+INSTRUMENTATION = None
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+THROTTLING_ERROR_CODES = (
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'PriorRequestNotComplete',
+)
+
+
+class Instrumentation:
+
+    def __init__(self):
+        self.startTime = time.perf_counter()
+        self.spans = []  # (category, name, start, end, thread id, attributes), in seconds since the start
+        self.calls = {}  # (service, operation, region) -> aggregated metrics of the AWS calls
+        self.stages = {}  # name -> aggregated metrics of the stages
+        self._lock = threading.Lock()
+
+    def instrument_client(self, client):
+        meta = getattr(client, 'meta', None)
+        if meta is None or not hasattr(meta, 'events'):
+            return  # e.g. a fake client given by CLIENT_FACTORY.
+        meta.events.register('before-call', self._before_call)
+        meta.events.register('after-call', partial(self._after_call, meta.region_name))
+        meta.events.register('after-call-error', partial(self._after_call_error, meta.region_name))
+        meta.events.register('needs-retry', partial(self._needs_retry, meta.region_name))
+
+    # The request context is shared by the hooks of one call, so the start time is kept there.
+    # Every hook returns None, so that the call itself goes on untouched.
+    def _before_call(self, context, **kwargs):
+        context['instrumentationStart'] = time.perf_counter()
+
+    def _after_call(self, region, event_name, http_response, parsed, context, **kwargs):
+        errorCode = parsed.get('Error', {}).get('Code') if http_response.status_code >= 300 else None
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self._record_call(region, event_name, context, errorCode, retries)
+
+    def _after_call_error(self, region, event_name, exception, context, **kwargs):
+        self._record_call(region, event_name, context, type(exception).__name__, 0)
+
+    def _needs_retry(self, region, event_name, response, caught_exception, **kwargs):
+        if response is None or response[1].get('Error', {}).get('Code') not in THROTTLING_ERROR_CODES:
+            return
+        _event, service, operation = event_name.split('.', 2)
+        with self._lock:
+            self._call_metrics(service, operation, region)['throttles'] += 1
+
+    # The operation is given by its API name, e.g. DescribeClientVpnEndpoints, as in the event names of the hooks.
+    def record_retry(self, service, operation, region):
+        with self._lock:
+            self._call_metrics(service, operation, region)['retries'] += 1
+
+    def _call_metrics(self, service, operation, region):
+        return self.calls.setdefault((service, operation, region), {
+            'count': 0, 'errors': {}, 'retries': 0, 'throttles': 0, 'sum': 0.0,
+            'buckets': [0] * len(LATENCY_BUCKETS)})
+
+    def _record_call(self, region, eventName, context, errorCode, retries):
+        endTime = time.perf_counter()
+        startTime = context.get('instrumentationStart', endTime)
+        _event, service, operation = eventName.split('.', 2)
+        with self._lock:
+            metrics = self._call_metrics(service, operation, region)
+            metrics['count'] += 1
+            metrics['sum'] += endTime - startTime
+            metrics['retries'] += retries
+            if errorCode is not None:
+                metrics['errors'][errorCode] = metrics['errors'].get(errorCode, 0) + 1
+            record_in_buckets(metrics['buckets'], endTime - startTime)
+        self.record_span('aws', f"{service}.{operation}", startTime, endTime,
+                         {'region': region, 'retries': retries, 'error': errorCode})
+
+    def record_span(self, category, name, startTime, endTime, attributes=None):
+        with self._lock:
+            self.spans.append((category, name, startTime - self.startTime, endTime - self.startTime,
+                               threading.get_ident(), attributes or {}))
+            if category == 'stage':
+                metrics = self.stages.setdefault(name, {
+                    'count': 0, 'sum': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)})
+                metrics['count'] += 1
+                metrics['sum'] += endTime - startTime
+                record_in_buckets(metrics['buckets'], endTime - startTime)
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            write_histogram(lines, 'vpn_toggle_aws_call_duration_seconds', 'Latency of the AWS API calls, one sample per attempt.',
+                            [(aws_call_labels(key), metrics) for key, metrics in sorted(self.calls.items())])
+            for name, field, description in (('vpn_toggle_aws_call_retries_total', 'retries', 'Calls retried after a throttled or transient error.'),
+                                             ('vpn_toggle_aws_call_throttles_total', 'throttles', 'Attempts rejected as throttled.')):
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} counter")
+                for key, metrics in sorted(self.calls.items()):
+                    lines.append(f"{name}{{{aws_call_labels(key)}}} {metrics[field]}")
+            lines.append("# HELP vpn_toggle_aws_call_errors_total AWS API calls which failed, by error code.")
+            lines.append("# TYPE vpn_toggle_aws_call_errors_total counter")
+            for key, metrics in sorted(self.calls.items()):
+                for code, count in sorted(metrics['errors'].items()):
+                    lines.append(
+                        f"vpn_toggle_aws_call_errors_total{{{aws_call_labels(key)},code=\"{code}\"}} {count}")
+            write_histogram(lines, 'vpn_toggle_stage_duration_seconds', 'Duration of the deploy and manage stages.',
+                            [(f'stage="{name}"', metrics) for name, metrics in sorted(self.stages.items())])
+        return '\n'.join(lines) + '\n'
+
+    def trace_events(self):
+        with self._lock:
+            return {
+                'displayTimeUnit': 'ms',
+                'traceEvents': [{
+                    'name': name,
+                    'cat': category,
+                    'ph': 'X',
+                    'ts': round(startTime * 1e6),
+                    'dur': round((endTime - startTime) * 1e6),
+                    'pid': os.getpid(),
+                    'tid': threadId,
+                    'args': attributes,
+                } for category, name, startTime, endTime, threadId, attributes in self.spans],
+            }
+
+
+def record_in_buckets(buckets, value):
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+            buckets[index] += 1
+
+
+def aws_call_labels(key):
+    service, operation, region = key
+    return f'service="{service}",operation="{operation}",region="{region}"'
+
+
+def write_histogram(lines, name, description, series):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, metrics in series:
+        for bound, count in zip(LATENCY_BUCKETS, metrics['buckets']):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {metrics["count"]}')
+        lines.append(f"{name}_sum{{{labels}}} {metrics['sum']:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {metrics['count']}")
+
+
+@contextmanager
+def trace_span(name, category='stage'):
+    if INSTRUMENTATION is None:
+        yield
+        return
+    startTime = time.perf_counter()
+    attributes = {}
+    try:
+        yield
+    except BaseException as e:
+        attributes['error'] = type(e).__name__
+        raise
+    finally:
+        INSTRUMENTATION.record_span(category, name, startTime, time.perf_counter(), attributes)
+
+
+def traced(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if INSTRUMENTATION is None:
+            return function(*args, **kwargs)
+        with trace_span(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# Every AWS call goes through a token bucket shared by the calls of the same service, region and API family,
+# reads (describe/list/get/export) or writes, since AWS throttles them separately. Each bucket starts at the rate in
+# RATE_LIMITS and adapts AIMD-style : it grows by about one call per second every second without throttling, up to
+# RATE_MAX_FACTOR times its starting rate, and is halved on every throttled call. The buckets hand out reservations,
+# so that the concurrent callers are spaced out evenly instead of all retrying at once.
+# The throttled calls are retried, and so are the reads which failed on a transient error, as long as the retry budget
+# shared by the whole process allows it : every retry spends one token, and every successful call earns back a fraction,
+# so that a throttling storm gives up instead of piling retries on top of it.
+RATE_LIMITING = True
+RATE_LIMITS = {  # (service, family) -> (calls per second, burst)
+    ('ec2', 'read'): (20, 100),
+    ('ec2', 'write'): (5, 50),
+    ('acm', 'read'): (10, 10),
+    ('acm', 'write'): (5, 5),
+    ('cloudformation', 'read'): (10, 20),
+    ('cloudformation', 'write'): (2, 5),
+    ('resourcegroupstaggingapi', 'read'): (5, 5),
+}
+DEFAULT_RATE_LIMIT = (5, 5)
+RATE_MAX_FACTOR = 4
+RATE_MIN = 0.5
+RETRY_MAX_ATTEMPTS = 8
+RETRY_BUDGET_INITIAL = 20
+RETRY_BUDGET_MAX = 100
+RETRY_BUDGET_EARNED_PER_SUCCESS = 0.2
+TRANSIENT_ERROR_CODES = (
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+    'RequestTimeout',
+    'RequestTimeoutException',
+)
+TRANSIENT_EXCEPTIONS = ('EndpointConnectionError', 'ConnectionClosedError', 'ReadTimeoutError', 'ConnectTimeoutError')
+READ_OPERATION_PREFIXES = ('describe_', 'list_', 'get_', 'export_')
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.maxRate = rate * RATE_MAX_FACTOR
+        self.burst = burst
+        self.tokens = burst
+        self.updatedAt = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Takes a token, and sleeps until the time reserved for it when the bucket is empty.
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+            self.updatedAt = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.maxRate, self.rate + 1 / self.rate)
+
+    # The burst left is dropped too, so that the next calls are spaced out at the new rate right away.
+    def on_throttled(self):
+        with self._lock:
+            self.rate = max(RATE_MIN, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+
+class RetryBudget:
+
+    def __init__(self):
+        self.tokens = RETRY_BUDGET_INITIAL
+        self._lock = threading.Lock()
+
+    def earn(self):
+        with self._lock:
+            self.tokens = min(RETRY_BUDGET_MAX, self.tokens + RETRY_BUDGET_EARNED_PER_SUCCESS)
+
+    def spend(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+_BUCKETS = {}
+_BUCKETS_LOCK = threading.Lock()
+RETRY_BUDGET = RetryBudget()
+
+
+def get_token_bucket(service, region, family):
+    with _BUCKETS_LOCK:
+        bucket = _BUCKETS.get((service, region, family))
+        if bucket is None:
+            bucket = TokenBucket(*RATE_LIMITS.get((service, family), DEFAULT_RATE_LIMIT))
+            _BUCKETS[(service, region, family)] = bucket
+        return bucket
+
+
+# Wraps a client so that its operations go through the token bucket of their family and are retried within the budget.
+# Everything else, e.g. meta or exceptions, is the wrapped client's.
+class RateLimitedClient:
+
+    def __init__(self, client, service, region):
+        self._client = client
+        self._service = service
+        self._region = region
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name in ('can_paginate', 'get_paginator', 'get_waiter', 'close'):
+            return attribute
+        isRead = name.startswith(READ_OPERATION_PREFIXES)
+        bucket = get_token_bucket(self._service, self._region, 'read' if isRead else 'write')
+        meta = getattr(self._client, 'meta', None)
+        operationName = getattr(meta, 'method_to_api_mapping', {}).get(name, name)
+
+        @wraps(attribute)
+        def call(*args, **kwargs):
+            for attempt in range(RETRY_MAX_ATTEMPTS):
+                bucket.acquire()
+                try:
+                    response = attribute(*args, **kwargs)
+                except Exception as e:
+                    errorCode = aws_error_code(e)
+                    isThrottled = errorCode in THROTTLING_ERROR_CODES
+                    # A write which failed on a transient error may have been applied, so only the reads are retried then.
+                    isTransient = isRead and (errorCode in TRANSIENT_ERROR_CODES or type(e).__name__ in TRANSIENT_EXCEPTIONS)
+                    if isThrottled:
+                        bucket.on_throttled()
+                    if not (isThrottled or isTransient) or attempt + 1 == RETRY_MAX_ATTEMPTS or not RETRY_BUDGET.spend():
+                        raise
+                    if INSTRUMENTATION is not None:
+                        INSTRUMENTATION.record_retry(self._service, operationName, self._region)
+                    time.sleep(random.uniform(0, min(5, 0.1 * 2 ** attempt)))
+                else:
+                    bucket.on_success()
+                    RETRY_BUDGET.earn()
+                    return response
+        return call
+
+
+def start_instrumentation():
+    global INSTRUMENTATION
+    for option in ('--metrics', '--trace'):
+        path = get_option(option)
+        if path is not None and path != '-' and path.startswith('-'):
+            raise Exception(f"Please specify a value for the option {option}.")
+    if get_option('--metrics') is not None or get_option('--trace') is not None:
+        INSTRUMENTATION = Instrumentation()
+
+
+def export_instrumentation():
+    if INSTRUMENTATION is None:
+        return
+    metricsPath = get_option('--metrics')
+    if metricsPath == '-':
+        print(INSTRUMENTATION.prometheus_text(), end='')
+    elif metricsPath is not None:
+        Path(metricsPath).write_text(INSTRUMENTATION.prometheus_text())
+    tracePath = get_option('--trace')
+    if tracePath is not None:
+        Path(tracePath).write_text(dumps(INSTRUMENTATION.trace_events()))
+
+
+# Returns the error code of a failed AWS call, e.g. "AlreadyExistsException", or None for any other exception.
+def aws_error_code(e):
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+# Returns the value following the option on the command line, e.g. "easy-rsa" for get_option('--pki') with "--pki easy-rsa".
+def get_option(option, default=None):
+    arguments = sys.argv[1:]
+    if option in arguments:
+        index = arguments.index(option)
+        if index + 1 >= len(arguments):
+            raise Exception(f"Please specify a value for the option {option}.")
+        return arguments[index + 1]
+    return default
+
+
+WAIT_TIMEOUT = 900  # Associating a target network usually takes a few minutes.
+
+
+# This function calls poll() until isDone() accepts its result, sleeping in between with jittered exponential backoff.
+# Fast transitions are noticed after the first short sleeps, while slow ones cost only a few calls.
+# It returns the last result and the number of seconds spent waiting.
+def poll_with_backoff(poll, isDone, timeout=WAIT_TIMEOUT, initialDelay=1, maxDelay=30):
+    startTime = time.monotonic()
+    delay = initialDelay
+    while True:
+        result = poll()
+        elapsed = time.monotonic() - startTime
+        if isDone(result):
+            return result, elapsed
+        if elapsed >= timeout:
+            raise Exception(
+                "Timed out after {:.0f} seconds of waiting.".format(elapsed))
+        time.sleep(min(timeout - elapsed, random.uniform(delay / 2, delay)))
+        delay = min(maxDelay, delay * 2)
+
+
+# The snapshot holds what one invocation knows about an endpoint : its description, target networks and routes.
+# Each of them is fetched the first time it is read, or when it is older than SNAPSHOT_TTL seconds,
+# and every read helper below is answered from it. Mutating helpers invalidate the snapshot once they are done.
+# Nothing is fetched ahead of time, since the routes of a split tunnel may take many pages that status or off never read.
+SNAPSHOT_TTL = 5
+
+
+class EndpointSnapshot:
+
+    def __init__(self, client, endpointId, subnetIds=(), ttl=SNAPSHOT_TTL):
+        self.client = client
+        self.endpointId = endpointId
+        self.subnetIds = list(subnetIds)
+        self.ttl = ttl
+        self._entries = {}  # name -> (time of fetching, value)
+        self._lock = threading.Lock()
+
+    def _fetch_endpoint(self):
+        response = self.client.describe_client_vpn_endpoints(
+            ClientVpnEndpointIds=[
+                self.endpointId,
+            ]
+        )
+        if len(response['ClientVpnEndpoints']) > 0:
+            return response['ClientVpnEndpoints'][0]
+        else:
+            raise Exception("No existing client vpn endpoint found.")
+
+    def _fetch_target_networks(self):
+        return self._fetch_pages(self.client.describe_client_vpn_target_networks, 'ClientVpnTargetNetworks')
+
+    def _fetch_routes(self):
+        return self._fetch_pages(self.client.describe_client_vpn_routes, 'Routes')
+
+    def _fetch_pages(self, operation, key):
+        items = []
+        # The largest page the describe calls allow, so that a split tunnel with thousands of routes takes a few calls.
+        kwargs = {'ClientVpnEndpointId': self.endpointId, 'MaxResults': 1000}
+        while True:
+            response = operation(**kwargs)
+            items.extend(response[key])
+            if not response.get('NextToken'):
+                return items
+            kwargs['NextToken'] = response['NextToken']
+
+    def _get(self, name):
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(name)
+            if entry is not None and now - entry[0] < self.ttl:
+                return entry[1]
+            fetchers = {
+                'endpoint': self._fetch_endpoint,
+                'targetNetworks': self._fetch_target_networks,
+                'routes': self._fetch_routes,
+            }
+            self._entries[name] = (now, fetchers[name]())
+            return self._entries[name][1]
+
+    # Seeds the snapshot with an endpoint description fetched elsewhere, e.g. by a region-wide describe call.
+    def prime(self, endpoint):
+        with self._lock:
+            self._entries['endpoint'] = (time.monotonic(), endpoint)
+
+    # Re-reads the endpoint description only, which is all that polling for a state change needs.
+    def refresh_endpoint(self):
+        endpoint = self._fetch_endpoint()
+        self.prime(endpoint)
+        return endpoint
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def endpoint(self):
+        return self._get('endpoint')
+
+    def target_networks(self):
+        return self._get('targetNetworks')
+
+    def routes(self):
+        return self._get('routes')
+
+
+@traced
+def get_association_state(snapshot):
+    return snapshot.endpoint()['Status']['Code']
+
+
+# This function returns True if the endpoint is associated with the target network, vice versa.
+def is_associated(snapshot):
+    state = get_association_state(snapshot)
+    if state == "pending-associate":  # When the subnet is NOT associated
+        return False
+    elif state == "available":  # When the subnet is associated
+        return True
+    # the possibility of an endpoint neither assiciated nor available.(Unexpected state)
+    else:
+        raise Exception("An unexpected state detected.")
+
+
+# The target subnets of the profile, one per availability zone. Older profiles only have SUBNET_ID.
+def profile_subnets(profile):
+    return profile.get('SUBNET_IDS') or [profile['SUBNET_ID']]
+
+
+# Calls function(snapshot, item) for every item concurrently, and raises the first failure once every call is done.
+def run_for_each(function, snapshot, items):
+    with ThreadPoolExecutor(max_workers=max(1, len(items))) as executor:
+        futures = [executor.submit(function, snapshot, item) for item in items]
+    for future in futures:
+        future.result()
+
+
+@traced
+def associate_subnet(snapshot, subnetId) -> None:
+    try:
+        response = snapshot.client.associate_client_vpn_target_network(
+            ClientVpnEndpointId=snapshot.endpointId,
+            SubnetId=subnetId,
+        )
+    except Exception as e:
+        if aws_error_code(e) == 'InvalidClientVpnDuplicateAssociationException':
+            return  # The subnet is associated already, e.g. by an earlier run which failed halfway.
+        raise
+    if response["Status"]["Code"] != 'associating':
+        raise Exception("Unexpected association state detected : {}".format(
+            response['Status']['Code']))
+
+
+# The subnets are associated concurrently, so that an endpoint with a subnet in every AZ turns on as fast as with one.
+def associate_target_networks(snapshot) -> None:
+    try:
+        run_for_each(associate_subnet, snapshot, snapshot.subnetIds)
+    finally:
+        snapshot.invalidate()
+
+
+DEFAULT_ROUTES = ['0.0.0.0/0']  # The CIDR block that allows the traffic in and out of the public internet.
+ROUTE_WORKERS = 8
+
+
+# The routes created when the endpoint is turned on : the ones recorded by "routes sync", or else the default route.
+def profile_routes(profile):
+    return profile.get('ROUTES') or DEFAULT_ROUTES
+
+
+@traced
+def create_route(snapshot, cidr, subnetId) -> None:
+    try:
+        response = snapshot.client.create_client_vpn_route(
+            ClientVpnEndpointId=snapshot.endpointId,
+            DestinationCidrBlock=cidr,
+            TargetVpcSubnetId=subnetId,
+        )
+    except Exception as e:
+        if aws_error_code(e) == 'InvalidClientVpnRouteDuplicate':
+            return
+        raise
+    if response['Status']['Code'] != 'creating':
+        raise Exception("Unexpected state detected after creating the route : {}".format(
+            response['Status']['Code']))
+
+
+@traced
+def delete_route(snapshot, cidr, subnetId) -> None:
+    response = snapshot.client.delete_client_vpn_route(
+        ClientVpnEndpointId=snapshot.endpointId,
+        DestinationCidrBlock=cidr,
+        TargetVpcSubnetId=subnetId,
+    )
+    if response['Status']['Code'] != 'deleting':
+        raise Exception("Unexpected state detected after deleting the route : {}".format(
+            response['Status']['Code']))
+
+
+# Applies the ("create" or "delete", CIDR, subnet id) changes on a thread pool,
+# and returns one row for every change which failed.
+# The snapshot is left for the caller to invalidate, once for all the changes.
+def apply_route_changes(snapshot, changes):
+    operations = {'create': create_route, 'delete': delete_route}
+    failures = []
+    if len(changes) == 0:
+        return failures
+    with ThreadPoolExecutor(max_workers=min(ROUTE_WORKERS, len(changes))) as executor:
+        futures = [(action, cidr, subnetId, executor.submit(operations[action], snapshot, cidr, subnetId))
+                   for action, cidr, subnetId in changes]
+        for action, cidr, subnetId, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                failures.append({'ACTION': action, 'CIDR': cidr, 'SUBNET_ID': subnetId, 'RESULT': f"error: {e}"})
+    return failures
+
+
+# Every route is created once through every target subnet, so that the traffic keeps flowing when one AZ is down.
+def create_routing_rules(snapshot, cidrs=DEFAULT_ROUTES) -> None:
+    changes = [('create', cidr, subnetId) for subnetId in snapshot.subnetIds for cidr in cidrs]
+    try:
+        failures = apply_route_changes(snapshot, changes)
+    finally:
+        snapshot.invalidate()
+    if len(failures) > 0:
+        raise Exception("Failed to create {} of {} route(s), e.g. {} through {} : {}".format(
+            len(failures), len(changes), failures[0]['CIDR'], failures[0]['SUBNET_ID'], failures[0]['RESULT']))
+
+
+# Returns the ids of every association which is not on its way out already.
+def get_current_association_ids(snapshot):
+    associationIds = [x['AssociationId'] for x in snapshot.target_networks()
+                      if x['Status']['Code'] in ('associating', 'associated')]
+    if len(associationIds) > 0:
+        return associationIds
+    else:
+        raise Exception(
+            "No association ID found, probably there is no terget network associated right now.")
+
+
+@traced
+def disassociate_association(snapshot, associationId) -> None:
+    response = snapshot.client.disassociate_client_vpn_target_network(
+        ClientVpnEndpointId=snapshot.endpointId,
+        AssociationId=associationId,
+    )
+    if response['Status']['Code'] != 'disassociating':
+        raise Exception("Unexpected status detected after disassociation : {}".format(
+            response['Status']['Code']))
+
+
+# Every association is removed at once, so that turning off takes as long as one disassociation.
+def disassociate_target_networks(snapshot) -> None:
+    associationIds = get_current_association_ids(snapshot)
+    try:
+        run_for_each(disassociate_association, snapshot, associationIds)
+    finally:
+        snapshot.invalidate()
+
+
+def turn_on(snapshot, cidrs=DEFAULT_ROUTES) -> None:
+    routes = f"the new route({cidrs[0]})" if len(cidrs) == 1 else f"{len(cidrs)} new routes"
+    print(
+        f"Associating the target subnet({', '.join(snapshot.subnetIds)}) and creating {routes}.")
+    print("... ... ...")
+    associate_target_networks(snapshot)
+    print("... ... ...")
+    create_routing_rules(snapshot, cidrs)
+    print("Done.")
+
+
+def toggle(snapshot, cidrs=DEFAULT_ROUTES):
+    if is_associated(snapshot):
+        disassociate(snapshot)
+        return 'pending-associate'
+    else:
+        turn_on(snapshot, cidrs)
+        return 'available'
+
+
+# Blocks until the endpoint reaches the expected state, and reports how long it took.
+@traced
+def wait_for_state(snapshot, expectedState, timeout=WAIT_TIMEOUT) -> None:
+    print(f"Waiting for the endpoint to become \"{expectedState}\"...")
+    _endpoint, elapsed = poll_with_backoff(
+        snapshot.refresh_endpoint,
+        lambda endpoint: endpoint['Status']['Code'] == expectedState,
+        timeout=timeout)
+    print("The endpoint is now \"{}\", after {:.1f} seconds.".format(
+        expectedState, elapsed))
+
+
+def get_status(snapshot) -> None:
+    print("Getting the association state of the client vpn endpoint : \n{}".format(
+        snapshot.endpointId))
+    print("... ... ...")
+    print("Currently, and state of association is : \n{}".format(
+        get_association_state(snapshot)))
+    print("Done.")
+
+
+def disassociate(snapshot) -> None:
+    print(
+        f"Disassociating the target subnet({', '.join(snapshot.subnetIds)})\nfrom the client vpn endpoint({snapshot.endpointId}).")
+    print("... ... ...")
+    disassociate_target_networks(snapshot)
+    print("Done.")
+
+
+# *** THE PROFILE REGISTRY CODE SECTION STARTS ***
+# Every deployment is recorded in a local SQLite registry, indexed by friendly name, region and endpoint id,
+# so that a profile is found with one indexed query instead of globbing and parsing every .ovpnsetup file.
+# The full profile is kept as JSON, in the same format as the .ovpnsetup files.
+
+REGISTRY_PATH = ''  # Left blank, the registry lives under $XDG_CONFIG_HOME (Default: ~/.config).
+
+
+def get_registry_path():
+    if REGISTRY_PATH != '':
+        return Path(REGISTRY_PATH)
+    configDirectory = os.environ.get('XDG_CONFIG_HOME') or Path.home() / '.config'
+    return Path(configDirectory) / 'vpn-toggle-utility' / 'profiles.sqlite3'
+
+
+def open_registry():
+    path = get_registry_path()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    import sqlite3
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS profiles (
+            endpoint_id TEXT PRIMARY KEY,
+            friendly_name TEXT NOT NULL,
+            region TEXT NOT NULL,
+            date_of_creation INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS profiles_by_name ON profiles (friendly_name, date_of_creation);
+        CREATE INDEX IF NOT EXISTS profiles_by_region ON profiles (region, date_of_creation);
+        CREATE INDEX IF NOT EXISTS profiles_by_date ON profiles (date_of_creation);
+        CREATE TABLE IF NOT EXISTS pool (
+            friendly_name TEXT PRIMARY KEY,
+            region TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            pid INTEGER,
+            data TEXT
+        );
+        CREATE INDEX IF NOT EXISTS pool_by_region ON pool (region, status, created_at);
+        CREATE TABLE IF NOT EXISTS pool_sizes (
+            region TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            subnet_count INTEGER NOT NULL
+        );
+    ''')
+    return connection
+
+
+# Records the profiles, keeping the most recent one when an endpoint is already registered.
+def register_profiles(profiles):
+    connection = open_registry()
+    with connection:
+        insert_profiles(connection, profiles)
+    connection.close()
+
+
+def insert_profiles(connection, profiles):
+    connection.executemany('''
+        INSERT INTO profiles (endpoint_id, friendly_name, region, date_of_creation, data)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (endpoint_id) DO UPDATE SET
+            friendly_name = excluded.friendly_name,
+            region = excluded.region,
+            date_of_creation = excluded.date_of_creation,
+            data = excluded.data
+        WHERE excluded.date_of_creation >= profiles.date_of_creation
+    ''', [(profile['ENDPOINT_ID'], profile['FRIENDLY_NAME'], profile['AWS_REGION'],
+           profile['DATE_OF_CREATION'], dumps(profile)) for profile in profiles])
+
+
+def unregister_profile(endpointId):
+    connection = open_registry()
+    with connection:
+        connection.execute(
+            'DELETE FROM profiles WHERE endpoint_id = ?', (endpointId,))
+    connection.close()
+
+
+def query_profiles(condition='', parameters=(), limit=None):
+    connection = open_registry()
+    query = 'SELECT data FROM profiles {} ORDER BY date_of_creation DESC'.format(
+        f'WHERE {condition}' if condition != '' else '')
+    if limit is not None:
+        query += f' LIMIT {int(limit)}'
+    profiles = [loads(row[0])
+                for row in connection.execute(query, parameters)]
+    connection.close()
+    return profiles
+
+
+# Finds the most recent profile with the friendly name, or the profile of the endpoint id.
+def find_profile(name):
+    if name.startswith('cvpn-endpoint-'):
+        profiles = query_profiles('endpoint_id = ?', (name,))
+    else:
+        profiles = query_profiles('friendly_name = ?', (name,), limit=1)
+    if len(profiles) == 0:
+        raise Exception(f"No profile named \"{name}\" found in the registry.")
+    return profiles[0]
+
+
+def load_profile(path):
+    with open(path, 'r') as _f:
+        return loads(_f.read())
+
+
+# The profile to manage is the file given with -f, or the registered one given with -p (by friendly name or endpoint id),
+# or else the most recent one in the registry. The ids hard-coded at the top of this script override all of them.
+# The .ovpnsetup files under the CWD are imported the first time, when the registry is still empty.
+def resolve_profile():
+    profilePath = get_option('-f')
+    profileName = get_option('-p')
+    if profilePath is not None:
+        profile = load_profile(profilePath)
+    elif profileName is not None:
+        profile = find_profile(profileName)
+    elif CLIENT_VPN_ENDPOINT_ID != '' and SUBNET_ID != '':
+        profile = {'AWS_REGION': None, 'FRIENDLY_NAME': ''}
+    else:
+        profiles = query_profiles(limit=1)
+        if len(profiles) == 0 and len(list(Path('.').glob('*.ovpnsetup'))) > 0:
+            import_profiles('.')
+            profiles = query_profiles(limit=1)
+        if len(profiles) == 0:
+            raise Exception(
+                f"No profile found. Please specify one with -f or -p.\n{HELP_SCRIPT}")
+        profile = profiles[0]
+    if CLIENT_VPN_ENDPOINT_ID != '':
+        profile['ENDPOINT_ID'] = CLIENT_VPN_ENDPOINT_ID
+    if SUBNET_ID != '':
+        profile['SUBNET_ID'] = SUBNET_ID
+        profile['SUBNET_IDS'] = [SUBNET_ID]
+    return profile
+
+
+def import_profiles(location):
+    profiles = load_fleet_profiles(location)
+    register_profiles(profiles)
+    return profiles
+
+
+def print_profiles(profiles):
+    print_table(profiles, ['FRIENDLY_NAME', 'AWS_REGION', 'ENDPOINT_ID', 'SUBNET_ID', 'DATE_OF_CREATION'])
+
+
+def manage_registry():
+    subcommand = sys.argv[2] if len(sys.argv) > 2 else ''
+    if subcommand == 'import':
+        location = sys.argv[3] if len(sys.argv) > 3 and not sys.argv[3].startswith('-') else '.'
+        profiles = import_profiles(location)
+        print(f"Imported {len(profiles)} profile(s) into {get_registry_path()}.")
+    elif subcommand == 'list':
+        region = get_option('--region')
+        if region is not None:
+            print_profiles(query_profiles('region = ?', (region,)))
+        else:
+            print_profiles(query_profiles())
+    else:
+        raise Exception(
+            f"Please specify the registry command (import or list).\n{HELP_SCRIPT}")
+
+# *** THE PROFILE REGISTRY CODE SECTION ENDS ***
+
+
+# *** THE FLEET MANAGEMENT CODE SECTION STARTS ***
+# The fleet mode runs status/on/off against many deployments at once, given a directory or a glob of .ovpnsetup profiles.
+# Endpoints are grouped by region so that every region is described with a single API call,
+# and the per-endpoint actions run on a thread pool bounded per region.
+
+FLEET_WORKERS_PER_REGION = 8
+
+
+# This function collects the profiles saved by save_the_setup_results() from a directory or a glob pattern.
+# When several profiles point at the same endpoint, the most recent one is kept.
+def load_fleet_profiles(location):
+    if Path(location).is_dir():
+        paths = sorted(Path(location).glob('*.ovpnsetup'))
+    else:
+        paths = sorted(Path(p) for p in glob(location))
+    profiles = {}
+    for path in paths:
+        if not path.is_file():
+            continue
+        with path.open('r') as _f:
+            profile = loads(_f.read())
+        current = profiles.get(profile['ENDPOINT_ID'])
+        if current is None or current['DATE_OF_CREATION'] < profile['DATE_OF_CREATION']:
+            profiles[profile['ENDPOINT_ID']] = profile
+    if len(profiles) == 0:
+        raise Exception(f"No .ovpnsetup profile found at \"{location}\".")
+    return list(profiles.values())
+
+
+# Returns a mapping from the endpoint ids to their descriptions, with one describe call per page.
+# EC2 rejects the whole call when one of the ids does not exist, so the ids named by the error are left out
+# and the call is made again. The endpoints which do not exist are missing from the mapping.
+def describe_fleet_endpoints(client, endpointIds):
+    import re
+    endpointIds = list(endpointIds)
+    while len(endpointIds) > 0:
+        try:
+            return describe_endpoint_pages(client, endpointIds)
+        except Exception as e:
+            if aws_error_code(e) != 'InvalidClientVpnEndpointId.NotFound':
+                raise
+            message = getattr(e, 'response', {}).get('Error', {}).get('Message', '')
+            missing = set(re.findall(r'cvpn-endpoint-[0-9a-f]+', message)) & set(endpointIds)
+            if len(missing) == 0:
+                # The error does not say which id is missing, so the ids are described one by one.
+                return describe_endpoints_one_by_one(client, endpointIds)
+            endpointIds = [x for x in endpointIds if x not in missing]
+    return {}
+
+
+def describe_endpoint_pages(client, endpointIds):
+    endpoints = {}
+    kwargs = {'ClientVpnEndpointIds': endpointIds}
+    while True:
+        response = client.describe_client_vpn_endpoints(**kwargs)
+        for endpoint in response['ClientVpnEndpoints']:
+            endpoints[endpoint['ClientVpnEndpointId']] = endpoint
+        if not response.get('NextToken'):
+            return endpoints
+        kwargs['NextToken'] = response['NextToken']
+
+
+def describe_endpoints_one_by_one(client, endpointIds):
+    endpoints = {}
+    for endpointId in endpointIds:
+        try:
+            endpoints.update(describe_endpoint_pages(client, [endpointId]))
+        except Exception as e:
+            if aws_error_code(e) != 'InvalidClientVpnEndpointId.NotFound':
+                raise
+    return endpoints
+
+
+def run_fleet_action(command, snapshot, cidrs=DEFAULT_ROUTES):
+    state = get_association_state(snapshot)
+    if command == 'on' and state == 'pending-associate':
+        associate_target_networks(snapshot)
+        create_routing_rules(snapshot, cidrs)
+        return 'associating'
+    elif command == 'off' and state == 'available':
+        disassociate_target_networks(snapshot)
+        return 'disassociating'
+    else:
+        return 'unchanged'
+
+
+def run_fleet_region(command, region, profiles, clientFactory):
+    client = clientFactory(region)
+    endpoints = describe_fleet_endpoints(
+        client, [profile['ENDPOINT_ID'] for profile in profiles])
+    results = []
+    with ThreadPoolExecutor(max_workers=min(FLEET_WORKERS_PER_REGION, len(profiles))) as executor:
+        futures = []
+        for profile in profiles:
+            endpoint = endpoints.get(profile['ENDPOINT_ID'])
+            if endpoint is None:
+                futures.append(None)
+            else:
+                snapshot = EndpointSnapshot(
+                    client, profile['ENDPOINT_ID'], profile_subnets(profile))
+                snapshot.prime(endpoint)
+                futures.append(executor.submit(
+                    run_fleet_action, command, snapshot, profile_routes(profile)))
+        for profile, future in zip(profiles, futures):
+            endpoint = endpoints.get(profile['ENDPOINT_ID'])
+            result = {
+                'FRIENDLY_NAME': profile['FRIENDLY_NAME'],
+                'AWS_REGION': region,
+                'ENDPOINT_ID': profile['ENDPOINT_ID'],
+                'STATE': endpoint['Status']['Code'] if endpoint is not None else 'not-found',
+                'RESULT': '',
+            }
+            if future is not None:
+                try:
+                    result['RESULT'] = future.result()
+                except Exception as e:
+                    result['RESULT'] = f"error: {e}"
+            results.append(result)
+    return results
+
+
+# Runs the command against every profile concurrently, one worker per region, and returns one result row per endpoint.
+def run_fleet(command, profiles, clientFactory=None):
+    if command not in ('status', 'on', 'off'):
+        raise Exception(
+            f"No such fleet command as \"{command}\" is available. Please use status, on or off.")
+    if clientFactory is None:
+        clientFactory = partial(get_client, 'ec2')
+    regions = {}
+    for profile in profiles:
+        regions.setdefault(profile['AWS_REGION'], []).append(profile)
+    results = []
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        futures = [executor.submit(run_fleet_region, command, region, regionProfiles, clientFactory)
+                   for region, regionProfiles in regions.items()]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def print_fleet_table(results):
+    print_table(results, ['FRIENDLY_NAME', 'AWS_REGION', 'ENDPOINT_ID', 'STATE', 'RESULT'])
+
+
+def print_table(results, columns):
+    widths = [max([len(column)] + [len(str(row[column])) for row in results])
+              for column in columns]
+    print('  '.join(column.ljust(width)
+                    for column, width in zip(columns, widths)).rstrip())
+    for row in results:
+        print('  '.join(str(row[column]).ljust(width)
+                        for column, width in zip(columns, widths)).rstrip())
+
+
+def manage_fleet():
+    if len(sys.argv) < 3:
+        raise Exception(
+            f"Please specify the fleet command (status, on, off or destroy).\n{HELP_SCRIPT}")
+    if len(sys.argv) > 3 and not sys.argv[3].startswith('-'):
+        profiles = load_fleet_profiles(sys.argv[3])
+    else:
+        profiles = query_profiles()
+        if len(profiles) == 0:
+            raise Exception(
+                "No profile found in the registry. Please import them with \"registry import\", or specify a directory or a glob.")
+    if sys.argv[2] == 'destroy':
+        destroy_fleet(profiles)
+        return
+    print(
+        f"Running \"{sys.argv[2]}\" against {len(profiles)} endpoint(s)...")
+    print("... ... ...")
+    print_fleet_table(run_fleet(sys.argv[2], profiles))
+    print("Done.")
+
+# *** THE FLEET MANAGEMENT CODE SECTION ENDS ***
+
+
+# *** THE CLIENT ISSUANCE CODE SECTION STARTS ***
+# issue-clients creates one client certificate and one .ovpn file for every user name in a list.
+# The RSA key generation runs on a process pool, and the client configuration is exported once for all the users.
+
+CLIENT_NAME_CHARACTERS = set(string.ascii_letters + string.digits + '._@-')
+_ISSUER = None  # (CA certificate, CA key) loaded once in every worker process.
+
+
+def read_client_names(path):
+    clientNames = []
+    with open(path, 'r') as _f:
+        for line in _f:
+            clientName = line.strip()
+            if clientName == '' or clientName.startswith('#') or clientName in clientNames:
+                continue
+            if not set(clientName) <= CLIENT_NAME_CHARACTERS:
+                raise Exception(
+                    f"The client name \"{clientName}\" may only contain letters, digits and . _ @ -")
+            clientNames.append(clientName)
+    return clientNames
+
+
+def load_issuer(caCertPem, caKeyPem):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import serialization
+    return (x509.load_pem_x509_certificate(caCertPem),
+            serialization.load_pem_private_key(caKeyPem, password=None))
+
+
+def _load_issuer(caCertPem, caKeyPem):
+    global _ISSUER
+    _ISSUER = load_issuer(caCertPem, caKeyPem)
+
+
+def _issue_with_loaded_issuer(clientName):
+    return issue_client_certificate(_ISSUER[0], _ISSUER[1], clientName)
+
+
+# Returns a mapping from the client names to their (certificate, key) PEM pairs.
+def issue_client_certificates(caCertPem, caKeyPem, clientNames, workers=None):
+    # Imported here since it loads multiprocessing, which only this command needs.
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers, initializer=_load_issuer, initargs=(caCertPem, caKeyPem)) as executor:
+        return dict(zip(clientNames, executor.map(_issue_with_loaded_issuer, clientNames, chunksize=8)))
+
+
+def issue_clients():
+    if len(sys.argv) < 3 or sys.argv[2].startswith('-'):
+        raise Exception(
+            f"Please specify the file which lists the client names.\n{HELP_SCRIPT}")
+    profile = resolve_profile()
+    caCertFile = get_option('--ca-cert', profile.get('CA_CERT_FILE'))
+    caKeyFile = get_option('--ca-key', profile.get('CA_KEY_FILE'))
+    if caCertFile is None or caKeyFile is None:
+        raise Exception(
+            "The profile does not record a CA. Please specify it with --ca-cert and --ca-key.")
+    workers = get_option('--workers')
+    outputDirectory = Path(get_option(
+        '--output-dir', f"{profile['FRIENDLY_NAME']}-clients"))
+    clientNames = read_client_names(sys.argv[2])
+
+    print("Exporting the connection profile...")
+    template = ConnectionProfileTemplate(get_client('ec2', profile['AWS_REGION']).export_client_vpn_client_configuration(
+        ClientVpnEndpointId=profile['ENDPOINT_ID']
+    )['ClientConfiguration'])
+    print("Done.\n")
+
+    print(f"Issuing the certificates of {len(clientNames)} client(s)...")
+    startTime = time.monotonic()
+    credentials = issue_client_certificates(
+        Path(caCertFile).read_bytes(), Path(caKeyFile).read_bytes(), clientNames,
+        int(workers) if workers is not None else None)
+    print("Done in {:.1f} seconds.\n".format(time.monotonic() - startTime))
+
+    print(f"Writing the .ovpn files under {outputDirectory}/ ...")
+    outputDirectory.mkdir(parents=True, exist_ok=True)
+    for clientName, (clientCert, clientKey) in credentials.items():
+        write_connection_profile(template, clientKey, clientCert,
+                                 outputDirectory / f"{profile['AWS_REGION']}-{profile['FRIENDLY_NAME']}-{clientName}.ovpn")
+    print("Done.")
+
+# *** THE CLIENT ISSUANCE CODE SECTION ENDS ***
+
+
+# *** THE IDLE AUTO-OFF CODE SECTION STARTS ***
+# idle-off watches the client connections of the endpoints, and disassociates an endpoint once nobody has been
+# connected to it for the idle window, since the association is billed by the hour whether it is used or not.
+# The connection counts over time are kept in a fixed-size ring buffer per endpoint.
+
+IDLE_WINDOW = 30 * 60  # Seconds without any active connection before an endpoint is turned off.
+IDLE_CHECK_INTERVAL = 60
+IDLE_HISTORY_SIZE = 1440  # A day of samples at the default interval.
+
+
+# A ring buffer of (time, connection count) samples, stored in two flat arrays instead of a list of tuples.
+class ConnectionCountHistory:
+
+    def __init__(self, size=IDLE_HISTORY_SIZE):
+        from array import array
+        self.times = array('d', [0]) * size
+        self.counts = array('L', [0]) * size
+        self.size = size
+        self.length = 0
+        self.next = 0
+
+    def append(self, sampleTime, count):
+        self.times[self.next] = sampleTime
+        self.counts[self.next] = count
+        self.next = (self.next + 1) % self.size
+        self.length = min(self.length + 1, self.size)
+
+    # Yields the samples from the oldest to the newest.
+    def __iter__(self):
+        start = (self.next - self.length) % self.size
+        for i in range(self.length):
+            index = (start + i) % self.size
+            yield self.times[index], self.counts[index]
+
+    def summary(self):
+        counts = [count for _time, count in self]
+        if len(counts) == 0:
+            return "no samples"
+        return "{} samples, min {}, avg {:.1f}, max {}".format(
+            len(counts), min(counts), sum(counts) / len(counts), max(counts))
+
+
+# The tracker keeps the active connections of one endpoint, by connection id, up to date from one poll to the next.
+# describe_client_vpn_connections only returns the active connections and the ones terminated within the last hour,
+# so a poll reads a bounded list, in pages of the maximal size, and only the connections which changed are touched.
+class ConnectionTracker:
+
+    def __init__(self, snapshot, region, idleWindow=IDLE_WINDOW, historySize=IDLE_HISTORY_SIZE):
+        self.snapshot = snapshot
+        self.region = region
+        self.idleWindow = idleWindow
+        self.active = {}  # connection id -> the connection description
+        self.lastActiveAt = time.monotonic()
+        self.history = ConnectionCountHistory(historySize)
+
+    # The active connections are rebuilt from the whole listing, since a connection may drop out of it
+    # without ever being listed with a terminated status.
+    def poll(self):
+        kwargs = {'ClientVpnEndpointId': self.snapshot.endpointId, 'MaxResults': 1000}
+        active = {}
+        while True:
+            response = self.snapshot.client.describe_client_vpn_connections(**kwargs)
+            for connection in response['Connections']:
+                if connection['Status']['Code'] == 'active':
+                    active[connection['ConnectionId']] = connection
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+        self.active = active
+        return len(self.active)
+
+    # Returns True when the endpoint has been idle for the whole window and should be turned off.
+    def check(self, state):
+        now = time.monotonic()
+        if state != 'available':
+            # Nothing to watch while the endpoint is off. The window starts over once it is turned on again.
+            self.active.clear()
+            self.lastActiveAt = now
+            self.history.append(time.time(), 0)
+            return False
+        count = self.poll()
+        self.history.append(time.time(), count)
+        if count > 0:
+            self.lastActiveAt = now
+        return now - self.lastActiveAt >= self.idleWindow
+
+    def idle_for(self):
+        return time.monotonic() - self.lastActiveAt
+
+
+def run_idle_check(trackers, clientFactory=None):
+    if clientFactory is None:
+        clientFactory = partial(get_client, 'ec2')
+    regions = {}
+    for tracker in trackers:
+        regions.setdefault(tracker.region, []).append(tracker)
+    for region, regionTrackers in regions.items():
+        # An endpoint which no longer exists is left out of the description, and is reported without
+        # holding up the others. A region which fails for another reason is tried again at the next check.
+        try:
+            endpoints = describe_fleet_endpoints(
+                clientFactory(region), [tracker.snapshot.endpointId for tracker in regionTrackers])
+        except Exception as e:
+            print(f"Failed to describe the endpoints in {region} : {e}", file=sys.stderr)
+            continue
+        for tracker in regionTrackers:
+            endpoint = endpoints.get(tracker.snapshot.endpointId)
+            if endpoint is None:
+                print(f"{tracker.snapshot.endpointId} : not found.", file=sys.stderr)
+                tracker.active.clear()
+                continue
+            tracker.snapshot.prime(endpoint)
+            state = endpoint['Status']['Code']
+            try:
+                isIdle = tracker.check(state)
+                print("{} : {}, {} active connection(s), idle for {:.0f} seconds.".format(
+                    tracker.snapshot.endpointId, state, len(tracker.active), tracker.idle_for() if state == 'available' else 0))
+                if isIdle:
+                    disassociate(tracker.snapshot)
+            except Exception as e:
+                print(f"Failed to check {tracker.snapshot.endpointId} : {e}", file=sys.stderr)
+
+
+def idle_off():
+    if get_option('-f') is not None or get_option('-p') is not None:
+        profiles = [resolve_profile()]
+    elif len(sys.argv) > 2 and not sys.argv[2].startswith('-'):
+        profiles = load_fleet_profiles(sys.argv[2])
+    else:
+        profiles = query_profiles()
+    idleWindow = float(get_option('--idle-minutes', IDLE_WINDOW / 60)) * 60
+    interval = float(get_option('--interval', IDLE_CHECK_INTERVAL))
+    trackers = []
+    for profile in profiles:
+        trackers.append(ConnectionTracker(EndpointSnapshot(get_client('ec2', profile['AWS_REGION']),
+                                                           profile['ENDPOINT_ID'], profile_subnets(profile)),
+                                          profile['AWS_REGION'], idleWindow=idleWindow))
+    print("Watching {} endpoint(s), turning them off after {:.0f} minutes without connections.".format(
+        len(trackers), idleWindow / 60))
+    try:
+        while True:
+            run_idle_check(trackers)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Connection counts:")
+        for tracker in trackers:
+            print(f"    {tracker.snapshot.endpointId} : {tracker.history.summary()}")
+
+# *** THE IDLE AUTO-OFF CODE SECTION ENDS ***
+
+
+# *** THE DAEMON CODE SECTION STARTS ***
+# The daemon keeps one process running for the whole fleet. The boto3 clients stay warm, the state of every endpoint
+# is held in memory and refreshed in the background, and the per-endpoint schedules run on an asyncio event loop.
+# It serves status/on/off/toggle/list over a Unix socket, one JSON object per line in each direction, e.g.
+#     {"command": "status", "endpoint": "my-vpn"}  ->  {"ok": true, "endpoint": "cvpn-endpoint-...", "state": "available", ...}
+# Reads are answered from memory, without calling AWS.
+
+DAEMON_REFRESH_INTERVAL = 30  # Seconds between two background refreshes of the endpoint states.
+DAEMON_SCHEDULE_INTERVAL = 30  # Seconds between two checks of the schedules.
+
+
+def get_daemon_socket_path():
+    return Path(get_option('--socket', get_registry_path().parent / 'daemon.sock'))
+
+
+# A schedule is the daily window in which an endpoint should be on, in local time, e.g. "08:00-20:00" or "22:00-06:00".
+def parse_schedule(window):
+    import datetime
+    try:
+        start, end = [datetime.time.fromisoformat(x.strip())
+                      for x in window.split('-')]
+    except ValueError:
+        raise Exception(
+            f"The schedule \"{window}\" is not valid. Please use the HH:MM-HH:MM format.")
+    return start, end
+
+
+def is_within_schedule(schedule, moment):
+    start, end = schedule
+    if start <= end:
+        return start <= moment < end
+    else:  # The window wraps around midnight.
+        return moment >= start or moment < end
+
+
+# Runs an on, off or toggle in a worker of the daemon, and returns the command run, the state read and the result.
+# The state is read afresh rather than taken from memory, where it may be DAEMON_REFRESH_INTERVAL seconds old,
+# and the direction of a toggle is decided from it.
+def run_daemon_action(command, snapshot, cidrs):
+    state = snapshot.refresh_endpoint()['Status']['Code']
+    if command == 'toggle':
+        command = 'off' if state == 'available' else 'on'
+    return command, state, run_fleet_action(command, snapshot, cidrs)
+
+
+class ToggleDaemon:
+
+    def __init__(self, profiles, schedules=None, clientFactory=None, clock=None):
+        import datetime
+        self.clientFactory = clientFactory or partial(get_client, 'ec2')
+        self.clock = clock or datetime.datetime.now
+        self.endpoints = {}  # endpoint id -> the state kept about the endpoint
+        self.names = {}  # friendly name -> endpoint id
+        for profile in profiles:
+            self.endpoints[profile['ENDPOINT_ID']] = {
+                'profile': profile,
+                'snapshot': EndpointSnapshot(self.clientFactory(profile['AWS_REGION']),
+                                             profile['ENDPOINT_ID'], profile_subnets(profile)),
+                'state': 'unknown',
+                'updatedAt': None,
+                'expectedState': None,  # Set from an on/off until the endpoint reaches the new state.
+                'busy': False,  # Set while an on/off runs in a worker.
+                'actionStartedAt': None,
+                'schedule': None,
+                'wasWithinSchedule': None,
+            }
+            self.names[profile['FRIENDLY_NAME']] = profile['ENDPOINT_ID']
+        for key, window in (schedules or {}).items():
+            entry = self.find(key)
+            entry['schedule'] = parse_schedule(window)
+            entry['window'] = window
+        self.executor = ThreadPoolExecutor(
+            max_workers=FLEET_WORKERS_PER_REGION * max(1, len({profile['AWS_REGION'] for profile in profiles})))
+
+    def find(self, key):
+        if key is None and len(self.endpoints) == 1:
+            return next(iter(self.endpoints.values()))
+        entry = self.endpoints.get(self.names.get(key, key))
+        if entry is None:
+            raise Exception(f"No endpoint named \"{key}\" is managed by the daemon.")
+        return entry
+
+    async def _run(self, function, *args):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    # Describes every endpoint with one call per region, and updates the states kept in memory.
+    # The endpoints which no longer exist are marked not-found, and a region which fails is left as it was,
+    # without holding up the other regions.
+    async def refresh(self):
+        import asyncio
+        regions = {}
+        for endpointId, entry in self.endpoints.items():
+            regions.setdefault(entry['profile']['AWS_REGION'], []).append(endpointId)
+        descriptions = await asyncio.gather(*[
+            self._run(describe_fleet_endpoints, self.clientFactory(region), endpointIds)
+            for region, endpointIds in regions.items()], return_exceptions=True)
+        now = time.monotonic()
+        for (region, endpointIds), endpoints in zip(regions.items(), descriptions):
+            if isinstance(endpoints, Exception):
+                print(f"Failed to refresh the endpoints in {region} : {endpoints}", file=sys.stderr)
+                continue
+            for endpointId in endpointIds:
+                entry = self.endpoints[endpointId]
+                endpoint = endpoints.get(endpointId)
+                if endpoint is None:
+                    entry['state'] = 'not-found'
+                    entry['updatedAt'] = now
+                    entry['expectedState'] = None
+                    entry['actionStartedAt'] = None
+                    continue
+                entry['state'] = endpoint['Status']['Code']
+                entry['updatedAt'] = now
+                entry['snapshot'].prime(endpoint)
+                if entry['state'] == entry['expectedState'] or \
+                        (entry['actionStartedAt'] is not None and now - entry['actionStartedAt'] > WAIT_TIMEOUT):
+                    entry['expectedState'] = None
+                    entry['actionStartedAt'] = None
+
+    # The entry is claimed before the action is handed to a worker, so that a request or a schedule tick
+    # arriving while it runs is refused instead of acting on the endpoint a second time.
+    async def perform(self, entry, command):
+        if entry['busy']:
+            raise Exception("Another action is already running on the endpoint.")
+        if entry['expectedState'] is not None:
+            raise Exception("The endpoint is still changing its state to \"{}\".".format(
+                entry['expectedState']))
+        entry['busy'] = True
+        try:
+            command, state, result = await self._run(
+                run_daemon_action, command, entry['snapshot'], profile_routes(entry['profile']))
+        finally:
+            entry['busy'] = False
+        entry['state'] = state
+        entry['updatedAt'] = time.monotonic()
+        if result != 'unchanged':
+            entry['expectedState'] = 'available' if command == 'on' else 'pending-associate'
+            entry['actionStartedAt'] = time.monotonic()
+        return result
+
+    # An endpoint is turned on when its window opens, and kept off outside of it,
+    # so that it is switched off again if someone turns it on at night. Within the window it is left alone.
+    async def apply_schedules(self):
+        moment = self.clock().time()
+        for endpointId, entry in self.endpoints.items():
+            if entry['schedule'] is None:
+                continue
+            isWithin = is_within_schedule(entry['schedule'], moment)
+            wasWithin = entry['wasWithinSchedule']
+            entry['wasWithinSchedule'] = isWithin
+            if entry['busy'] or entry['expectedState'] is not None:
+                continue
+            try:
+                if not isWithin and entry['state'] == 'available':
+                    print(f"{endpointId} is outside of its schedule, turning it off.")
+                    await self.perform(entry, 'off')
+                elif isWithin and wasWithin is False and entry['state'] == 'pending-associate':
+                    print(f"The schedule of {endpointId} begins, turning it on.")
+                    await self.perform(entry, 'on')
+            except Exception as e:
+                print(f"Failed to apply the schedule of {endpointId} : {e}", file=sys.stderr)
+
+    def describe(self, entry):
+        return {
+            'endpoint': entry['profile']['ENDPOINT_ID'],
+            'name': entry['profile']['FRIENDLY_NAME'],
+            'region': entry['profile']['AWS_REGION'],
+            'state': entry['state'],
+            'expectedState': entry['expectedState'],
+            'age': None if entry['updatedAt'] is None else round(time.monotonic() - entry['updatedAt'], 1),
+            'schedule': entry.get('window'),
+        }
+
+    async def handle_request(self, request):
+        command = request.get('command')
+        if command == 'list':
+            return {'ok': True, 'endpoints': [self.describe(entry) for entry in self.endpoints.values()]}
+        entry = self.find(request.get('endpoint'))
+        if command == 'status':
+            return dict(ok=True, **self.describe(entry))
+        elif command in ('on', 'off', 'toggle'):
+            result = await self.perform(entry, command)
+            return dict(ok=True, result=result, **self.describe(entry))
+        else:
+            raise Exception(f"No such daemon command as \"{command}\" is available.")
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.handle_request(loads(line))
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+                writer.write((dumps(response) + '\n').encode('UTF-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _every(self, interval, function):
+        import asyncio
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await function()
+            except Exception as e:
+                print(f"Errors occured in the background : {e}", file=sys.stderr)
+
+    async def serve(self, socketPath):
+        import asyncio
+        import signal
+        await self.refresh()
+        await self.apply_schedules()
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signalNumber in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signalNumber, stopping.set)
+        server = await asyncio.start_unix_server(self._handle_connection, path=str(socketPath))
+        os.chmod(socketPath, 0o600)
+        tasks = [loop.create_task(self._every(DAEMON_REFRESH_INTERVAL, self.refresh)),
+                 loop.create_task(self._every(DAEMON_SCHEDULE_INTERVAL, self.apply_schedules))]
+        print(f"Serving {len(self.endpoints)} endpoint(s) on {socketPath}.")
+        try:
+            async with server:
+                await stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+            Path(socketPath).unlink(missing_ok=True)
+        print("The daemon stopped.")
+
+
+# Sends one request to the daemon and returns its response.
+def call_daemon(request, socketPath):
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(str(socketPath))
+        connection.sendall((dumps(request) + '\n').encode('UTF-8'))
+        with connection.makefile('r') as _f:
+            return loads(_f.readline())
+
+
+def run_daemon():
+    import asyncio
+    socketPath = get_daemon_socket_path()
+    if socketPath.exists():
+        try:
+            call_daemon({'command': 'list'}, socketPath)
+        except OSError:
+            socketPath.unlink()  # Left behind by a daemon which did not stop cleanly.
+        else:
+            raise Exception(f"A daemon is already serving on {socketPath}.")
+    socketPath.parent.mkdir(parents=True, exist_ok=True)
+    if len(sys.argv) > 2 and not sys.argv[2].startswith('-'):
+        profiles = load_fleet_profiles(sys.argv[2])
+    else:
+        profiles = query_profiles()
+    if len(profiles) == 0:
+        raise Exception("No profile found for the daemon to manage.")
+    schedulesFile = get_option('--schedules')
+    schedules = load_profile(schedulesFile) if schedulesFile is not None else {}
+    asyncio.run(ToggleDaemon(profiles, schedules).serve(socketPath))
+
+
+def control_daemon():
+    if len(sys.argv) < 3:
+        raise Exception(
+            f"Please specify the daemon command (status, on, off, toggle or list).\n{HELP_SCRIPT}")
+    request = {'command': sys.argv[2]}
+    if len(sys.argv) > 3 and not sys.argv[3].startswith('-'):
+        request['endpoint'] = sys.argv[3]
+    response = call_daemon(request, get_daemon_socket_path())
+    print(dumps(response, indent=4))
+    if not response['ok']:
+        sys.exit(1)
+
+# *** THE DAEMON CODE SECTION ENDS ***
+
+
+# *** THE TEARDOWN CODE SECTION STARTS ***
+# A deployment is torn down in three steps : the target networks of its endpoint are disassociated, its stack is deleted,
+# and the two ACM certificates the stack was given are deleted, concurrently, as soon as the endpoint releases them.
+# The stack deletion is followed through the stack events. Besides, the certificates tagged with the friendly name
+# and used by nothing, e.g. those imported by a deployment which failed, are deleted as orphans.
+# The orphans are found with one listing of the tagged certificates and one listing of the certificates per region.
+DESTROY_WORKERS_PER_REGION = 8
+CERTIFICATE_RELEASE_TIMEOUT = 300
+# destroy --orphans leaves alone the certificates imported less than this many seconds ago, since a deployment
+# running elsewhere may not have created its stack yet.
+ORPHAN_MIN_AGE = 3600
+
+
+# Returns a mapping from the friendly names to the ARNs of their tagged certificates which are not in use.
+# With minAge, the certificates imported more recently are not taken as orphans. Those listed without their
+# creation date are taken as old enough.
+def find_orphaned_certificates(region, minAge=0):
+    import datetime
+    tagged = {}  # ARN -> friendly name
+    client = get_client('resourcegroupstaggingapi', region)
+    kwargs = {'TagFilters': [{'Key': 'deploymentFriendlyName'}],
+              'ResourceTypeFilters': ['acm:certificate']}
+    while True:
+        response = client.get_resources(**kwargs)
+        for resource in response['ResourceTagMappingList']:
+            tags = {tag['Key']: tag['Value'] for tag in resource['Tags']}
+            tagged[resource['ResourceARN']] = tags['deploymentFriendlyName']
+        if not response.get('PaginationToken'):
+            break
+        kwargs['PaginationToken'] = response['PaginationToken']
+    kept = set()  # the certificates in use, or too recent
+    client = get_client('acm', region)
+    kwargs = {}
+    now = datetime.datetime.now(datetime.timezone.utc)
+    while True:
+        response = client.list_certificates(**kwargs)
+        # A certificate listed without its InUse flag is taken as in use, to be on the safe side.
+        kept.update(summary['CertificateArn'] for summary in response['CertificateSummaryList']
+                    if summary.get('InUse', True) or
+                    (summary.get('CreatedAt') is not None and (now - summary['CreatedAt']).total_seconds() < minAge))
+        if not response.get('NextToken'):
+            break
+        kwargs['NextToken'] = response['NextToken']
+    orphans = {}
+    for arn, friendlyName in tagged.items():
+        if arn not in kept:
+            orphans.setdefault(friendlyName, []).append(arn)
+    return orphans
+
+
+# Only the target networks are read while waiting, not the whole endpoint snapshot.
+def describe_target_networks(client, endpointId):
+    targetNetworks = []
+    kwargs = {'ClientVpnEndpointId': endpointId}
+    while True:
+        response = client.describe_client_vpn_target_networks(**kwargs)
+        targetNetworks.extend(response['ClientVpnTargetNetworks'])
+        if not response.get('NextToken'):
+            return targetNetworks
+        kwargs['NextToken'] = response['NextToken']
+
+
+@traced
+def disassociate_all_target_networks(client, endpointId):
+    try:
+        targetNetworks = describe_target_networks(client, endpointId)
+    except Exception as e:
+        if aws_error_code(e) == 'InvalidClientVpnEndpointId.NotFound':
+            return  # The endpoint is gone already.
+        raise
+    associationIds = [x['AssociationId'] for x in targetNetworks
+                      if x['Status']['Code'] in ('associating', 'associated')]
+    if len(associationIds) > 0:
+        with ThreadPoolExecutor(max_workers=len(associationIds)) as executor:
+            list(executor.map(lambda associationId: client.disassociate_client_vpn_target_network(
+                ClientVpnEndpointId=endpointId, AssociationId=associationId), associationIds))
+    poll_with_backoff(partial(describe_target_networks, client, endpointId), lambda targetNetworks: all(
+        x['Status']['Code'] == 'disassociated' for x in targetNetworks))
+
+
+# Deletes the stack and returns the ARNs of the certificates it was given, or an empty list when there is no such stack.
+@traced
+def delete_stack(client, stackName):
+    try:
+        stack = client.describe_stacks(StackName=stackName)['Stacks'][0]
+    except Exception as e:
+        if aws_error_code(e) == 'ValidationError':
+            return []  # The stack does not exist, or is deleted already.
+        raise
+    parameters = {x['ParameterKey']: x.get('ParameterValue', '') for x in stack.get('Parameters', [])}
+    tracker = StackEventTracker(client, stack['StackId'])
+    tracker.skip_existing_events()
+    print(f"Deleting the stack {stackName} ...")
+    client.delete_stack(StackName=stack['StackId'])
+    poll_with_backoff(tracker.poll, lambda status: status == 'DELETE_COMPLETE',
+                      initialDelay=2, maxDelay=10)
+    return [parameters[key] for key in ('ServerCertificateArn', 'ClientCertificateArn') if parameters.get(key)]
+
+
+# A certificate stays in use for a little while after its endpoint is deleted, so the deletion is retried until it is released.
+# The orphans are not waited for: one found in use after all is left alone.
+def delete_certificate(client, arn, waitForRelease=True):
+    def attempt():
+        try:
+            client.delete_certificate(CertificateArn=arn)
+        except Exception as e:
+            if aws_error_code(e) == 'ResourceNotFoundException':
+                return 'gone'
+            if aws_error_code(e) != 'ResourceInUseException':
+                raise
+            return 'in-use' if waitForRelease else 'kept'
+        return 'deleted'
+    result, _elapsed = poll_with_backoff(attempt, lambda result: result != 'in-use',
+                                         timeout=CERTIFICATE_RELEASE_TIMEOUT, initialDelay=2, maxDelay=15)
+    return result == 'deleted'
+
+
+# Returns the number of certificates deleted.
+@traced
+def delete_certificates(client, certificates, orphans=()):
+    orphans = [arn for arn in orphans if arn not in certificates]
+    if len(certificates) + len(orphans) == 0:
+        return 0
+    with ThreadPoolExecutor(max_workers=len(certificates) + len(orphans)) as executor:
+        futures = [executor.submit(delete_certificate, client, arn) for arn in certificates]
+        futures += [executor.submit(delete_certificate, client, arn, False) for arn in orphans]
+        return sum(future.result() for future in futures)
+
+
+def destroy_deployment(profile, orphans=()):
+    startTime = time.monotonic()
+    region = profile['AWS_REGION']
+    result = {
+        'FRIENDLY_NAME': profile['FRIENDLY_NAME'],
+        'AWS_REGION': region,
+        'ENDPOINT_ID': profile['ENDPOINT_ID'],
+        'RESULT': 'destroyed',
+        'CERTIFICATES': 0,
+        'DURATION': '',
+    }
+    try:
+        if profile['FRIENDLY_NAME'] == '':
+            raise Exception("The profile has no friendly name, so its stack cannot be found.")
+        disassociate_all_target_networks(
+            get_client('ec2', region), profile['ENDPOINT_ID'])
+        certificates = delete_stack(get_client(
+            'cloudformation', region), f"ovpn-{profile['FRIENDLY_NAME']}")
+        result['CERTIFICATES'] = delete_certificates(
+            get_client('acm', region), certificates, orphans)
+        unregister_profile(profile['ENDPOINT_ID'])
+    except Exception as e:
+        result['RESULT'] = f"error: {e}"
+    result['DURATION'] = "{:.0f} s".format(time.monotonic() - startTime)
+    return result
+
+
+def destroy_region(region, profiles):
+    orphans = find_orphaned_certificates(region)
+    with ThreadPoolExecutor(max_workers=min(DESTROY_WORKERS_PER_REGION, len(profiles))) as executor:
+        futures = [executor.submit(destroy_deployment, profile, orphans.get(profile['FRIENDLY_NAME'], []))
+                   for profile in profiles]
+        return [future.result() for future in futures]
+
+
+# Tears the deployments down concurrently, one worker per region, and returns one result row per deployment.
+def run_destroy(profiles):
+    regions = {}
+    for profile in profiles:
+        regions.setdefault(profile['AWS_REGION'], []).append(profile)
+    results = []
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        futures = [executor.submit(destroy_region, region, regionProfiles)
+                   for region, regionProfiles in regions.items()]
+        for future in futures:
+            results.extend(future.result())
+    return results
+
+
+def confirm_destroy(what, answer):
+    if '--yes' in sys.argv[2:]:
+        return
+    if input(f"This will permanently delete {what}.\nPlease type \"{answer}\" to confirm > ") != answer:
+        print("Abort.")
+        sys.exit(1)
+
+
+def print_destroy_table(results):
+    print_table(results, ['FRIENDLY_NAME', 'AWS_REGION', 'ENDPOINT_ID',
+                          'RESULT', 'CERTIFICATES', 'DURATION'])
+
+
+def destroy_fleet(profiles):
+    print_profiles(profiles)
+    confirm_destroy(f"the {len(profiles)} deployment(s) above", 'destroy')
+    print(f"Destroying {len(profiles)} deployment(s)...")
+    print("... ... ...")
+    startTime = time.monotonic()
+    results = run_destroy(profiles)
+    print_destroy_table(results)
+    print("Done in {:.0f} seconds.".format(time.monotonic() - startTime))
+
+
+# Returns the (friendly name, region) pairs of the deployments which may still need certificates they imported
+# without being in use : the interrupted deployments with a journal under the CWD, and the endpoints of the pool.
+def find_pending_deployments():
+    pending = set()
+    for journalPath in glob(f"*{JOURNAL_SUFFIX}"):
+        try:
+            settings = loads(Path(journalPath).read_text())['settings']
+        except (OSError, ValueError, KeyError) as e:
+            raise Exception(f"The deployment journal \"{journalPath}\" could not be read : {e}")
+        pending.add((settings['friendlyName'], settings['region']))
+    pending.update((entry['friendlyName'], entry['region']) for entry in query_pool())
+    return pending
+
+
+# The orphans of every supported region (or of the one given with --region) are looked for concurrently.
+# The certificates of an interrupted deployment, which resume needs, or of an endpoint of the pool,
+# which may still be warming, are not orphans, nor are the ones imported less than ORPHAN_MIN_AGE seconds ago.
+def destroy_orphans():
+    region = get_option('--region')
+    regions = [region] if region is not None else CLIENT_VPN_REGIONS
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        orphans = dict(zip(regions, executor.map(partial(find_orphaned_certificates, minAge=ORPHAN_MIN_AGE), regions)))
+    pending = find_pending_deployments()
+    orphans = {region: {friendlyName: arns for friendlyName, arns in regionOrphans.items()
+                        if (friendlyName, region) not in pending}
+               for region, regionOrphans in orphans.items()}
+    rows = [{'AWS_REGION': region, 'FRIENDLY_NAME': friendlyName, 'CERTIFICATE_ARN': arn}
+            for region, regionOrphans in orphans.items()
+            for friendlyName, arns in regionOrphans.items() for arn in arns]
+    if len(rows) == 0:
+        print("No orphaned certificate found.")
+        return
+    print_table(rows, ['AWS_REGION', 'FRIENDLY_NAME', 'CERTIFICATE_ARN'])
+    confirm_destroy(f"the {len(rows)} certificate(s) above", 'destroy')
+    with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        counts = executor.map(lambda region: delete_certificates(get_client('acm', region), [],
+                                                                 [arn for arns in orphans[region].values() for arn in arns]),
+                              regions)
+        print(f"Deleted {sum(counts)} certificate(s).")
 
-client_ec2 = None
-client_acm = None
-client_cf = None
 
-'''
-So please leave these values below blank if you want to specify the ids with system environment variables.
-Otherwise, the values specified here would override the environment variables.
-'''
-CLOUDFORMATION_STACK_ID = ""
-CLIENT_VPN_ENDPOINT_ID = ""
-SERVER_CERTIFICATE_ARN = ""
-CLIENT_CERTIFICATE_ARN = ""
-SUBNET_ID = ""
-USER_SETTINGS = {}
-TEMPLATE_CONTENT = ''
-CLIENT_CERT = ''
-CLIENT_KEY = ''
-HELP_SCRIPT = '''
-Usage: ./client-vpn-manager [command] -f [the_config_file]
-The python script to deploy and manage the vpn service based on AWS Client VPN Endpoints.
+def destroy():
+    if '--orphans' in sys.argv[2:]:
+        destroy_orphans()
+        return
+    profile = resolve_profile()
+    if profile['AWS_REGION'] is None:
+        raise Exception(
+            "The region of the deployment is unknown. Please specify its profile with -f or -p.")
+    confirm_destroy(
+        f"the deployment \"{profile['FRIENDLY_NAME']}\" ({profile['ENDPOINT_ID']} in {profile['AWS_REGION']})",
+        profile['FRIENDLY_NAME'])
+    print("Destroying...")
+    startTime = time.monotonic()
+    result = destroy_region(profile['AWS_REGION'], [profile])[0]
+    print_destroy_table([result])
+    if result['RESULT'] != 'destroyed':
+        raise Exception(f"Failed to destroy the deployment : {result['RESULT']}")
+    print("Done in {:.0f} seconds.".format(time.monotonic() - startTime))
 
-NOTE: PLEASE HAVE YOUR AWS CLI SETUP WITH YOUR AWS ACCOUNT BEFORE YOU RUN THIS SCRIPT.
-      THE SCRIPT WILL NOT RUN WITHOUT AN AWS ACCOUNT SETUP WITH THE CLI.
+# *** THE TEARDOWN CODE SECTION ENDS ***
 
-***TO DEPLOY A NEW VPN SERVICE, please run the script without any command or option.***
 
-***TO MANAGE AN EXISTING ENDPOINT, please use the following commands:***
-    status  :   Output the current status of the specified VPN Endpoint.
-    on      :   Turn on the VPN
-    off     :   Turn off the VPN
-    toggle  :   Toggle the VPN
-   *help    :   Output the help 
+# *** THE ROUTE MANAGEMENT CODE SECTION STARTS ***
+# "routes sync" brings the routes of a split tunnel in line with a list of CIDR blocks, which may hold thousands of prefixes.
+# The list is collapsed first, so that overlapping and adjacent prefixes become one route, and the existing routes are
+# read in pages of a thousand. Only the difference is applied, with the create and delete calls running concurrently.
+# The list is recorded in the profile as ROUTES, and those routes replace 0.0.0.0/0 whenever the endpoint is turned on,
+# since the routes through a subnet are deleted along with its association.
 
-    -f [Filename] (Optional)
-    You can use the optional -f flag to specify the file which contains the profile of a specific VPN deployment.
-    Thus you can have multiple deployments active at the same time, and manage each of them with its profile.
-    If the file is not speficied, the program will automatically look for one under the current working directory.
-    If multiple profiles are found under the CWD, should the most recent one be used.
-'''
 
-# *** THE MANAGEMENT CODE SECTION STARTS ***
+# Reads one CIDR block per line. Blank lines and the text following a "#" are ignored.
+def read_cidr_file(path):
+    import ipaddress
+    networks = []
+    with open(path, 'r') as _f:
+        for number, line in enumerate(_f, 1):
+            line = line.split('#', 1)[0].strip()
+            if line == '':
+                continue
+            try:
+                network = ipaddress.ip_network(line, strict=False)
+            except ValueError:
+                raise Exception(f"{path}:{number} : \"{line}\" is not a valid CIDR block.")
+            if network.version != 4:
+                raise Exception(f"{path}:{number} : \"{line}\" is not an IPv4 CIDR block, which Client VPN routes require.")
+            networks.append(network)
+    if len(networks) == 0:
+        raise Exception(f"No CIDR block found in {path}.")
+    return networks
 
 
-def get_association_state():
-    response = client_ec2.describe_client_vpn_endpoints(
-        ClientVpnEndpointIds=[
-            CLIENT_VPN_ENDPOINT_ID,
-        ]
-    )
-    if len(response['ClientVpnEndpoints']) > 0:
-        return response['ClientVpnEndpoints'][0]['Status']['Code']
+# Merges the overlapping and adjacent networks, e.g. 10.0.0.0/25 and 10.0.0.128/25 into 10.0.0.0/24.
+def collapse_cidrs(networks):
+    import ipaddress
+    return [str(network) for network in ipaddress.collapse_addresses(networks)]
+
+
+# Returns the (CIDR, subnet id) routes to create and the ones to delete, every CIDR block being routed through every
+# target subnet. Only the routes added through the subnets of the profile are considered, so the local routes created
+# along with the associations are left alone.
+def diff_routes(snapshot, cidrs):
+    import ipaddress
+    existing = set()
+    for route in snapshot.routes():
+        if route.get('Origin') == 'add-route' and route.get('TargetSubnet') in snapshot.subnetIds:
+            existing.add((str(ipaddress.ip_network(route['DestinationCidr'], strict=False)), route['TargetSubnet']))
+    desired = {(cidr, subnetId) for subnetId in snapshot.subnetIds for cidr in cidrs}
+
+    def order(route):
+        return ipaddress.ip_network(route[0]), route[1]
+    return sorted(desired - existing, key=order), sorted(existing - desired, key=order)
+
+
+# The extra routes are deleted only once every missing one is created,
+# so that replacing prefixes with their aggregate never leaves a gap in the tunnel.
+def sync_routes(snapshot, cidrs):
+    toCreate, toDelete = diff_routes(snapshot, cidrs)
+    try:
+        failures = apply_route_changes(snapshot, [('create', cidr, subnetId) for cidr, subnetId in toCreate])
+        if len(failures) == 0:
+            failures = apply_route_changes(snapshot, [('delete', cidr, subnetId) for cidr, subnetId in toDelete])
+        else:
+            failures += [{'ACTION': 'delete', 'CIDR': cidr, 'SUBNET_ID': subnetId, 'RESULT': 'skipped'}
+                         for cidr, subnetId in toDelete]
+    finally:
+        snapshot.invalidate()
+    return toCreate, toDelete, failures
+
+
+# Records the routes in the profile file given with -f, or in the registry.
+def save_profile_routes(profile, cidrs):
+    profile['ROUTES'] = cidrs
+    profilePath = get_option('-f')
+    if profilePath is not None:
+        # The profile holds no key, so it keeps the mode it was created with.
+        write_file_atomically(profilePath, [dumps(profile)], suffix='.ovpnsetup.tmp',
+                              mode=os.stat(profilePath).st_mode & 0o777)
+    if 'DATE_OF_CREATION' in profile:
+        register_profiles([profile])
     else:
-        raise Exception("No existing client vpn endpoint found.")
+        print("The profile comes from the ids hard-coded in the script, so the routes could not be recorded.")
 
 
-# This function returns True if the endpoint is associated with the target network, vice versa.
-def is_associated():
-    state = get_association_state()
-    if state == "pending-associate":  # When the subnet is NOT associated
-        return False
-    elif state == "available":  # When the subnet is associated
-        return True
-    # the possibility of an endpoint neither assiciated nor available.(Unexpected state)
+def print_routes(snapshot):
+    rows = [{
+        'DESTINATION_CIDR': route['DestinationCidr'],
+        'TARGET_SUBNET': route.get('TargetSubnet', ''),
+        'ORIGIN': route.get('Origin', ''),
+        'STATUS': route.get('Status', {}).get('Code', ''),
+    } for route in snapshot.routes()]
+    print_table(rows, ['DESTINATION_CIDR', 'TARGET_SUBNET', 'ORIGIN', 'STATUS'])
+
+
+def manage_routes():
+    subcommand = sys.argv[2] if len(sys.argv) > 2 else ''
+    if subcommand not in ('list', 'sync'):
+        raise Exception(
+            f"Please specify the routes command (list or sync).\n{HELP_SCRIPT}")
+    profile = resolve_profile()
+    snapshot = EndpointSnapshot(get_client(
+        'ec2', profile['AWS_REGION']), profile['ENDPOINT_ID'], profile_subnets(profile))
+    if subcommand == 'list':
+        print_routes(snapshot)
+        return
+    if len(sys.argv) < 4 or sys.argv[3].startswith('-'):
+        raise Exception(
+            f"Please specify the file listing the CIDR blocks to route.\n{HELP_SCRIPT}")
+    isDryRun = '--dry-run' in sys.argv[3:]
+    networks = read_cidr_file(sys.argv[3])
+    cidrs = collapse_cidrs(networks)
+    print(f"{len(networks)} CIDR block(s) collapsed into {len(cidrs)} route(s).")
+    if get_association_state(snapshot) != 'available':
+        print("The endpoint is off, so its routes will be created the next time it is turned on.")
     else:
-        raise Exception("An unexpected state detected.")
+        print(f"Syncing the routes through the target subnet({', '.join(snapshot.subnetIds)}) ...")
+        print("... ... ...")
+        if isDryRun:
+            toCreate, toDelete = diff_routes(snapshot, cidrs)
+            failures = []
+            print_table([{'ACTION': 'create', 'CIDR': cidr, 'SUBNET_ID': subnetId} for cidr, subnetId in toCreate] +
+                        [{'ACTION': 'delete', 'CIDR': cidr, 'SUBNET_ID': subnetId} for cidr, subnetId in toDelete],
+                        ['ACTION', 'CIDR', 'SUBNET_ID'])
+        else:
+            toCreate, toDelete, failures = sync_routes(snapshot, cidrs)
+        print("{} route(s) to create, {} to delete, {} unchanged.".format(
+            len(toCreate), len(toDelete), len(cidrs) * len(snapshot.subnetIds) - len(toCreate)))
+        if len(failures) > 0:
+            print_table(failures, ['ACTION', 'CIDR', 'SUBNET_ID', 'RESULT'])
+            raise Exception(f"Failed to apply {len(failures)} route change(s).")
+    if not isDryRun:
+        save_profile_routes(profile, cidrs)
+    print("Done.")
 
+# *** THE ROUTE MANAGEMENT CODE SECTION ENDS ***
 
-def associate_target_network() -> None:
-    response = client_ec2.associate_client_vpn_target_network(
-        ClientVpnEndpointId=CLIENT_VPN_ENDPOINT_ID,
-        SubnetId=SUBNET_ID,
-    )
-    if response["Status"]["Code"] != 'associating':
-        raise Exception("Unexpected association state detected : {}".format(
-            response['Status']['Code']))
 
+# *** THE WARM POOL CODE SECTION STARTS ***
+# The pool keeps a number of endpoints per region deployed ahead of time, and left in the pending-associate state,
+# where they cost little. "pool claim" hands out the oldest warm endpoint of the pool : it associates the endpoint and
+# issues a client profile, so that the time to a working VPN is the time of the association instead of the deployment.
+# The pool is then refilled by a detached "pool fill" process.
+# The pool lives in the registry database, where every pooled endpoint is a row which is "warming" while it is deployed
+# by the process recorded in the row, and "ready" once it is done. A claimed endpoint leaves the pool and is registered
+# as a profile in the same transaction. The pooled deployments keep their journals and CAs under the pool directory.
 
-def create_internet_routing_rule() -> None:
-    response = client_ec2.create_client_vpn_route(
-        ClientVpnEndpointId=CLIENT_VPN_ENDPOINT_ID,
-        # The CIDR block that allows the traffic in and out of the public internet.
-        DestinationCidrBlock='0.0.0.0/0',
-        TargetVpcSubnetId=SUBNET_ID,
-    )
-    if response['Status']['Code'] != 'creating':
-        raise Exception("Unexpected state detected after creating the route : {}".format(
-            response['Status']['Code']))
+POOL_FILL_WORKERS = 4
 
 
-def get_current_association_id():
-    response = client_ec2.describe_client_vpn_target_networks(
-        ClientVpnEndpointId=CLIENT_VPN_ENDPOINT_ID
-    )
-    if len(response['ClientVpnTargetNetworks']) > 0:
-        return response['ClientVpnTargetNetworks'][0]['AssociationId']
+def get_pool_directory():
+    return get_registry_path().parent / 'pool'
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # The process exists, but belongs to someone else.
+    return True
+
+
+# Returns a mapping from the regions to their (size, number of subnets) targets.
+def get_pool_sizes():
+    connection = open_registry()
+    sizes = {region: (size, subnetCount) for region, size, subnetCount in connection.execute(
+        'SELECT region, size, subnet_count FROM pool_sizes')}
+    connection.close()
+    return sizes
+
+
+def set_pool_size(region, size, subnetCount):
+    connection = open_registry()
+    with connection:
+        connection.execute('''
+            INSERT INTO pool_sizes (region, size, subnet_count) VALUES (?, ?, ?)
+            ON CONFLICT (region) DO UPDATE SET size = excluded.size, subnet_count = excluded.subnet_count
+        ''', (region, size, subnetCount))
+    connection.close()
+
+
+def query_pool(region=None):
+    connection = open_registry()
+    query = 'SELECT friendly_name, region, status, created_at, pid, data FROM pool {} ORDER BY region, created_at'.format(
+        'WHERE region = ?' if region is not None else '')
+    entries = [{'friendlyName': name, 'region': entryRegion, 'status': status, 'createdAt': createdAt, 'pid': pid,
+                'profile': loads(data) if data is not None else None}
+               for name, entryRegion, status, createdAt, pid, data in
+               connection.execute(query, (region,) if region is not None else ())]
+    connection.close()
+    return entries
+
+
+# Runs the function with a connection to the registry inside a write transaction, which is taken at once,
+# so that two processes changing the pool never both read it before one of them writes.
+def in_pool_transaction(function, *args):
+    connection = open_registry()
+    connection.isolation_level = None
+    try:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = function(connection, *args)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+    finally:
+        connection.close()
+
+
+# Takes over the deployments left by a process which is gone, reserves new rows up to the size of the pool, and takes
+# the ready endpoints beyond the size out of the pool. Returns the names to deploy and the profiles to destroy.
+def _reserve_pool_entries(connection, region, size):
+    rows = connection.execute(
+        'SELECT friendly_name, status, pid, data FROM pool WHERE region = ? ORDER BY created_at', (region,)).fetchall()
+    abandoned = [name for name, status, pid, _data in rows
+                 if status == 'warming' and (pid is None or not is_process_alive(pid))]
+    newNames = ['pool-' + ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits)
+                                  for _ in range(8)) for _ in range(size - len(rows))]
+    now = int(time.time())
+    connection.executemany('''
+        INSERT INTO pool (friendly_name, region, status, created_at, pid) VALUES (?, ?, 'warming', ?, ?)
+        ON CONFLICT (friendly_name) DO UPDATE SET pid = excluded.pid
+    ''', [(name, region, now, os.getpid()) for name in abandoned + newNames])
+    # The newest ready endpoints go first, since the oldest are the next to be claimed.
+    surplus = [(name, loads(data)) for name, status, _pid, data in reversed(rows)
+               if status == 'ready'][:max(0, len(rows) - size)]
+    connection.executemany('DELETE FROM pool WHERE friendly_name = ?', [(name,) for name, _profile in surplus])
+    return abandoned + newNames, [profile for _name, profile in surplus]
+
+
+def save_pool_entry(deployment):
+    profile = collect_setup_results(deployment)
+    connection = open_registry()
+    with connection:
+        connection.execute("UPDATE pool SET status = 'ready', pid = NULL, data = ? WHERE friendly_name = ?",
+                           (dumps(profile), deployment.friendlyName))
+    connection.close()
+
+
+# Deploys one pooled endpoint, resuming its journal when an earlier process left one behind.
+# On failure the row is released, so that the next fill takes the deployment over.
+def deploy_pool_entry(name, region, subnetCount):
+    result = {'FRIENDLY_NAME': name, 'AWS_REGION': region, 'ENDPOINT_ID': '', 'RESULT': 'ready', 'DURATION': ''}
+    startTime = time.monotonic()
+    journalPath = DeployJournal.path_for(name)
+    if journalPath.exists():
+        deployment = DeployJournal.load(journalPath)
     else:
-        raise Exception(
-            "No association ID found, probably there is no terget network associated right now.")
+        deployment = Deployment({'friendlyName': name, 'isSplitTunneled': False, 'region': region,
+                                 'subnetCount': subnetCount, 'pooled': True}, 'builtin')
+    try:
+        run_deployment(deployment, build_deploy_pipeline(deployment))
+        result['ENDPOINT_ID'] = deployment.endpointId
+    except Exception as e:
+        connection = open_registry()
+        with connection:
+            connection.execute('UPDATE pool SET pid = NULL WHERE friendly_name = ?', (name,))
+        connection.close()
+        result['RESULT'] = f"error: {e}"
+    result['DURATION'] = "{:.0f} s".format(time.monotonic() - startTime)
+    return result
 
 
-def disassociate_target_network() -> None:
-    associationId = get_current_association_id()
-    response = client_ec2.response = client_ec2.disassociate_client_vpn_target_network(
-        ClientVpnEndpointId=CLIENT_VPN_ENDPOINT_ID,
-        AssociationId=associationId,
-    )
-    if response['Status']['Code'] != 'disassociating':
-        raise Exception("Unexpected status detected after disassociation : {}".format(
-            response['Status']['Code']))
+# Brings the pool of the region to its size, and returns one result row per endpoint deployed or destroyed.
+# It runs under the pool directory, where the deployments write their files.
+def refill_pool(region):
+    size, subnetCount = get_pool_sizes().get(region, (0, 1))
+    names, surplus = in_pool_transaction(_reserve_pool_entries, region, size)
+    results = []
+    if len(surplus) > 0:
+        print(f"Destroying {len(surplus)} endpoint(s) beyond the size of the pool...")
+        for profile, result in zip(surplus, destroy_region(region, surplus)):
+            if result['RESULT'] == 'destroyed':
+                for key in ('CA_CERT_FILE', 'CA_KEY_FILE'):
+                    Path(profile[key]).unlink(missing_ok=True)
+            results.append(result)
+    if len(names) > 0:
+        print(f"Deploying {len(names)} endpoint(s) into the pool of {region}...")
+        with ThreadPoolExecutor(max_workers=min(POOL_FILL_WORKERS, len(names))) as executor:
+            results.extend(executor.map(partial(deploy_pool_entry, region=region, subnetCount=subnetCount), names))
+    return results
 
 
-def turn_on() -> None:
-    print(
-        f"Associating the target subnet({SUBNET_ID}) and creating the new route(0.0.0.0/0).")
-    print("... ... ...")
-    associate_target_network()
-    print("... ... ...")
-    create_internet_routing_rule()
-    print("Done.")
+# Moves to the pool directory, with a copy of the cloudformation template from the CWD or from next to the script.
+def enter_pool_directory():
+    directory = get_pool_directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    for template in (Path('cloudformation-template'), Path(__file__).resolve().parent / 'cloudformation-template'):
+        if template.exists():
+            (directory / 'cloudformation-template').write_text(template.read_text())
+            break
+    os.chdir(directory)
 
 
-def get_status() -> None:
-    print("Getting the association state of the client vpn endpoint : \n{}".format(
-        CLIENT_VPN_ENDPOINT_ID))
-    print("... ... ...")
-    print("Currently, and state of association is : \n{}".format(
-        get_association_state()))
-    print("Done.")
+# The refill runs in a detached process, which outlives the claim and logs under the pool directory.
+def start_pool_refill(region):
+    import subprocess
+    directory = get_pool_directory()
+    directory.mkdir(parents=True, exist_ok=True)
+    with open(directory / f"refill-{region}.log", 'ab') as log:
+        subprocess.Popen([sys.executable, str(Path(__file__).resolve()), 'pool', 'fill', '--region', region],
+                         cwd=directory, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
 
 
-def disassociate() -> None:
-    print(
-        f"Disassociating the target subnet({SUBNET_ID})\nfrom the client vpn endpoint({CLIENT_VPN_ENDPOINT_ID}).")
-    print("... ... ...")
-    disassociate_target_network()
-    print("Done.")
+def _claim_pool_entry(connection, region):
+    query = "SELECT friendly_name, data FROM pool WHERE status = 'ready' {} ORDER BY created_at LIMIT 1".format(
+        'AND region = ?' if region is not None else '')
+    row = connection.execute(query, (region,) if region is not None else ()).fetchone()
+    if row is None:
+        return None
+    profile = loads(row[1])
+    profile['DATE_OF_CREATION'] = int(time.time())
+    connection.execute('DELETE FROM pool WHERE friendly_name = ?', (row[0],))
+    insert_profiles(connection, [profile])
+    return profile
+
+
+# Associates the claimed endpoint while its client configuration is exported and the client certificate is issued.
+def claim_from_pool():
+    region = get_option('--region')
+    clientName = get_option('--name', 'client')
+    if not set(clientName) <= CLIENT_NAME_CHARACTERS:
+        raise Exception(
+            f"The client name \"{clientName}\" may only contain letters, digits and . _ @ -")
+    outputDirectory = Path(get_option('--output-dir', '.'))
+    startTime = time.monotonic()
+    profile = in_pool_transaction(_claim_pool_entry, region)
+    if profile is None:
+        raise Exception("No warm endpoint is left in the pool{}. Please fill it with \"pool fill\".".format(
+            f" of {region}" if region is not None else ''))
+    region = profile['AWS_REGION']
+    print(f"Claimed the endpoint {profile['ENDPOINT_ID']} ({profile['FRIENDLY_NAME']}) in {region}.")
+    if '--no-refill' not in sys.argv[2:]:
+        start_pool_refill(region)
+        print(f"The pool is being refilled in the background, see {get_pool_directory() / f'refill-{region}.log'}")
+    client = get_client('ec2', region)
+    snapshot = EndpointSnapshot(client, profile['ENDPOINT_ID'], profile_subnets(profile))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        association = executor.submit(turn_on, snapshot, profile_routes(profile))
+        configuration = executor.submit(lambda: client.export_client_vpn_client_configuration(
+            ClientVpnEndpointId=profile['ENDPOINT_ID'])['ClientConfiguration'])
+        caCert, caKey = load_issuer(Path(profile['CA_CERT_FILE']).read_bytes(),
+                                    Path(profile['CA_KEY_FILE']).read_bytes())
+        clientCert, clientKey = issue_client_certificate(caCert, caKey, clientName)
+        template = ConnectionProfileTemplate(configuration.result())
+        association.result()
+    outputDirectory.mkdir(parents=True, exist_ok=True)
+    fileName = outputDirectory / f"{region}-{profile['FRIENDLY_NAME']}-{clientName}.ovpn"
+    write_connection_profile(template, clientKey, clientCert, fileName)
+    print(f"Your .ovpn file is: {fileName}")
+    if '--wait' in sys.argv[2:]:
+        wait_for_state(snapshot, 'available')
+    print("Claimed in {:.1f} seconds. The endpoint is registered as \"{}\".".format(
+        time.monotonic() - startTime, profile['FRIENDLY_NAME']))
+
+
+def fill_pool():
+    region = get_option('--region')
+    if region not in CLIENT_VPN_REGIONS:
+        raise Exception(
+            f"Please specify the region of the pool with --region, among {', '.join(CLIENT_VPN_REGIONS)}.")
+    sizes = get_pool_sizes()
+    if len(sys.argv) > 3 and not sys.argv[3].startswith('-'):
+        if not sys.argv[3].isdigit():
+            raise Exception(f"The size of the pool must be a number, not \"{sys.argv[3]}\".")
+        previousSubnetCount = sizes.get(region, (0, 1))[1]
+        set_pool_size(region, int(sys.argv[3]),
+                      parse_subnet_count(get_option('--subnets', previousSubnetCount)))
+    elif region not in sizes:
+        raise Exception(
+            f"The pool of {region} has no size yet. Please specify it, e.g. \"pool fill 3 --region {region}\".")
+    startTime = time.monotonic()
+    enter_pool_directory()
+    results = refill_pool(region)
+    if len(results) == 0:
+        print(f"The pool of {region} is full already.")
+    else:
+        print("... ... ...")
+        print_table(results, ['FRIENDLY_NAME', 'AWS_REGION', 'ENDPOINT_ID', 'RESULT', 'DURATION'])
+    print("Done in {:.0f} seconds.".format(time.monotonic() - startTime))
+    if any(row['RESULT'] not in ('ready', 'destroyed') for row in results):
+        raise Exception("The pool could not be filled completely. The next fill takes the failed deployments over.")
+
+
+def print_pool_status():
+    sizes = get_pool_sizes()
+    entries = query_pool()
+    now = int(time.time())
+    rows = []
+    for entry in entries:
+        status = entry['status']
+        if status == 'warming' and (entry['pid'] is None or not is_process_alive(entry['pid'])):
+            status = 'abandoned'
+        rows.append({
+            'FRIENDLY_NAME': entry['friendlyName'],
+            'AWS_REGION': entry['region'],
+            'STATUS': status,
+            'ENDPOINT_ID': entry['profile']['ENDPOINT_ID'] if entry['profile'] is not None else '',
+            'AGE': "{:.0f} min".format((now - entry['createdAt']) / 60),
+        })
+    print_table(rows, ['FRIENDLY_NAME', 'AWS_REGION', 'STATUS', 'ENDPOINT_ID', 'AGE'])
+    for region, (size, subnetCount) in sorted(sizes.items()):
+        ready = sum(1 for row in rows if row['AWS_REGION'] == region and row['STATUS'] == 'ready')
+        print(f"{region} : {ready} of {size} ready, with {subnetCount} subnet(s) each.")
+
+
+def manage_pool():
+    subcommand = sys.argv[2] if len(sys.argv) > 2 else ''
+    if subcommand == 'fill':
+        fill_pool()
+    elif subcommand == 'claim':
+        claim_from_pool()
+    elif subcommand == 'status':
+        print_pool_status()
+    else:
+        raise Exception(
+            f"Please specify the pool command (fill, claim or status).\n{HELP_SCRIPT}")
+
+# *** THE WARM POOL CODE SECTION ENDS ***
 
 
 def manage():
@@ -153,12 +2382,45 @@ def manage():
     global CLIENT_VPN_ENDPOINT_ID
     global SUBNET_ID
     commandInput = sys.argv[1]
+    if commandInput in ("status", "on", "off", "toggle"):
+        profile = resolve_profile()
+        snapshot = EndpointSnapshot(get_client(
+            'ec2', profile['AWS_REGION']), profile['ENDPOINT_ID'], profile_subnets(profile))
+    isWaiting = '--wait' in sys.argv[2:]
     if commandInput == "status":
-        get_status()
+        get_status(snapshot)
     elif commandInput == "off":
-        disassociate()
+        disassociate(snapshot)
+        if isWaiting:
+            wait_for_state(snapshot, 'pending-associate')
     elif commandInput == "on":
-        turn_on()
+        turn_on(snapshot, profile_routes(profile))
+        if isWaiting:
+            wait_for_state(snapshot, 'available')
+    elif commandInput == "toggle":
+        expectedState = toggle(snapshot, profile_routes(profile))
+        if isWaiting:
+            wait_for_state(snapshot, expectedState)
+    elif commandInput == "fleet":
+        manage_fleet()
+    elif commandInput == "issue-clients":
+        issue_clients()
+    elif commandInput == "registry":
+        manage_registry()
+    elif commandInput == "idle-off":
+        idle_off()
+    elif commandInput == "daemon":
+        run_daemon()
+    elif commandInput == "ctl":
+        control_daemon()
+    elif commandInput == "resume":
+        resume_deploy()
+    elif commandInput == "destroy":
+        destroy()
+    elif commandInput == "routes":
+        manage_routes()
+    elif commandInput == "pool":
+        manage_pool()
     elif commandInput == "help":
         print(HELP_SCRIPT)
     else:
@@ -168,11 +2430,139 @@ def manage():
 # *** THE MANAGEMENT CODE SECTION ENDS ***
 # *** THE DEPLOYMENT CODE SECTION STARTS ***
 
+# The regions which support Client VPN Endpoints, in the order they are offered to the user.
+CLIENT_VPN_REGIONS = [
+    "us-east-1",
+    "us-east-2",
+    "us-west-1",
+    "us-west-2",
+    "ap-south-1",
+    "ap-northeast-2",
+    "ap-southeast-1",
+    "ap-southeast-2",
+    "ap-northeast-1",
+    "ca-central-1",
+    "eu-central-1",
+    "eu-west-1",
+    "eu-west-2",
+    "eu-north-1"
+]
+
+
+# The state of one deployment, handed to every stage of its pipeline, so that several deployments can run side by side.
+# The settings are the ones gathered by get_user_settings() : friendlyName, isSplitTunneled and region,
+# plus subnetCount, the number of target subnets (Default: 1), from --subnets or the spec,
+# and pooled, set for the deployments which fill the warm pool.
+# The credentials are PEM bytes under caCert, caKey, serverCert, serverKey, clientCert and clientKey,
+# plus extraClients, which maps the names of the additional clients to their (certificate, key) pairs.
+class Deployment:
+
+    def __init__(self, settings, pkiBackend=None, extraClientNames=()):
+        self.settings = settings
+        self.friendlyName = settings['friendlyName']
+        self.region = settings['region']
+        self.pkiBackend = pkiBackend or PKI_BACKEND or default_pki_backend()
+        self.extraClientNames = list(extraClientNames)
+        self.credentials = {}
+        self.templateContent = ''
+        self.serverCertificateArn = ''
+        self.clientCertificateArn = ''
+        self.stackId = ''
+        self.endpointId = ''
+        self.subnetIds = []
+        self.journal = None
+        self.isResumed = False  # Set when the deployment is loaded from its journal.
+
+    def checkpoint(self):
+        if self.journal is not None:
+            self.journal.save(self)
+
+
+# Every deployment keeps a journal of the stages it has finished under the CWD, next to the other files it creates,
+# so that an interrupted deployment can be picked up by the resume command instead of starting over with a new PKI.
+# Besides the finished stages, the journal holds the settings, the credentials, the certificate ARNs and the stack id.
+# The credentials include private keys, which is the price of resuming without a new PKI : the file is readable by
+# the user only, and the server key is dropped from it once the server certificate is imported,
+# except for the deployments sharing a PKI, whose journal is where the others of the group get the PKI from.
+# It is rewritten atomically after every stage and as soon as the stack is created, and removed once the deployment is done.
+# The template stage is never recorded : reading the template is cheap, and its content is not kept in the journal.
+JOURNAL_SUFFIX = '.deploy-journal.json'
+UNJOURNALED_STAGES = ('template',)
+
+
+class DeployJournal:
+
+    def __init__(self, path, completedStages=()):
+        self.path = Path(path)
+        self.completedStages = list(completedStages)
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def path_for(friendlyName):
+        return Path(f"{friendlyName}{JOURNAL_SUFFIX}").resolve()
+
+    def save(self, deployment):
+        with self._lock:
+            # The server key is only needed to import the server certificate, so it is not kept any longer on disk,
+            # unless the deployment shares its PKI with other deployments of a spec, which may be seeded from the journal.
+            droppedKeys = {'extraClients'}
+            if 'server-certificate' in self.completedStages and deployment.settings.get('pki') is None:
+                droppedKeys.add('serverKey')
+            data = {
+                'settings': deployment.settings,
+                'pkiBackend': deployment.pkiBackend,
+                'extraClientNames': deployment.extraClientNames,
+                'completedStages': self.completedStages,
+                'credentials': {key: value.decode('UTF-8') for key, value in deployment.credentials.items()
+                                if key not in droppedKeys},
+                'extraClients': {name: [cert.decode('UTF-8'), key.decode('UTF-8')]
+                                 for name, (cert, key) in deployment.credentials.get('extraClients', {}).items()},
+                'serverCertificateArn': deployment.serverCertificateArn,
+                'clientCertificateArn': deployment.clientCertificateArn,
+                'stackId': deployment.stackId,
+                'endpointId': deployment.endpointId,
+                'subnetIds': deployment.subnetIds,
+            }
+            # The journal is kept readable by the user only, since it holds private keys.
+            write_file_atomically(self.path, [dumps(data, indent=4)], suffix='.json.tmp')
+
+    def complete(self, deployment, stage):
+        if stage in UNJOURNALED_STAGES:
+            return
+        with self._lock:
+            self.completedStages.append(stage)
+            self.save(deployment)
+
+    def remove(self):
+        with self._lock:
+            self.path.unlink()
+
+    @classmethod
+    def load(cls, path):
+        data = loads(Path(path).read_text())
+        deployment = Deployment(
+            data['settings'], data['pkiBackend'], data['extraClientNames'])
+        deployment.credentials = {key: value.encode('UTF-8')
+                                  for key, value in data['credentials'].items()}
+        if len(deployment.credentials) > 0:
+            deployment.credentials['extraClients'] = {name: (cert.encode('UTF-8'), key.encode('UTF-8'))
+                                                      for name, (cert, key) in data['extraClients'].items()}
+        deployment.serverCertificateArn = data['serverCertificateArn']
+        deployment.clientCertificateArn = data['clientCertificateArn']
+        deployment.stackId = data['stackId']
+        deployment.endpointId = data['endpointId']
+        # The journals written before the multi-subnet deployments hold a single subnetId.
+        deployment.subnetIds = data.get('subnetIds') or ([data['subnetId']] if data.get('subnetId') else [])
+        # The journals written by earlier versions may record the template stage.
+        deployment.journal = cls(path, [stage for stage in data['completedStages']
+                                        if stage not in UNJOURNALED_STAGES])
+        deployment.isResumed = True
+        return deployment
+
 
 def get_user_settings():
-    # The function gets the required deployment settings from the user.
-    global USER_SETTINGS
-    USER_SETTINGS = {
+    # The function gets the required deployment settings from the user, and returns them.
+    settings = {
         'friendlyName': '',
         'isSplitTunneled': False,
         'region': ''
@@ -187,21 +2577,21 @@ def get_user_settings():
         print(friendlyName)
     else:
         print("Your current VPN friendly name is:\n{}".format(friendlyName))
-    USER_SETTINGS['friendlyName'] = friendlyName
+    settings['friendlyName'] = friendlyName
 
     isSplitTunneled = input(
         "Do you want to enable split tunnel for your VPN?\n[Default: Nn] <Yy or Nn> ").capitalize()
     while True:
         if isSplitTunneled == 'Y':
-            USER_SETTINGS['isSplitTunneled'] = True
+            settings['isSplitTunneled'] = True
             print("The VPN will be split-tunnel enabled.")
             break
         elif isSplitTunneled == 'N':
-            USER_SETTINGS['isSplitTunneled'] = False
+            settings['isSplitTunneled'] = False
             print("The VPN will be split-tunnel disabled.")
             break
         elif isSplitTunneled == '':
-            USER_SETTINGS['isSplitTunneled'] = False
+            settings['isSplitTunneled'] = False
             print("The VPN will be split-tunnel disabled as default.")
             break
         else:
@@ -226,23 +2616,7 @@ def get_user_settings():
     13. Europe (London)
     14. Europe (Stockholm)
     '''
-    regionsMapping = [
-        "",
-        "us-east-1",
-        "us-east-2",
-        "us-west-1",
-        "us-west-2",
-        "ap-south-1",
-        "ap-northeast-2",
-        "ap-southeast-1",
-        "ap-southeast-2",
-        "ap-northeast-1",
-        "ca-central-1",
-        "eu-central-1",
-        "eu-west-1",
-        "eu-west-2",
-        "eu-north-1"
-    ]
+    regionsMapping = [""] + CLIENT_VPN_REGIONS
     print(availableRegions)
     while True:
         regionNumber = input(
@@ -250,52 +2624,166 @@ def get_user_settings():
         try:
             regionNumberInteger = int(regionNumber)
             if regionNumberInteger <= 14 and regionNumberInteger >= 1:
-                USER_SETTINGS['region'] = regionsMapping[regionNumberInteger]
+                settings['region'] = regionsMapping[regionNumberInteger]
             else:
                 raise Exception(
                     "Value ({}) not found. Please re-enter your region number.".format(regionNumber))
         except Exception as e:
             print(e)
         else:
-            print("Your choice is {}".format(USER_SETTINGS['region']))
+            print("Your choice is {}".format(settings['region']))
             break
 
-    print("Please review your settings:\n {}".format(USER_SETTINGS))
+    print("Please review your settings:\n {}".format(settings))
     if input("Please press ENTER to proceed, any other key to abort.\n> ").capitalize() != "":
         print("Abort.")
         sys.exit(1)
+    return settings
+
+
+# The credentials are generated either in-process with the cryptography package (builtin),
+# or with easy-rsa, which requires git and the network. The builtin backend is used whenever cryptography is installed.
+# Either way they are uploaded to ACM afterwards by import_server_certificate() and import_client_certificate().
+def generate_credentials(deployment):
+    if deployment.pkiBackend == 'easy-rsa':
+        generate_credentials_with_easy_rsa(deployment)
+    elif deployment.pkiBackend == 'builtin':
+        generate_credentials_in_process(deployment)
+    else:
+        raise Exception(
+            f"No such PKI backend as \"{deployment.pkiBackend}\" is available. Please use builtin or easy-rsa.")
 
 
-def generate_credentials():
+def default_pki_backend():
+    try:
+        import cryptography
+    except ImportError:
+        return 'easy-rsa'
+    return 'builtin'
+
+
+def generate_private_key():
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    return rsa.generate_private_key(public_exponent=65537, key_size=PKI_KEY_SIZE)
+
+
+# Builds a certificate with the same extensions as the easy-rsa "ca", "server" and "client" x509 types.
+# Without an issuer, the certificate is self-signed with its own key, which is how the CA is created.
+def build_certificate(commonName, privateKey, certificateType, issuerCert=None, issuerKey=None):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID, ExtendedKeyUsageOID
+    from cryptography.hazmat.primitives import hashes
+    import datetime
+
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, commonName)])
+    publicKey = privateKey.public_key()
+    if issuerCert is None:
+        issuerName, issuerKey, issuerPublicKey = subject, privateKey, publicKey
+    else:
+        issuerName, issuerPublicKey = issuerCert.subject, issuerCert.public_key()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder().subject_name(subject).issuer_name(issuerName).public_key(
+        publicKey).serial_number(x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(minutes=5)).not_valid_after(
+        now + datetime.timedelta(days=PKI_CA_DAYS if certificateType == 'ca' else PKI_CERT_DAYS)).add_extension(
+        x509.SubjectKeyIdentifier.from_public_key(publicKey), critical=False).add_extension(
+        x509.AuthorityKeyIdentifier.from_issuer_public_key(issuerPublicKey), critical=False)
+    if certificateType == 'ca':
+        builder = builder.add_extension(
+            x509.BasicConstraints(ca=True, path_length=None), critical=True).add_extension(
+            x509.KeyUsage(digital_signature=False, content_commitment=False, key_encipherment=False,
+                          data_encipherment=False, key_agreement=False, key_cert_sign=True,
+                          crl_sign=True, encipher_only=False, decipher_only=False), critical=False)
+    else:
+        isServer = certificateType == 'server'
+        builder = builder.add_extension(
+            x509.BasicConstraints(ca=False, path_length=None), critical=False).add_extension(
+            x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=isServer,
+                          data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                          crl_sign=False, encipher_only=False, decipher_only=False), critical=False).add_extension(
+            x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH if isServer else ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+        if isServer:
+            builder = builder.add_extension(
+                x509.SubjectAlternativeName([x509.DNSName(commonName)]), critical=False)
+    return builder.sign(issuerKey, hashes.SHA256())
+
+
+def to_pem(certificate=None, privateKey=None):
+    from cryptography.hazmat.primitives import serialization
+    if certificate is not None:
+        return certificate.public_bytes(serialization.Encoding.PEM)
+    return privateKey.private_bytes(serialization.Encoding.PEM,
+                                    serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+
+
+# Issues one client certificate signed by the CA, and returns the certificate and the key as PEM bytes.
+def issue_client_certificate(caCert, caKey, commonName):
+    clientKey = generate_private_key()
+    clientCert = build_certificate(
+        commonName, clientKey, 'client', caCert, caKey)
+    return to_pem(certificate=clientCert), to_pem(privateKey=clientKey)
+
+
+# The builtin backend. The CA, the server and the client credentials live in memory,
+# and one more client certificate is issued for every name in extraClientNames.
+# Only the CA is written to disk at the end of the deployment, so that more clients can be issued later.
+def generate_pki(name, extraClientNames=()):
+    caKey = generate_private_key()
+    caCert = build_certificate(f"{name}-ca", caKey, 'ca')
+    serverKey = generate_private_key()
+    serverCert = build_certificate(
+        f"server-{name}", serverKey, 'server', caCert, caKey)
+    credentials = {
+        'caCert': to_pem(certificate=caCert),
+        'caKey': to_pem(privateKey=caKey),
+        'serverCert': to_pem(certificate=serverCert),
+        'serverKey': to_pem(privateKey=serverKey),
+        'extraClients': {},
+    }
+    credentials['clientCert'], credentials['clientKey'] = issue_client_certificate(
+        caCert, caKey, f"{name}.domain.tld")
+    for clientName in extraClientNames:
+        credentials['extraClients'][clientName] = issue_client_certificate(
+            caCert, caKey, clientName)
+    return credentials
+
+
+def generate_credentials_in_process(deployment):
+    print("Generating credentials in-process...")
+    deployment.credentials = generate_pki(
+        deployment.friendlyName, deployment.extraClientNames)
+    print("Done.\n")
+
+
+def generate_credentials_with_easy_rsa(deployment):
     # This function first clones https://github.com/openvpn/easy-rsa.git and generates certificates for both server and clients.
     # And saves it under the current directory.
-    # After that, it uploads the credentials to ACM.
-    global CLIENT_CERT
-    global CLIENT_KEY
+    import subprocess
     print("Generating credentials...")
     input("In the process, you will be prompted to enter the DN for your CA. You can just leave it blank and press enter.\nPlease type enter to confirm > ")
     commandsToRun = [
         'git clone https://github.com/openvpn/easy-rsa.git .easy-rsa-{}'.format(
-            USER_SETTINGS['friendlyName']),
+            deployment.friendlyName),
         '.easy-rsa-{}/easyrsa3/easyrsa init-pki'.format(
-            USER_SETTINGS['friendlyName']),
+            deployment.friendlyName),
         '.easy-rsa-{}/easyrsa3/easyrsa build-ca nopass'.format(
-            USER_SETTINGS['friendlyName']),
+            deployment.friendlyName),
         '.easy-rsa-{}/easyrsa3/easyrsa build-server-full server-{} nopass'.format(
-            USER_SETTINGS['friendlyName'], USER_SETTINGS['friendlyName']),
+            deployment.friendlyName, deployment.friendlyName),
         '.easy-rsa-{}/easyrsa3/easyrsa build-client-full {}.domain.tld nopass'.format(
-            USER_SETTINGS['friendlyName'], USER_SETTINGS['friendlyName']),
-        'mkdir {}.ovpnsetup'.format(USER_SETTINGS['friendlyName']),
-        'cp pki/ca.crt ./{}.ovpnsetup'.format(USER_SETTINGS['friendlyName']),
+            deployment.friendlyName, deployment.friendlyName),
+        'mkdir {}.ovpnsetup'.format(deployment.friendlyName),
+        'cp pki/ca.crt ./{}.ovpnsetup'.format(deployment.friendlyName),
         'cp pki/issued/server-{}.crt ./{}.ovpnsetup'.format(
-            USER_SETTINGS['friendlyName'], USER_SETTINGS['friendlyName']),
+            deployment.friendlyName, deployment.friendlyName),
         'cp pki/private/server-{}.key ./{}.ovpnsetup'.format(
-            USER_SETTINGS['friendlyName'], USER_SETTINGS['friendlyName']),
+            deployment.friendlyName, deployment.friendlyName),
         'cp pki/issued/{}.domain.tld.crt ./{}.ovpnsetup'.format(
-            USER_SETTINGS['friendlyName'], USER_SETTINGS['friendlyName']),
+            deployment.friendlyName, deployment.friendlyName),
         'cp pki/private/{}.domain.tld.key ./{}.ovpnsetup'.format(
-            USER_SETTINGS['friendlyName'], USER_SETTINGS['friendlyName']),
-        'rm -rf .easy-rsa-{}'.format(USER_SETTINGS['friendlyName']),
+            deployment.friendlyName, deployment.friendlyName),
+        'rm -rf .easy-rsa-{}'.format(deployment.friendlyName),
         'rm -rf pki'
     ]
     for command in commandsToRun:
@@ -305,46 +2793,53 @@ def generate_credentials():
 
     # pre-load the certificates into the memory.
     print("Retrieving the certificates...")
-    CA_CERT = open(
-        f"./{USER_SETTINGS['friendlyName']}.ovpnsetup/ca.crt", "r").read().encode('UTF-8')
-    SERVER_CERT = open(
-        f"./{USER_SETTINGS['friendlyName']}.ovpnsetup/server-{USER_SETTINGS['friendlyName']}.crt", "r").read().encode('UTF-8')
-    SERVER_KEY = open(
-        f"./{USER_SETTINGS['friendlyName']}.ovpnsetup/server-{USER_SETTINGS['friendlyName']}.key", "r").read().encode('UTF-8')
-    CLIENT_CERT = open(
-        f"./{USER_SETTINGS['friendlyName']}.ovpnsetup/{USER_SETTINGS['friendlyName']}.domain.tld.crt", "r").read().encode('UTF-8')
-    CLIENT_KEY = open(
-        f"./{USER_SETTINGS['friendlyName']}.ovpnsetup/{USER_SETTINGS['friendlyName']}.domain.tld.key", "r").read().encode('UTF-8')
+    credentials = {'extraClients': {}}
+    credentials['caCert'] = open(
+        f"./{deployment.friendlyName}.ovpnsetup/ca.crt", "r").read().encode('UTF-8')
+    credentials['serverCert'] = open(
+        f"./{deployment.friendlyName}.ovpnsetup/server-{deployment.friendlyName}.crt", "r").read().encode('UTF-8')
+    credentials['serverKey'] = open(
+        f"./{deployment.friendlyName}.ovpnsetup/server-{deployment.friendlyName}.key", "r").read().encode('UTF-8')
+    credentials['clientCert'] = open(
+        f"./{deployment.friendlyName}.ovpnsetup/{deployment.friendlyName}.domain.tld.crt", "r").read().encode('UTF-8')
+    credentials['clientKey'] = open(
+        f"./{deployment.friendlyName}.ovpnsetup/{deployment.friendlyName}.domain.tld.key", "r").read().encode('UTF-8')
+    deployment.credentials = credentials
     print("Done.\n")
 
     # Delete the temporary configuration folder. (This process is unnecessary and complicated. It should be later simplified.)
-    subprocess.run(f"rm -rf {USER_SETTINGS['friendlyName']}-{}.ovpnsetup".split(' '), check=True)
-
-    # Upload the certificates.
-    # Import Server Certificate
-    print("Uploading the certificates...")
-    global SERVER_CERTIFICATE_ARN
-    SERVER_CERTIFICATE_ARN = client_acm.import_certificate(
-        Certificate=SERVER_CERT,
-        PrivateKey=SERVER_KEY,
-        CertificateChain=CA_CERT,
+    subprocess.run(f"rm -rf {deployment.friendlyName}.ovpnsetup".split(' '), check=True)
+
+
+
+@traced
+def import_server_certificate(deployment):
+    print("Uploading the server certificate...")
+    deployment.serverCertificateArn = get_client('acm', deployment.region).import_certificate(
+        Certificate=deployment.credentials['serverCert'],
+        PrivateKey=deployment.credentials['serverKey'],
+        CertificateChain=deployment.credentials['caCert'],
         Tags=[
             {
                 "Key": "deploymentFriendlyName",
-                "Value": USER_SETTINGS['friendlyName']
+                "Value": deployment.friendlyName
             }
         ]
     )['CertificateArn']
-    # Import Client Certificate
-    global CLIENT_CERTIFICATE_ARN
-    CLIENT_CERTIFICATE_ARN = client_acm.import_certificate(
-        Certificate=CLIENT_CERT,
-        PrivateKey=CLIENT_KEY,
-        CertificateChain=CA_CERT,
+    print("Done.\n")
+
+
+@traced
+def import_client_certificate(deployment):
+    print("Uploading the client certificate...")
+    deployment.clientCertificateArn = get_client('acm', deployment.region).import_certificate(
+        Certificate=deployment.credentials['clientCert'],
+        PrivateKey=deployment.credentials['clientKey'],
+        CertificateChain=deployment.credentials['caCert'],
         Tags=[
             {
                 "Key": "deploymentFriendlyName",
-                "Value": USER_SETTINGS['friendlyName']
+                "Value": deployment.friendlyName
             }
         ]
     )['CertificateArn']
@@ -352,113 +2847,347 @@ def generate_credentials():
 
 
 # This function downloads the cloudformation template if one is not found under the CWD.
-def download_cloudformation_template():
+# The lock keeps concurrent deployments from downloading it at the same time.
+_TEMPLATE_LOCK = threading.Lock()
+
+
+def download_cloudformation_template(deployment):
+    import subprocess
     cfTemplate = Path('cloudformation-template')
-    global TEMPLATE_CONTENT
-    for count in range(3):
-        if cfTemplate.exists():
-            TEMPLATE_CONTENT = cfTemplate.open('r').read()
-            break
+    with _TEMPLATE_LOCK:
+        for count in range(3):
+            if cfTemplate.exists():
+                deployment.templateContent = cfTemplate.open('r').read()
+                break
+            else:
+                subprocess.run("wget \'https://raw.githubusercontent.com/Scottpedia/vpn-toggle-utility/setup-script/cloudformation-template\' -O cloudformation-template".split(
+                    ' '), check=True, stdout=sys.stdout)
         else:
-            subprocess.run("wget \'https://raw.githubusercontent.com/Scottpedia/vpn-toggle-utility/setup-script/cloudformation-template\' -O cloudformation-template".split(
-                ' '), check=True, stdout=sys.stdout)
+            raise Exception(
+                "Failed to find and download the cloudformation template.")
+    validate_cloudformation_template(deployment.templateContent, deployment.settings.get('subnetCount', 1))
+
+
+# A local sanity check of the template, so that a broken file fails the deployment before anything is created on AWS.
+# The SubnetCount parameter is only required for the deployments with several subnets,
+# so that the older templates still deploy a single subnet.
+def validate_cloudformation_template(templateContent, subnetCount=1):
+    try:
+        template = loads(templateContent)
+    except ValueError as e:
+        raise Exception(f"The cloudformation template is not valid JSON : {e}")
+    parameters = ('ClientCertificateArn', 'ServerCertificateArn', 'isSplitTunnelled', 'FriendlyName')
+    if subnetCount > 1:
+        parameters += ('SubnetCount',)
+    for section, keys in (('Parameters', parameters),
+                          ('Outputs', ('ClientVPNEndpointId', 'SubnetId'))):
+        missing = [key for key in keys if key not in template.get(section, {})]
+        if len(missing) > 0:
+            raise Exception(
+                f"The cloudformation template is missing {section} : {', '.join(missing)}")
+
+
+# The outputs of the cloudformation template holding the ids of the target subnets, one per availability zone.
+SUBNET_OUTPUT_KEYS = ('SubnetId', 'SecondSubnetId', 'ThirdSubnetId')
+MAX_SUBNETS = len(SUBNET_OUTPUT_KEYS)
+
+
+def parse_subnet_count(value):
+    try:
+        subnetCount = int(value)
+    except (TypeError, ValueError):
+        subnetCount = 0
+    if not 1 <= subnetCount <= MAX_SUBNETS:
+        raise Exception(f"The number of subnets must be between 1 and {MAX_SUBNETS}, not \"{value}\".")
+    return subnetCount
+
+
+# The resources of the cloudformation template whose progress is reported during the deployment.
+TRACKED_RESOURCE_TYPES = (
+    'AWS::EC2::VPC',
+    'AWS::EC2::Subnet',
+    'AWS::EC2::InternetGateway',
+    'AWS::EC2::ClientVpnEndpoint',
+)
+
+
+# The tracker follows the events of one stack incrementally. Every poll only reads the events newer than the last
+# one it has seen, reports the progress of the tracked resources, records how long each of them took to create,
+# and raises on the first failed event instead of waiting for the deployment to time out.
+class StackEventTracker:
+
+    def __init__(self, client, stackId, resourceTypes=TRACKED_RESOURCE_TYPES):
+        self.client = client
+        self.stackId = stackId
+        self.resourceTypes = resourceTypes
+        self.lastEventId = None
+        self.stackStatus = None
+        self.startTimes = {}  # logical resource id -> time the creation started
+        self.durations = {}  # logical resource id -> seconds the creation took
+
+    # describe_stack_events lists the newest events first, so pages are read until the last seen event shows up.
+    def _read_new_events(self):
+        newEvents = []
+        kwargs = {'StackName': self.stackId}
+        while True:
+            response = self.client.describe_stack_events(**kwargs)
+            for event in response['StackEvents']:
+                if event['EventId'] == self.lastEventId:
+                    return newEvents
+                newEvents.append(event)
+            if not response.get('NextToken'):
+                return newEvents
+            kwargs['NextToken'] = response['NextToken']
+
+    # Marks the events so far as seen, e.g. before deleting a stack whose history may hold failures from its creation.
+    def skip_existing_events(self):
+        events = self.client.describe_stack_events(
+            StackName=self.stackId)['StackEvents']
+        if len(events) > 0:
+            self.lastEventId = events[0]['EventId']
+
+    def poll(self):
+        newEvents = self._read_new_events()
+        if len(newEvents) > 0:
+            self.lastEventId = newEvents[0]['EventId']
+        for event in reversed(newEvents):
+            self._handle_event(event)
+        return self.stackStatus
+
+    def _handle_event(self, event):
+        status = event['ResourceStatus']
+        logicalId = event['LogicalResourceId']
+        resourceType = event['ResourceType']
+        if resourceType == 'AWS::CloudFormation::Stack' and event.get('PhysicalResourceId') == self.stackId:
+            self.stackStatus = status
+        if status.endswith('_FAILED') or status.startswith('ROLLBACK'):
+            raise Exception("The stack deployment failed at {} ({}) : {} {}".format(
+                logicalId, resourceType, status, event.get('ResourceStatusReason', '')))
+        if resourceType not in self.resourceTypes:
+            return
+        if status == 'CREATE_IN_PROGRESS' and logicalId not in self.startTimes:
+            self.startTimes[logicalId] = event['Timestamp']
+            print(f"Creating {resourceType} ({logicalId})...")
+        elif status == 'CREATE_COMPLETE' and logicalId in self.startTimes:
+            self.durations[logicalId] = (
+                event['Timestamp'] - self.startTimes[logicalId]).total_seconds()
+            print("Created {} ({}) in {:.0f} seconds.".format(
+                resourceType, logicalId, self.durations[logicalId]))
+
+    def print_durations(self):
+        print("Resource creation times:")
+        for logicalId, duration in sorted(self.durations.items(), key=lambda x: -x[1]):
+            print("    {:<20}{:>6.0f} s".format(logicalId, duration))
+
+
+# Creating the stack is the one stage which cannot simply be repeated, so the stack id is recorded in the journal
+# right away, and a stack left behind by an earlier run with the same name is reattached to.
+@traced
+def create_stack(client_cf, deployment):
+    stackName = 'ovpn-{}'.format(deployment.friendlyName)
+    subnetCount = deployment.settings.get('subnetCount', 1)
+    subnetParameters = [{'ParameterKey': 'SubnetCount', 'ParameterValue': str(subnetCount)}] if subnetCount > 1 else []
+    try:
+        response = client_cf.create_stack(
+            StackName=stackName,
+            TemplateBody=deployment.templateContent,
+            Parameters=[
+                {
+                    'ParameterKey': 'ClientCertificateArn',
+                    'ParameterValue': deployment.clientCertificateArn
+                },
+                {
+                    'ParameterKey': 'ServerCertificateArn',
+                    'ParameterValue': deployment.serverCertificateArn
+                },
+                {
+                    'ParameterKey': 'isSplitTunnelled',
+                    'ParameterValue': str(deployment.settings['isSplitTunneled']).lower()
+                },
+                {
+                    'ParameterKey': 'FriendlyName',
+                    'ParameterValue': deployment.friendlyName
+                }
+            ] + subnetParameters,
+            TimeoutInMinutes=15,
+            Tags=[
+                {
+                    "Key": "deploymentFriendlyName",
+                    "Value": deployment.friendlyName
+                }
+            ]
+        )
+    except Exception as e:
+        # The stack may have been created by the interrupted run being resumed, which stopped before recording its id.
+        # It is only reattached to when it uses the certificates of this deployment, so that the stack
+        # of another deployment with the same friendly name is left alone.
+        if aws_error_code(e) != 'AlreadyExistsException' or not deployment.isResumed:
+            raise
+        stack = client_cf.describe_stacks(StackName=stackName)["Stacks"][0]
+        parameters = {x['ParameterKey']: x['ParameterValue'] for x in stack.get('Parameters', [])}
+        if parameters.get('ServerCertificateArn') != deployment.serverCertificateArn or \
+                parameters.get('ClientCertificateArn') != deployment.clientCertificateArn:
+            raise
+        print(f"The stack {stackName} already exists. Reattaching to it...")
+        deployment.stackId = stack['StackId']
+        discard_failed_stack(client_cf, deployment)
+        if deployment.stackId == '':
+            create_stack(client_cf, deployment)
     else:
-        raise Exception(
-            "Failed to find and download the cloudformation template.")
+        deployment.stackId = response['StackId']
+
+
+# The states a stack only leaves by being deleted. A failed creation ends in ROLLBACK_COMPLETE.
+FAILED_STACK_STATUSES = ('CREATE_FAILED', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE', 'DELETE_FAILED')
+
+
+# A stack reattached to after a failed creation would fail the deployment on every resume,
+# so it is deleted, keeping its certificates, and the stack id is cleared for the stack to be created again.
+def discard_failed_stack(client_cf, deployment):
+    def describe():
+        return client_cf.describe_stacks(StackName=deployment.stackId)['Stacks'][0]
+    stack, _elapsed = poll_with_backoff(
+        describe, lambda stack: stack['StackStatus'] not in ('ROLLBACK_IN_PROGRESS', 'DELETE_IN_PROGRESS'),
+        timeout=600, initialDelay=2, maxDelay=10)
+    status = stack['StackStatus']
+    if status == 'DELETE_COMPLETE':
+        print(f"The stack {deployment.stackId} is deleted already. A new one will be created.")
+    elif status in FAILED_STACK_STATUSES:
+        print(f"The stack {deployment.stackId} ended in {status}. Deleting it to create it again...")
+        try:
+            delete_stack(client_cf, deployment.stackId)
+        except Exception as e:
+            raise Exception(
+                f"The failed stack {deployment.stackId} could not be deleted : {e}\nPlease delete it by hand, then resume the deployment.")
+    else:
+        return
+    deployment.stackId = ''
+    deployment.checkpoint()
 
 
-def deploy_cloudformation_template():
+def deploy_cloudformation_template(deployment):
     print("Now we start to deploy the actual thing on AWS.")
     print("Deploying...")
-    response = client_cf.create_stack(
-        StackName='ovpn-{}'.format(USER_SETTINGS['friendlyName']),
-        TemplateBody=TEMPLATE_CONTENT,
-        Parameters=[
-            {
-                'ParameterKey': 'ClientCertificateArn',
-                'ParameterValue': CLIENT_CERTIFICATE_ARN
-            },
-            {
-                'ParameterKey': 'ServerCertificateArn',
-                'ParameterValue': SERVER_CERTIFICATE_ARN
-            },
-            {
-                'ParameterKey': 'isSplitTunnelled',
-                'ParameterValue': str(USER_SETTINGS['isSplitTunneled']).lower()
-            },
-            {
-                'ParameterKey': 'FriendlyName',
-                'ParameterValue': USER_SETTINGS['friendlyName']
-            }
-        ],
-        TimeoutInMinutes=15,
-        Tags=[
-            {
-                "Key": "deploymentFriendlyName",
-                "Value": USER_SETTINGS['friendlyName']
-            }
-        ]
-    )
-    global CLOUDFORMATION_STACK_ID
-    global CLIENT_VPN_ENDPOINT_ID
-    global SUBNET_ID
-    CLOUDFORMATION_STACK_ID = response['StackId']
-    print("Deployment initiated. The program will refresh every 3 seconds to check the progress of deployment. The timeout is 5 mimutes.")
-    for i in range(100):
-        time.sleep(3)
-        response = client_cf.describe_stacks(
-            StackName='ovpn-{}'.format(USER_SETTINGS['friendlyName'])
-        )
-        if response["Stacks"][0]['StackStatus'] == 'CREATE_COMPLETE':
-            print("Stack is successfully created!")
-            outputs = response["Stacks"][0]['Outputs']
-            outputs.sort(key=lambda x : x['OutputKey'])
-            CLIENT_VPN_ENDPOINT_ID = outputs[0]['OutputValue']
-            SUBNET_ID = outputs[1]['OutputValue']
-            break
-        elif response["Stacks"][0]['StackStatus'] == ('CREATE_FAILED' or 'ROLLBACK_IN_PROGRESS'):
-            print("The stack deployment failed.")
-            raise Exception("The stack deployment failed.")
-        elif response["Stacks"][0]['StackStatus'] == 'CREATE_IN_PROGRESS':
-            pass
-        else:
-            raise Exception("Unexpected stack status detected.")
-    else:
-        raise Exception("Deployment timed out.")
+    client_cf = get_client('cloudformation', deployment.region)
+    if deployment.stackId != '':
+        print(f"Reattaching to the stack {deployment.stackId} ...")
+        discard_failed_stack(client_cf, deployment)
+    if deployment.stackId == '':
+        create_stack(client_cf, deployment)
+        deployment.checkpoint()
+        print("Deployment initiated. The program will follow the stack events until the deployment completes. The timeout is 5 mimutes.")
+    tracker = StackEventTracker(client_cf, deployment.stackId)
+    with trace_span('wait_for_stack'):
+        _status, elapsed = poll_with_backoff(
+            tracker.poll,
+            lambda status: status == 'CREATE_COMPLETE',
+            timeout=300, initialDelay=2, maxDelay=10)
+    print("Stack is successfully created after {:.0f} seconds!".format(elapsed))
+    tracker.print_durations()
+    stack = client_cf.describe_stacks(
+        StackName=deployment.stackId
+    )["Stacks"][0]
+    outputs = {x['OutputKey']: x['OutputValue'] for x in stack['Outputs']}
+    deployment.endpointId = outputs['ClientVPNEndpointId']
+    deployment.subnetIds = [outputs[key] for key in SUBNET_OUTPUT_KEYS if key in outputs]
 
 
-def download_connection_profile():
+@traced
+def download_connection_profile(deployment):
     print('Exporting the connection profile...')
-    connConfig = client_ec2.export_client_vpn_client_configuration(
-        ClientVpnEndpointId=CLIENT_VPN_ENDPOINT_ID
+    connConfig = get_client('ec2', deployment.region).export_client_vpn_client_configuration(
+        ClientVpnEndpointId=deployment.endpointId
     )
     print('Done.\n')
 
     print('Inserting client-side credentials...')
     print('Processing...')
-    conn_fragments = connConfig['ClientConfiguration'].split('\n')
+    template = ConnectionProfileTemplate(connConfig['ClientConfiguration'])
+    fileName = f"{deployment.region}-{deployment.friendlyName}.ovpn"
+    write_connection_profile(
+        template, deployment.credentials['clientKey'], deployment.credentials['clientCert'], fileName)
+    print('Done.\n')
+    print('Your .ovpn file is: ' + fileName)
+    # The credentials of a PKI shared by several entries of a spec hold the clients of all of them,
+    # while only the clients listed for this deployment get a profile.
+    for clientName in deployment.extraClientNames:
+        clientCert, clientKey = deployment.credentials['extraClients'][clientName]
+        fileName = f"{deployment.region}-{deployment.friendlyName}-{clientName}.ovpn"
+        write_connection_profile(template, clientKey, clientCert, fileName)
+        print(f'The .ovpn file of {clientName} is: ' + fileName)
+
+
+# The client configuration exported by AWS, parsed once into directives so that any number of .ovpn files can be
+# rendered from it. Every directive is a (name, text) pair, where the text is the whole line of a plain directive,
+# or the whole inline block of one like <ca>...</ca>, named "<ca>".
+class ConnectionProfileTemplate:
 
-    conn_fragments[3] = 'remote ' + ''.join(random.SystemRandom().choice(string.ascii_letters + string.digits)
-                                            for _ in range(20)).lower() + '.' + conn_fragments[3].split(' ')[1] + ' 443'
+    def __init__(self, clientConfiguration):
+        self.directives = []
+        lines = iter(clientConfiguration.splitlines())
+        for line in lines:
+            stripped = line.strip()
+            if stripped.startswith('<') and not stripped.startswith('</'):
+                block = [line]
+                for line in lines:
+                    block.append(line)
+                    if line.strip() == '</' + stripped[1:]:
+                        break
+                else:
+                    raise Exception(
+                        f"The inline block {stripped} is not closed in the client configuration.")
+                self.directives.append((stripped, '\n'.join(block)))
+            elif stripped == '' or stripped.startswith('#') or stripped.startswith(';'):
+                self.directives.append(('', line))
+            else:
+                self.directives.append((stripped.split()[0], line))
+        if not any(name == 'remote' for name, _text in self.directives):
+            raise Exception("No remote directive found in the client configuration.")
+
+    # Yields the .ovpn file chunk by chunk. The remote gets a random sub-domain, and the client key and certificate
+    # are put in right after the CA, replacing any key or certificate already in the configuration.
+    def render(self, clientKey, clientCert):
+        credentialBlocks = '<key>\n{}\n</key>\n<cert>\n{}\n</cert>\n'.format(
+            clientKey.decode('UTF-8').strip(), clientCert.decode('UTF-8').strip())
+        isInserted = False
+        for name, text in self.directives:
+            if name == 'remote':
+                arguments = text.split()
+                yield 'remote {}.{} {}\n'.format(
+                    ''.join(random.SystemRandom().choice(string.ascii_lowercase + string.digits) for _ in range(20)),
+                    arguments[1], arguments[2] if len(arguments) > 2 else '443')
+            elif name in ('<key>', '<cert>'):
+                continue
+            elif name == '<ca>':
+                yield text + '\n'
+                yield credentialBlocks
+                isInserted = True
+            else:
+                yield text + '\n'
+        if not isInserted:
+            yield credentialBlocks
 
-    conn_fragments.insert(-2, '<key>')
-    for _i in CLIENT_KEY.decode('UTF-8').split('\n'):
-        conn_fragments.insert(-2, _i)
-    conn_fragments.insert(-2, '</key>')
 
-    conn_fragments.insert(-2, '<cert>')
-    for _i in CLIENT_CERT.decode('UTF-8').split('\n'):
-        conn_fragments.insert(-2, _i)
-    conn_fragments.insert(-2, '</cert>')
+# The file is streamed to a temporary file next to its destination and then renamed over it,
+# so a reader never sees it half-written. The temporary file gets the mode before anything is written to it,
+# so the default mode, readable by the owner only, suits the files holding a private key.
+def write_file_atomically(fileName, chunks, suffix='.tmp', mode=0o600):
+    directory = os.path.dirname(os.path.abspath(fileName))
+    import tempfile
+    fd, temporaryName = tempfile.mkstemp(dir=directory, prefix='.', suffix=suffix)
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as _f:
+            for chunk in chunks:
+                _f.write(chunk)
+        os.replace(temporaryName, fileName)
+    except BaseException:
+        os.unlink(temporaryName)
+        raise
 
-    ovpnConfig = '\n'.join(conn_fragments)
 
-    ovpnFile = open(
-        f"{USER_SETTINGS['region']}-{USER_SETTINGS['friendlyName']}.ovpn", "w+")
-    ovpnFile.write(ovpnConfig)
-    ovpnFile.close()
-    print('Done.\n')
-    print('Your .ovpn file is: ' + f"{USER_SETTINGS['region']}-{USER_SETTINGS['friendlyName']}.ovpn")
+def write_connection_profile(template, clientKey, clientCert, fileName):
+    write_file_atomically(fileName, template.render(clientKey, clientCert), suffix='.ovpn.tmp')
 
 
 # In the following function, we save the setup result as a file under the CWD for later use, 
@@ -470,59 +3199,422 @@ def download_connection_profile():
 # - Date of Creation
 # - Friendly Name of the Deployment
 # These data should be stored in Json format.
-def save_the_setup_results():
+def save_the_setup_results(deployment):
     print("Gathering Deployment attributes...")
-    saveTime = int(time.time())
-    DATA_TO_STORE={
-        "AWS_REGION": USER_SETTINGS['region'],
-        "ENDPOINT_ID": CLIENT_VPN_ENDPOINT_ID,
-        "SUBNET_ID": SUBNET_ID,
-        "DATE_OF_CREATION": saveTime,
-        "FRIENDLY_NAME": USER_SETTINGS['friendlyName']
-    }
+    DATA_TO_STORE = collect_setup_results(deployment)
+    saveTime = DATA_TO_STORE['DATE_OF_CREATION']
     print('Done.\n')
     print(DATA_TO_STORE)
-    print(f"Saving the file as \'{USER_SETTINGS['friendlyName']}-{saveTime}.ovpnsetup\' ...")
-    _f = open(f"{USER_SETTINGS['friendlyName']}-{saveTime}.ovpnsetup",'w+')
+    print(f"Saving the file as \'{deployment.friendlyName}-{saveTime}.ovpnsetup\' ...")
+    _f = open(f"{deployment.friendlyName}-{saveTime}.ovpnsetup",'w+')
     _f.write(dumps(DATA_TO_STORE))
     _f.close()
     print('Done.\n')
-    
+    print(f"Registering the profile in {get_registry_path()} ...")
+    register_profiles([DATA_TO_STORE])
+    print('Done.\n')
 
-    # *** THE DEPLOYMENT CODE SECTION ENDS ***
-if __name__ == "__main__":
-    if len(sys.argv) > 1:  # To see if the command is present.
+
+# Returns the profile of the deployment, saving its CA under the CWD when there is one.
+def collect_setup_results(deployment):
+    profile = {
+        "AWS_REGION": deployment.region,
+        "ENDPOINT_ID": deployment.endpointId,
+        "SUBNET_ID": deployment.subnetIds[0],
+        "SUBNET_IDS": deployment.subnetIds,
+        "DATE_OF_CREATION": int(time.time()),
+        "FRIENDLY_NAME": deployment.friendlyName
+    }
+    if deployment.credentials.get('caKey'):
+        profile['CA_CERT_FILE'], profile['CA_KEY_FILE'] = save_certificate_authority(
+            deployment)
+    return profile
+
+
+# The CA is kept next to the setup results, with the key readable by the owner only, to issue more clients later.
+def save_certificate_authority(deployment):
+    caCertFile = Path(f"{deployment.friendlyName}-ca.crt").resolve()
+    caKeyFile = Path(f"{deployment.friendlyName}-ca.key").resolve()
+    caCertFile.write_bytes(deployment.credentials['caCert'])
+    fd = os.open(caKeyFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as _f:
+        _f.write(deployment.credentials['caKey'])
+    return str(caCertFile), str(caKeyFile)
+
+
+# The deploy pipeline runs the deployment stages as a dependency graph.
+# A stage starts as soon as every stage it depends on is done, so that independent stages overlap,
+# e.g. the template is loaded while the PKI is generated, and both certificates are imported at the same time.
+class DeployPipeline:
+
+    def __init__(self, maxWorkers=4):
+        self.maxWorkers = maxWorkers
+        self.stages = {}  # name -> (function, names of the stages it depends on)
+        self.timings = {}  # name -> (start, end), in seconds since the pipeline started
+
+    def add_stage(self, name, function, dependsOn=()):
+        for dependency in dependsOn:
+            if dependency not in self.stages:
+                raise Exception(
+                    f"The stage \"{name}\" depends on the unknown stage \"{dependency}\".")
+        self.stages[name] = (function, tuple(dependsOn))
+
+    def _run_stage(self, name):
+        startTime = time.monotonic() - self.startTime
         try:
-            # get_configuration()
-            manage()
-        except Exception as e:
-            print("Errors occured.", file=sys.stderr)
-            traceback.print_exc()
-    else:  # manage the vpn when there is no commands or options.
-        print("No commands or options detected in the command line. Let's setup a brand-new VPN service!")
-        input("Please note that this program will create several temporary & non-temporary files and directories under the current working direcory. \
-            Be sure that you have the proper permission to write to the CWD and it is okay for such purposes!\nPlease press any key to proceed. > ")
-        # Before we initiate the deployment sequence, we need to know the following parameters:
-        # - the AWS region where the endpoint will be created. (no Default, mandatory)
-        # - the friendly name of this vpn service. (Default: timestampt/UUID)
-        # - if the vpn service should be split-tunnelled. (Default: non-split-tunnel)
-        # The user will be prompted to speficy these parameters. The job is done within the following function:
-        get_user_settings()
+            with trace_span(f"deploy:{name}"):
+                self.stages[name][0]()
+        finally:
+            self.timings[name] = (startTime, time.monotonic() - self.startTime)
+
+    # The stages listed in completed are taken as done already, and onStageDone is called with the name of every stage that finishes.
+    def run(self, completed=(), onStageDone=None):
+        self.startTime = time.monotonic()
+        done = set(completed) & set(self.stages)
+        running = {}  # future -> name
+        pending = {name: stage for name, stage in self.stages.items() if name not in done}
+        with ThreadPoolExecutor(max_workers=self.maxWorkers) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for name, (_function, dependsOn) in list(pending.items()):
+                    if all(dependency in done for dependency in dependsOn):
+                        running[executor.submit(self._run_stage, name)] = name
+                        del pending[name]
+                finished, _running = wait(running, return_when=FIRST_COMPLETED)
+                failed = [future for future in finished if future.exception() is not None]
+                if len(failed) > 0:
+                    # Let the stages already running finish, but do not start any new one.
+                    finished, _running = wait(running)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.exception() is None:
+                        done.add(name)
+                        if onStageDone is not None:
+                            onStageDone(name)
+                if len(failed) > 0:
+                    raise failed[0].exception()
+
+    # The critical path is found by walking back from the stage that finished last,
+    # each time to the dependency that finished last, since that is the one which held the stage back.
+    # The stages skipped because they were done by an earlier run end the path.
+    def critical_path(self):
+        name = max(self.timings, key=lambda x: self.timings[x][1])
+        path = [name]
+        while True:
+            dependsOn = [x for x in self.stages[name][1] if x in self.timings]
+            if len(dependsOn) == 0:
+                return path
+            name = max(dependsOn, key=lambda x: self.timings[x][1])
+            path.insert(0, name)
+
+    def print_report(self):
+        if len(self.timings) == 0:
+            return
+        print("Deployment stage timings:")
+        for name, (startTime, endTime) in sorted(self.timings.items(), key=lambda x: x[1][0]):
+            print("    {:<20} started at {:>6.1f} s, took {:>6.1f} s".format(
+                name, startTime, endTime - startTime))
+        path = self.critical_path()
+        print("Critical path : {} ({:.1f} s)".format(
+            ' -> '.join(path), self.timings[path[-1]][1]))
+
+
+# The credentials stage is left out when the deployment already has its credentials, e.g. from a shared PKI.
+def build_deploy_pipeline(deployment):
+    pipeline = DeployPipeline()
+    credentialsStages = []
+    if len(deployment.credentials) == 0:
+        pipeline.add_stage('credentials', partial(
+            generate_credentials, deployment))
+        credentialsStages = ['credentials']
+    pipeline.add_stage('template', partial(
+        download_cloudformation_template, deployment))
+    pipeline.add_stage('server-certificate', partial(import_server_certificate, deployment),
+                       dependsOn=credentialsStages)
+    pipeline.add_stage('client-certificate', partial(import_client_certificate, deployment),
+                       dependsOn=credentialsStages)
+    pipeline.add_stage('stack', partial(deploy_cloudformation_template, deployment),
+                       dependsOn=['template', 'server-certificate', 'client-certificate'])
+    if deployment.settings.get('pooled'):
+        # A pooled endpoint gets its client profile when it is claimed, and is registered by then.
+        pipeline.add_stage('save', partial(save_pool_entry, deployment),
+                           dependsOn=['stack'])
+        return pipeline
+    pipeline.add_stage('profile', partial(download_connection_profile, deployment),
+                       dependsOn=['stack'])
+    pipeline.add_stage('save', partial(save_the_setup_results, deployment),
+                       dependsOn=['stack'])
+    return pipeline
+
+
+# Runs the pipeline of the deployment, skipping the stages its journal records as finished.
+# The journal is removed once every stage is done, and kept otherwise, for the resume command.
+def run_deployment(deployment, pipeline):
+    if deployment.journal is None:
+        deployment.journal = DeployJournal(
+            DeployJournal.path_for(deployment.friendlyName))
+    deployment.checkpoint()
+    try:
+        pipeline.run(deployment.journal.completedStages,
+                     partial(deployment.journal.complete, deployment))
+    except BaseException:
+        print(
+            f"The deployment \"{deployment.friendlyName}\" can be resumed with : resume {deployment.journal.path}", file=sys.stderr)
+        raise
+    deployment.journal.remove()
+
+
+# A spec file lists several deployments to be created in one go, as YAML (when PyYAML is installed) or JSON:
+#
+#   deployments:
+#     - name: office-us
+#       region: us-east-1
+#       splitTunnel: true
+#       clients: [alice, bob]
+#       pki: office
+#       subnets: 2
+#     - name: office-eu
+#       region: eu-west-1
+#       pki: office
+#
+# The deployments sharing the same "pki" value share one CA, server and client certificate,
+# so that a client profile from any of them is accepted by all of them.
+# A deployment without the "pki" key gets a PKI of its own.
+def load_spec(path):
+    content = Path(path).read_text()
+    try:
+        import yaml
+    except ImportError:
         try:
-            client_ec2 = boto3.client(
-                "ec2", region_name=USER_SETTINGS['region'])
-            client_acm = boto3.client(
-                "acm", region_name=USER_SETTINGS['region'])
-            client_cf = boto3.client(
-                "cloudformation", region_name=USER_SETTINGS['region'])
-            generate_credentials()
-            download_cloudformation_template(),
-            # save the aws-generated private keys at the same time.
-            deploy_cloudformation_template()
-            download_connection_profile()
-            # # Insert the generated credential into the .ovpn file.
-            save_the_setup_results()
+            spec = loads(content)
+        except ValueError:
+            raise Exception(
+                f"Failed to parse the spec \"{path}\". Please install PyYAML to use YAML specs, or write it as JSON.")
+    else:
+        spec = yaml.safe_load(content)
+    if isinstance(spec, dict):
+        spec = spec.get('deployments')
+    if not isinstance(spec, list) or len(spec) == 0:
+        raise Exception(
+            f"No deployment found in the spec \"{path}\".")
+    settings = []
+    for entry in spec:
+        if not isinstance(entry, dict) or 'name' not in entry or 'region' not in entry:
+            raise Exception(
+                f"Every deployment in the spec needs a name and a region : {entry}")
+        if entry['region'] not in CLIENT_VPN_REGIONS:
+            raise Exception(
+                f"The region \"{entry['region']}\" of the deployment \"{entry['name']}\" does not support Client VPN Endpoints.")
+        if str(entry['name']) in [x['friendlyName'] for x in settings]:
+            raise Exception(
+                f"The deployment name \"{entry['name']}\" is used more than once in the spec.")
+        settings.append({
+            'friendlyName': str(entry['name']),
+            'isSplitTunneled': bool(entry.get('splitTunnel', False)),
+            'region': entry['region'],
+            'subnetCount': parse_subnet_count(entry.get('subnets', 1)),
+            'clients': [str(x) for x in entry.get('clients', [])],
+            'pki': entry.get('pki'),
+        })
+    return settings
+
+
+# Runs the deployments of one region one after another, and returns a row of the summary table for each of them.
+def run_spec_region(deployments):
+    results = []
+    for deployment in deployments:
+        row = {'NAME': deployment.friendlyName, 'REGION': deployment.region,
+               'RESULT': 'deployed', 'DURATION': '', 'ENDPOINT': '', 'CRITICAL PATH': ''}
+        pipeline = build_deploy_pipeline(deployment)
+        startTime = time.monotonic()
+        try:
+            run_deployment(deployment, pipeline)
         except Exception as e:
-            print(
-                "Errors occured during the deployment process.\n Program Exits.", file=sys.stderr)
-            traceback.print_exc()
+            row['RESULT'] = f"failed: {e}"
+        row['DURATION'] = "{:.1f} s".format(time.monotonic() - startTime)
+        row['ENDPOINT'] = deployment.endpointId or '-'
+        if len(pipeline.timings) > 0:
+            row['CRITICAL PATH'] = ' -> '.join(pipeline.critical_path())
+        results.append(row)
+    return results
+
+
+# Returns the row of a spec entry without a journal which is deployed already, i.e. registered or with a stack,
+# or None when the entry is to be deployed.
+def find_spec_deployment(spec):
+    row = {'NAME': spec['friendlyName'], 'REGION': spec['region'],
+           'RESULT': 'exists', 'DURATION': '', 'ENDPOINT': '-', 'CRITICAL PATH': ''}
+    profiles = query_profiles('friendly_name = ? AND region = ?', (spec['friendlyName'], spec['region']), limit=1)
+    if len(profiles) > 0:
+        row['ENDPOINT'] = profiles[0]['ENDPOINT_ID']
+        return row
+    try:
+        get_client('cloudformation', spec['region']).describe_stacks(
+            StackName=f"ovpn-{spec['friendlyName']}")
+    except Exception as e:
+        if aws_error_code(e) == 'ValidationError':
+            return None  # No such stack.
+        raise
+    return row
+
+
+# The deployments are created concurrently, one worker per region, while the deployments of the same region run in turn.
+# Every deployment uses the builtin PKI backend, since easy-rsa prompts the user and works in a shared directory.
+# Running the same spec again resumes the deployments which were interrupted, from their journals,
+# and reports the ones which are deployed already as existing, instead of deploying them a second time.
+def deploy_from_spec(path):
+    specs = load_spec(path)
+    print(f"Deploying {len(specs)} VPN service(s) from the spec \"{path}\"...")
+    sharedCredentials = {}  # pki group -> credentials
+    deploymentsByRegion = {}
+    deployments = []
+    freshSpecs = [spec for spec in specs if not DeployJournal.path_for(spec['friendlyName']).exists()]
+    with ThreadPoolExecutor(max_workers=min(16, max(1, len(freshSpecs)))) as executor:
+        existing = dict(zip([spec['friendlyName'] for spec in freshSpecs],
+                            executor.map(find_spec_deployment, freshSpecs)))
+    skippedRows = []
+    partialGroups = set()  # pki groups with a journal which cannot seed them
+    for spec in specs:
+        journalPath = DeployJournal.path_for(spec['friendlyName'])
+        if existing.get(spec['friendlyName']) is not None:
+            print(f"The deployment \"{spec['friendlyName']}\" exists already in {spec['region']}. Skipping it.")
+            skippedRows.append(existing[spec['friendlyName']])
+            continue
+        if journalPath.exists():
+            print(f"Resuming the deployment \"{spec['friendlyName']}\" from {journalPath} ...")
+            deployment = DeployJournal.load(journalPath)
+            # A journal without the server key, e.g. written by an earlier version, cannot seed the group.
+            if spec['pki'] is not None and len(deployment.credentials) > 0:
+                if 'serverKey' in deployment.credentials:
+                    sharedCredentials[spec['pki']] = deployment.credentials
+                else:
+                    partialGroups.add(spec['pki'])
+        else:
+            deployment = Deployment(spec, 'builtin', spec['clients'])
+        deployments.append(deployment)
+    specs = [spec for spec in specs if existing.get(spec['friendlyName']) is None]
+    for spec, deployment in zip(specs, deployments):
+        if spec['pki'] is not None and len(deployment.credentials) == 0:
+            if spec['pki'] not in sharedCredentials and spec['pki'] in partialGroups:
+                # A new PKI would not be trusted by the deployments of the group which already imported theirs.
+                skippedRows.append({
+                    'NAME': deployment.friendlyName, 'REGION': deployment.region,
+                    'RESULT': f"failed: the journals of the PKI \"{spec['pki']}\" lack its server key. "
+                              "Please resume them, then deploy this entry with a PKI of its own.",
+                    'DURATION': '', 'ENDPOINT': '-', 'CRITICAL PATH': ''})
+                continue
+            if spec['pki'] not in sharedCredentials:
+                print(f"Generating the shared PKI \"{spec['pki']}\"...")
+                clientNames = []
+                for x in specs:
+                    if x['pki'] == spec['pki']:
+                        clientNames.extend(
+                            name for name in x['clients'] if name not in clientNames)
+                sharedCredentials[spec['pki']] = generate_pki(
+                    str(spec['pki']), clientNames)
+            deployment.credentials = sharedCredentials[spec['pki']]
+        deploymentsByRegion.setdefault(deployment.region, []).append(deployment)
+    startTime = time.monotonic()
+    regionResults = []
+    if len(deploymentsByRegion) > 0:
+        with ThreadPoolExecutor(max_workers=len(deploymentsByRegion)) as executor:
+            regionResults = list(executor.map(
+                run_spec_region, deploymentsByRegion.values()))
+    results = skippedRows + [row for rows in regionResults for row in rows]
+    print("... ... ...")
+    print_table(results, ['NAME', 'REGION', 'RESULT',
+                          'DURATION', 'ENDPOINT', 'CRITICAL PATH'])
+    print("All deployments finished in {:.1f} s.".format(
+        time.monotonic() - startTime))
+    if any(row['RESULT'] not in ('deployed', 'exists') for row in results):
+        sys.exit(1)
+
+
+def deploy():
+    if get_option('--spec') is not None:
+        deploy_from_spec(get_option('--spec'))
+        return
+    pkiBackend = get_option('--pki', PKI_BACKEND or default_pki_backend())
+    extraClientNames = [x for x in get_option('--clients', '').split(',') if x != '']
+    if pkiBackend == 'easy-rsa' and len(extraClientNames) > 0:
+        raise Exception("Additional clients can only be issued with the builtin PKI backend.")
+    subnetCount = parse_subnet_count(get_option('--subnets', 1))
+    print("Let's setup a brand-new VPN service!")
+    input("Please note that this program will create several temporary & non-temporary files and directories under the current working direcory. \
+        Be sure that you have the proper permission to write to the CWD and it is okay for such purposes!\nPlease press any key to proceed. > ")
+    # Before we initiate the deployment sequence, we need to know the following parameters:
+    # - the AWS region where the endpoint will be created. (no Default, mandatory)
+    # - the friendly name of this vpn service. (Default: timestampt/UUID)
+    # - if the vpn service should be split-tunnelled. (Default: non-split-tunnel)
+    # The user will be prompted to speficy these parameters. The job is done within the following function:
+    settings = get_user_settings()
+    settings['subnetCount'] = subnetCount
+    deployment = Deployment(settings, pkiBackend, extraClientNames)
+    try:
+        if DeployJournal.path_for(deployment.friendlyName).exists():
+            raise Exception(
+                f"An interrupted deployment named \"{deployment.friendlyName}\" was found. Please run : resume {DeployJournal.path_for(deployment.friendlyName)}")
+        pipeline = build_deploy_pipeline(deployment)
+        try:
+            run_deployment(deployment, pipeline)
+        finally:
+            pipeline.print_report()
+    except Exception as e:
+        print(
+            "Errors occured during the deployment process.\n Program Exits.", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+
+
+# Picks up an interrupted deployment from its journal (Default: the only journal under the CWD), and runs the stages left.
+# When the journal has no stack id, because the run stopped right after creating the stack,
+# the id can be given with --stack-id or CLOUDFORMATION_STACK_ID to reattach to the stack.
+def resume_deploy():
+    if len(sys.argv) > 2 and not sys.argv[2].startswith('-'):
+        journalPath = sys.argv[2]
+    else:
+        journals = glob(f"*{JOURNAL_SUFFIX}")
+        if len(journals) != 1:
+            raise Exception(
+                f"{len(journals)} deployment journals found under the CWD. Please specify the one to resume.\n{HELP_SCRIPT}")
+        journalPath = journals[0]
+    deployment = DeployJournal.load(journalPath)
+    if deployment.stackId == '':
+        deployment.stackId = get_option('--stack-id', CLOUDFORMATION_STACK_ID)
+    print(f"Resuming the deployment \"{deployment.friendlyName}\" in {deployment.region}.")
+    print("Finished stages : {}".format(
+        ', '.join(deployment.journal.completedStages) or 'none'))
+    try:
+        pipeline = build_deploy_pipeline(deployment)
+        try:
+            run_deployment(deployment, pipeline)
+        finally:
+            pipeline.print_report()
+    except Exception as e:
+        print(
+            "Errors occured during the deployment process.\n Program Exits.", file=sys.stderr)
+        import traceback
+        traceback.print_exc()
+
+
+    # *** THE DEPLOYMENT CODE SECTION ENDS ***
+if __name__ == "__main__":
+    try:
+        start_instrumentation()
+    except Exception as e:
+        print(f"{e}\n{HELP_SCRIPT}", file=sys.stderr)
+        sys.exit(1)
+    try:
+        if len(sys.argv) > 1 and sys.argv[1] != "deploy":  # To see if the command is present.
+            try:
+                # get_configuration()
+                with trace_span(f"command:{sys.argv[1]}"):
+                    manage()
+            except Exception as e:
+                print("Errors occured.", file=sys.stderr)
+                import traceback
+                traceback.print_exc()
+        else:  # manage the vpn when there is no commands or options.
+            with trace_span("command:deploy"):
+                deploy()
+    finally:
+        export_instrumentation()